@@ -0,0 +1,88 @@
+"""
+Benchmarks the convolution engines used by `smooth_data`.
+
+Times each engine over a grid of array and kernel sizes and reports, for
+each number of samples, the kernel size from which the FFT engine is faster
+than direct convolution. These crossovers are used as `FFT_KERNEL_SIZES` in
+`cosmoscope/operations/convolution.py`. The block-wise engine is timed on
+memory-mapped arrays against convolving the whole array at once, which is
+used to choose `STREAM_THRESHOLD`.
+
+Run with::
+
+    python benchmarks/bench_smooth.py
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+# Benchmark the working tree rather than an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from cosmoscope.operations.convolution import (  # noqa: E402
+    ENGINES, blockwise_convolve, choose_engine, direct_convolve,
+    fft_convolve)
+
+N_SAMPLES = (10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6)
+N_KERNEL = (3, 9, 17, 25, 33, 41, 49, 57, 65, 81, 97, 129, 257, 513)
+
+# Sizes of the memory-mapped arrays the block-wise engine is timed on
+N_STREAMED = (2 ** 18, 2 ** 20, 2 ** 22)
+
+
+def best_time(func, repeat=3):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    print("{:>10s} {:>7s} {:>10s} {:>10s}".format(
+        "samples", "kernel", "direct", "fft"))
+
+    for n_samples in N_SAMPLES:
+        array = np.random.randn(n_samples)
+        array[::997] = np.nan
+        crossover = None
+
+        for n_kernel in N_KERNEL:
+            kernel = np.ones(n_kernel)
+
+            direct = best_time(lambda: direct_convolve(array, kernel))
+            fft = best_time(lambda: fft_convolve(array, kernel))
+
+            # The crossover is the kernel size from which the FFT stays
+            # faster, so a single noisy timing does not set it
+            if fft >= direct:
+                crossover = None
+            elif crossover is None:
+                crossover = n_kernel
+
+            print("{:>10d} {:>7d} {:>9.2f}ms {:>9.2f}ms".format(
+                n_samples, n_kernel, direct * 1e3, fft * 1e3))
+
+        print("FFT is faster from a kernel size of {} for {} samples.\n"
+              .format(crossover, n_samples))
+
+    print("{:>10s} {:>7s} {:>10s} {:>10s}".format(
+        "streamed", "kernel", "blockwise", "whole"))
+
+    for n_samples in N_STREAMED:
+        mapped = np.memmap(tempfile.TemporaryFile(), dtype=float, mode='w+',
+                           shape=(n_samples,))
+        mapped[:] = np.random.randn(n_samples)
+
+        for n_kernel in (9, 129):
+            kernel = np.ones(n_kernel)
+            engine = ENGINES[choose_engine(n_samples, n_kernel)]
+
+            blockwise = best_time(lambda: blockwise_convolve(mapped, kernel))
+            whole = best_time(lambda: engine(mapped, kernel))
+
+            print("{:>10d} {:>7d} {:>9.2f}ms {:>9.2f}ms".format(
+                n_samples, n_kernel, blockwise * 1e3, whole * 1e3))
+
+
+if __name__ == '__main__':
+    main()
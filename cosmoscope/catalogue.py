@@ -0,0 +1,183 @@
+"""Contains the columnar container holding many small spectra."""
+import uuid
+
+import numpy as np
+from astropy.nddata import StdDevUncertainty
+from astropy.units import Quantity, Unit
+
+__all__ = ['Catalogue', 'CATALOGUE_SEPARATOR']
+
+# Separates the catalogue identifier and spectrum index in the identifiers
+# of spectra materialized from a catalogue, e.g. ``<identifier>/42``
+CATALOGUE_SEPARATOR = '/'
+
+
+def _read_only(array):
+    view = array.view()
+    view.setflags(write=False)
+
+    return view
+
+
+class Catalogue:
+    """
+    Columnar container of many spectra. The values of all spectra are held
+    in one ragged buffer per array, with spectrum ``i`` stored between
+    ``offsets[i]`` and ``offsets[i + 1]``, and units shared by all spectra.
+    Spectra are addressed by their integer index, and are only materialized
+    as `~cosmoscope.data.Data` objects on demand.
+
+    Parameters
+    ----------
+    flux : `~astropy.units.Quantity` or `~numpy.ndarray`
+        The flux values of all spectra, concatenated.
+    spectral_axis : `~astropy.units.Quantity` or `~numpy.ndarray`
+        The spectral axis values of all spectra, concatenated.
+    offsets : `~numpy.ndarray`
+        Start index of each spectrum in the buffers, followed by the total
+        number of values.
+    unit, spectral_axis_unit : str or `~astropy.units.Unit`, optional
+        Units of arrays that are not quantities.
+    uncertainty : `~numpy.ndarray`, optional
+        Standard deviation uncertainties of all spectra, concatenated.
+    mask : `~numpy.ndarray`, optional
+        Masks of all spectra, concatenated.
+    names : list of str, optional
+        Name of each spectrum.
+    name : str, optional
+        Name of the catalogue.
+    """
+    def __init__(self, flux, spectral_axis, offsets, unit=None,
+                 spectral_axis_unit=None, uncertainty=None, mask=None,
+                 names=None, name=None):
+        self.unit = Unit(getattr(flux, 'unit', unit) or "")
+        self.spectral_axis_unit = Unit(
+            getattr(spectral_axis, 'unit', spectral_axis_unit) or "")
+
+        self.flux = np.asarray(getattr(flux, 'value', flux))
+        self.spectral_axis = np.asarray(
+            getattr(spectral_axis, 'value', spectral_axis))
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.uncertainty = np.asarray(uncertainty) \
+            if uncertainty is not None else None
+        self.mask = np.asarray(mask) if mask is not None else None
+        self.names = list(names) if names is not None else None
+
+        if self.offsets.ndim != 1 or self.offsets.shape[0] < 1 \
+                or self.offsets[0] != 0 \
+                or self.offsets[-1] != self.flux.shape[0] \
+                or np.any(np.diff(self.offsets) < 0):
+            raise ValueError("Offsets must increase from 0 to the number of "
+                             "flux values.")
+
+        for array in (self.spectral_axis, self.uncertainty, self.mask):
+            if array is not None and array.shape != self.flux.shape:
+                raise ValueError("Catalogue arrays must have the same shape "
+                                 "as the flux.")
+
+        if self.names is not None and len(self.names) != len(self):
+            raise ValueError("There must be one name per spectrum.")
+
+        self._identifier = str(uuid.uuid4())
+        self._name = name
+        self._version = 0
+
+    @classmethod
+    def from_arrays(cls, fluxes, spectral_axes, **kwargs):
+        """
+        Build a catalogue from a list of flux arrays and a list of spectral
+        axis arrays, one per spectrum.
+        """
+        lengths = [len(flux) for flux in fluxes]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        def concatenate(arrays):
+            unit = getattr(arrays[0], 'unit', None) if len(arrays) else None
+            values = np.concatenate(
+                [getattr(x, 'value', x) for x in arrays]) \
+                if len(arrays) else np.empty(0)
+
+            return Quantity(values, unit, copy=False) \
+                if unit is not None else values
+
+        for key in ('uncertainty', 'mask'):
+            if kwargs.get(key) is not None:
+                kwargs[key] = np.concatenate(kwargs[key])
+
+        return cls(concatenate(fluxes), concatenate(spectral_axes), offsets,
+                   **kwargs)
+
+    @property
+    def identifier(self):
+        return self._identifier
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def version(self):
+        return self._version
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    @property
+    def lengths(self):
+        """Return the number of values of each spectrum."""
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (
+            self.flux, self.spectral_axis, self.offsets, self.uncertainty,
+            self.mask) if array is not None)
+
+    def _slice(self, index):
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError("Catalogue has no spectrum {}.".format(index))
+
+        return index, slice(self.offsets[index], self.offsets[index + 1])
+
+    def spectrum(self, index):
+        """
+        Materialize a spectrum of the catalogue as a data object. The arrays
+        of the data object are read-only views on the catalogue buffers, and
+        the data object is not registered with the store.
+
+        Parameters
+        ----------
+        index : int
+            Index of the spectrum.
+
+        Returns
+        -------
+        : `~cosmoscope.data.Data`
+            The spectrum, with an identifier made of the catalogue identifier
+            and the index.
+        """
+        from .data import Data
+
+        index, values = self._slice(index)
+
+        uncertainty = StdDevUncertainty(
+            _read_only(self.uncertainty[values])) \
+            if self.uncertainty is not None else None
+        mask = _read_only(self.mask[values]) \
+            if self.mask is not None else None
+        name = self.names[index] if self.names is not None \
+            else '{} {}'.format(self._name or 'Spectrum', index)
+
+        data = Data.restore(
+            '{}{}{}'.format(self._identifier, CATALOGUE_SEPARATOR, index),
+            Quantity(_read_only(self.flux[values]), self.unit, copy=False),
+            spectral_axis=Quantity(_read_only(self.spectral_axis[values]),
+                                   self.spectral_axis_unit, copy=False),
+            uncertainty=uncertainty, mask=mask, name=name)
+        data._version = self._version
+
+        return data
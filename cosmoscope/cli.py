@@ -6,11 +6,31 @@ from .server import launch
 
 
 @click.command()
-@click.option('--server-address', default="tcp://127.0.0.1:4242", help="Server IP address.")
-@click.option('--publisher-address', default="tcp://127.0.0.1:4243", help="Publisher IP address.")
-def main(server_address=None, publisher_address=None):
+@click.option('--server-address', default="tcp://127.0.0.1:4242",
+              help="Server IP address.")
+@click.option('--publisher-address', default="tcp://127.0.0.1:4243",
+              help="Publisher IP address.")
+@click.option('--autosave-interval', default=None, type=float,
+              help="Seconds between session autosaves.")
+@click.option('--workers', default=None, type=int,
+              help="Number of worker processes for operations.")
+@click.option('--history-budget', default=None, type=int,
+              help="Maximum bytes held in memory, shared by all undo "
+                   "histories.")
+@click.option('--disk-cache/--no-disk-cache', default=False,
+              help="Cache operation results on disk.")
+@click.option('--memory-budget', default=None, type=int,
+              help="Maximum bytes of data arrays kept in memory.")
+@click.option('--memmap-threshold', default=None, type=int,
+              help="Bytes from which data arrays are memory-mapped.")
+def main(server_address=None, publisher_address=None, autosave_interval=None,
+         workers=None, history_budget=None, disk_cache=False,
+         memory_budget=None, memmap_threshold=None):
     """Console interface for the cosmoscope server."""
-    launch(server_address, publisher_address)
+    launch(server_address, publisher_address,
+           autosave_interval=autosave_interval, workers=workers,
+           history_budget=history_budget, disk_cache=disk_cache,
+           memory_budget=memory_budget, memmap_threshold=memmap_threshold)
 
 
 if __name__ == "__main__":
@@ -1,14 +1,21 @@
 """Contains core data container class and related functions."""
+import base64
 import logging
+import os
 from abc import ABCMeta
 
 import jsonpickle
 import numpy as np
+from astropy.modeling import CompoundModel
+from astropy.modeling.tabular import Tabular1D
 from astropy.units import Quantity, Unit
 from gwcs.coordinate_frames import SpectralFrame
 from specutils import Spectrum1D
+from specutils.utils.wcs_utils import SpectralGWCS, gwcs_from_array
 
 from .mixins import StoreRegistry
+from .utils.memmap import MEMMAP_PATH, release_on_collect, to_memmap
+from .utils.pyramid import Pyramid
 
 __all__ = ['Data']
 
@@ -23,6 +30,20 @@ class Data(Spectrum1D, metaclass=_StoreRegistryProxy):
 
         self._identifier = None
         self._name = name
+        self._version = 0
+        self._pyramid = None
+
+    @classmethod
+    def restore(cls, identifier, *args, **kwargs):
+        """
+        Rebuild a data object with a known identifier. Unlike calling the
+        class directly, the object is not registered with the store.
+        """
+        instance = cls.__new__(cls, *args, **kwargs)
+        instance.__init__(*args, **kwargs)
+        instance._identifier = identifier
+
+        return instance
 
     @property
     def identifier(self):
@@ -34,6 +55,76 @@ class Data(Spectrum1D, metaclass=_StoreRegistryProxy):
         """Return user-provided name of object."""
         return self._name
 
+    @property
+    def version(self):
+        """
+        Return the version of this data object. The version is incremented
+        every time the data is changed through the store.
+        """
+        return self._version
+
+    @property
+    def pyramid(self):
+        """
+        Return the min/max `~cosmoscope.utils.pyramid.Pyramid` of the flux
+        array. The pyramid is built on first access and rebuilt lazily when
+        the data object has changed.
+        """
+        if self._pyramid is None or self._pyramid[0] != self._version:
+            self._pyramid = (self._version, Pyramid(self.flux.value))
+
+        return self._pyramid[1]
+
+    @property
+    def nbytes(self):
+        """
+        Return the number of bytes used by the flux, uncertainty and mask
+        arrays of this data object.
+        """
+        arrays = (self.data,
+                  self.uncertainty.array
+                  if self.uncertainty is not None else None,
+                  self.mask)
+
+        return sum(np.asarray(x).nbytes for x in arrays if x is not None)
+
+    @property
+    def is_memmapped(self):
+        """Return whether the flux array is backed by a memory-mapped file."""
+        return isinstance(self.data, np.memmap)
+
+    def to_memmap(self, path=None):
+        """
+        Spill the flux, uncertainty and mask arrays of this data object to
+        `.npy` files and replace them with memory-mapped arrays. The files are
+        removed once the data object is garbage collected.
+
+        Parameters
+        ----------
+        path : str, optional
+            Directory in which to store the arrays. Defaults to a directory
+            named after the identifier in `~/.cosmoscope/arrays`.
+        """
+        path = path or os.path.join(MEMMAP_PATH, self.identifier)
+
+        if self.is_memmapped:
+            return
+
+        self._data = to_memmap(self.data, os.path.join(path, 'flux.npy'))
+
+        if self.uncertainty is not None:
+            self.uncertainty.array = to_memmap(
+                self.uncertainty.array,
+                os.path.join(path, 'uncertainty.npy'))
+
+        if self.mask is not None:
+            self.mask = to_memmap(self.mask, os.path.join(path, 'mask.npy'))
+
+        release_on_collect(self, path)
+
+        logging.info("Data object with id %s is now memory-mapped to %s.",
+                     self.identifier, path)
+
     def to_dict(self):
         """Convert and return data object as a dictionary representation."""
         return dict(
@@ -94,38 +185,87 @@ class UnitHandler(jsonpickle.handlers.BaseHandler):
 
 class SpectralFrameHandler(jsonpickle.handlers.BaseHandler):
     def flatten(self, obj, data):
-        data['__dict__'] = obj.__dict__.copy()
-        data['__dict__']['_unit'] = [x.to_string() for x in obj.unit]
+        # The units are flattened with the rest of the attributes
+        data['__dict__'] = self.context.flatten(obj.__dict__, reset=False)
         return data
 
     def restore(self, obj):
-        spec_frame = SpectralFrame()
-        spec_frame.__dict__ = obj['__dict__']
-        spec_frame._unit = tuple([Unit(x) for x in obj['__dict__']['_unit']])
+        spec_frame = SpectralFrame.__new__(SpectralFrame)
+        spec_frame.__dict__ = self.context.restore(obj['__dict__'],
+                                                   reset=False)
         return spec_frame
 
 
+class SpectralGWCSHandler(jsonpickle.handlers.BaseHandler):
+    """
+    Lookup table WCS use a model class created on the fly, which can not be
+    restored, so only their spectral axis is stored and they are rebuilt
+    from it.
+    """
+    def flatten(self, obj, data):
+        transform = obj.forward_transform
+        models = transform.traverse_postorder() \
+            if isinstance(transform, CompoundModel) else [transform]
+        lookup_table = next(model.lookup_table for model in models
+                            if isinstance(model, Tabular1D))
+
+        # The spectral frame comes last in the frames of cubes, and its axis
+        # order is reversed with respect to the numpy array
+        frames = getattr(obj.output_frame, 'frames', [obj.output_frame])
+        naxes = obj.input_frame.naxes
+
+        data['spectral_axis'] = self.context.flatten(Quantity(lookup_table),
+                                                     reset=False)
+        data['naxes'] = naxes
+        data['spectral_axis_index'] = naxes - 1 - int(
+            frames[-1].axes_order[0])
+        return data
+
+    def restore(self, obj):
+        spectral_axis = self.context.restore(obj['spectral_axis'],
+                                             reset=False)
+        naxes = obj['naxes']
+
+        return gwcs_from_array(
+            spectral_axis, (1,) * (naxes - 1) + (len(spectral_axis),),
+            obj['spectral_axis_index'] if naxes > 1 else None)
+
+
 class QuantityHandler(jsonpickle.handlers.BaseHandler):
     def flatten(self, obj, data):
-        data['value'] = obj.value
+        data['value'] = self.context.flatten(obj.value, reset=False)
         data['unit'] = obj.unit.to_string()
         return data
 
     def restore(self, obj):
-        return Quantity(obj['value'], unit=obj['unit'])
+        return Quantity(self.context.restore(obj['value'], reset=False),
+                        unit=obj['unit'])
 
 
 class NumpyArrayHandler(jsonpickle.handlers.BaseHandler):
     def flatten(self, obj, data):
-        data['value'] = obj.tolist()
+        # Store the raw buffer rather than a list of python objects, falling
+        # back to a list for arrays that hold arbitrary python objects
+        if obj.dtype.hasobject:
+            data['value'] = obj.tolist()
+        else:
+            data['buffer'] = base64.b64encode(
+                np.ascontiguousarray(obj)).decode('ascii')
+            data['shape'] = obj.shape
         data['dtype'] = obj.dtype.str
         return data
 
     def restore(self, obj):
+        if 'buffer' in obj:
+            return np.frombuffer(
+                base64.b64decode(obj['buffer']),
+                dtype=obj['dtype']).reshape(obj['shape'])
+
         return np.array(obj['value'], dtype=obj['dtype'])
 
 
 jsonpickle.handlers.register(Unit, UnitHandler)
 jsonpickle.handlers.register(SpectralFrame, SpectralFrameHandler)
+jsonpickle.handlers.register(SpectralGWCS, SpectralGWCSHandler)
 jsonpickle.handlers.register(Quantity, QuantityHandler)
 jsonpickle.handlers.register(np.ndarray, NumpyArrayHandler)
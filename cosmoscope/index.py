@@ -0,0 +1,368 @@
+"""Contains the spectral index used to search the data objects of the store."""
+import logging
+import operator
+
+import numpy as np
+import astropy.units as u
+
+__all__ = ['SpectralIndex', 'spectral_index', 'summarize', 'SUMMARY_FIELDS']
+
+# Unit of the spectral ranges held by the index
+INDEX_UNIT = u.AA
+
+# Number of intervals checked at once at the leaves of the interval tree
+LEAF_SIZE = 64
+
+# Per-spectrum summary statistics that predicates can be applied to
+SUMMARY_FIELDS = ('spectral_min', 'spectral_max', 'flux_min', 'flux_max',
+                  'flux_mean', 'n_samples')
+
+_OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt,
+              '>=': operator.ge, '==': operator.eq, '!=': operator.ne}
+
+
+def _to_index_unit(values, unit):
+    return u.Quantity(values, unit).to_value(INDEX_UNIT,
+                                             equivalencies=u.spectral())
+
+
+def _summarize(spectral_axis, flux, offsets):
+    """
+    Return the summary statistics of spectra stored in ragged buffers, with
+    spectrum ``i`` between ``offsets[i]`` and ``offsets[i + 1]``.
+    """
+    lengths = np.diff(offsets)
+    starts = np.minimum(offsets[:-1], max(len(flux) - 1, 0))
+    valid = ~np.isnan(flux)
+    counts = np.add.reduceat(valid, starts) if len(flux) \
+        else np.zeros(len(lengths))
+
+    def reduce(ufunc, values):
+        if not len(values):
+            return np.full(len(lengths), np.nan)
+
+        result = ufunc.reduceat(values, starts).astype(float)
+        result[lengths == 0] = np.nan
+
+        return result
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = reduce(np.add, np.where(valid, flux, 0.)) / counts
+
+    return {'spectral_min': reduce(np.fmin, spectral_axis),
+            'spectral_max': reduce(np.fmax, spectral_axis),
+            'flux_min': reduce(np.fmin, flux),
+            'flux_max': reduce(np.fmax, flux),
+            'flux_mean': np.where(counts > 0, mean, np.nan),
+            'n_samples': lengths}
+
+
+def summarize(spectral_axis, unit, flux):
+    """
+    Return the summary statistics of a spectrum as a dict of numbers, with
+    its spectral range in the unit of the index.
+    """
+    flux = np.asarray(flux, dtype=float).reshape(-1)
+    summary = _summarize(_to_index_unit(spectral_axis, unit), flux,
+                         np.array([0, len(flux)]))
+
+    return {field: summary[field][0].item() for field in SUMMARY_FIELDS}
+
+
+class _IntervalTree:
+    """
+    Static interval tree over intervals sorted by their start. The maximum
+    end of each group of intervals is kept in a binary tree, so that
+    intervals overlapping a range are found by only descending into groups
+    that can hold one, in logarithmic time plus the number of matches.
+    """
+    def __init__(self, starts, ends):
+        self.order = np.argsort(starts, kind='stable')
+        self.starts = starts[self.order]
+        self.ends = ends[self.order]
+
+        n_leaves = max(-(-len(starts) // LEAF_SIZE), 1)
+        self.size = 1 << (n_leaves - 1).bit_length()
+        self.tree = np.full(2 * self.size, -np.inf)
+
+        if len(starts):
+            self.tree[self.size:self.size + n_leaves] = np.fmax.reduceat(
+                self.ends, np.arange(0, len(starts), LEAF_SIZE))
+
+        for level in range(self.size.bit_length() - 2, -1, -1):
+            nodes = np.arange(1 << level, 2 << level)
+            self.tree[nodes] = np.fmax(self.tree[2 * nodes],
+                                       self.tree[2 * nodes + 1])
+
+    def overlap(self, lo, hi):
+        """Return the rows of the intervals overlapping ``[lo, hi]``."""
+        # Only intervals starting before the end of the range can overlap
+        limit = np.searchsorted(self.starts, hi, side='right')
+        found = []
+        stack = [1]
+
+        while stack:
+            node = stack.pop()
+            level = node.bit_length() - 1
+            span = (self.size >> level) * LEAF_SIZE
+            first = (node - (1 << level)) * span
+
+            if first >= limit or self.tree[node] < lo:
+                continue
+
+            if node < self.size:
+                stack.extend((2 * node + 1, 2 * node))
+                continue
+
+            rows = np.arange(first, min(first + LEAF_SIZE, limit))
+            found.append(rows[self.ends[rows] >= lo])
+
+        if not found:
+            return np.empty(0, dtype=int)
+
+        return self.order[np.concatenate(found)]
+
+
+class SpectralIndex:
+    """
+    Index of the spectral range and summary statistics of the data objects
+    and catalogue spectra of the store, kept up to date as a store listener.
+    Ranges are held in Angstrom, and the interval tree is rebuilt on the
+    first query after the store has changed. Data objects that are not
+    loaded are indexed from their stored summary and arrays, so the index
+    never loads them into the store.
+    """
+    def __init__(self):
+        # Columns of the summary statistics of each data object or catalogue
+        self._blocks = {}
+        self._tree = None
+        self._columns = None
+        self._store = None
+
+    def attach(self, store):
+        """Index the current contents of the store and follow its changes."""
+        self._store = store
+
+        for identifier, data in list(dict.items(store)):
+            self._index_data(identifier, data)
+
+        for catalogue in store.catalogues.values():
+            self._index_catalogue(catalogue)
+
+        store.subscribe(self.on_change)
+
+    def on_change(self, event, identifier, **info):
+        """Store listener that keeps the index up to date."""
+        store = self._store
+
+        if event in ('unregister', 'unregister_catalogue'):
+            self._blocks.pop(identifier, None)
+        elif event == 'register_catalogue':
+            self._index_catalogue(store.catalogues[identifier])
+        elif event == 'register' or (event == 'update'
+                                     and 'data' in info.get('diff', {})):
+            self._index_data(identifier, dict.get(store, identifier))
+        else:
+            return
+
+        self._tree = None
+
+    def _index_data(self, identifier, data):
+        from .session import DeferredData
+
+        if not isinstance(data, DeferredData):
+            summary = summarize(data.spectral_axis.value,
+                                data.spectral_axis.unit, data.flux.value)
+        elif 'summary' in data.entry:
+            summary = data.entry['summary']
+        else:
+            # Sessions saved before summaries were kept in the manifest
+            summary = summarize(data.array('spectral_axis'),
+                                data.entry['spectral_axis_unit'],
+                                data.array('flux'))
+
+        block = {field: np.array([summary[field]]) for field in SUMMARY_FIELDS}
+        block['catalogue'] = None
+
+        self._blocks[identifier] = block
+
+    def _index_catalogue(self, catalogue):
+        summary = _summarize(
+            _to_index_unit(catalogue.spectral_axis,
+                           catalogue.spectral_axis_unit),
+            np.asarray(catalogue.flux, dtype=float), catalogue.offsets)
+        summary['catalogue'] = catalogue
+
+        self._blocks[catalogue.identifier] = summary
+
+        logging.info("Indexed %d spectra of catalogue %s.", len(catalogue),
+                     catalogue.identifier)
+
+    def _build(self):
+        """Concatenate the indexed columns and build the interval tree."""
+        from .catalogue import CATALOGUE_SEPARATOR
+        from .session import DeferredData
+
+        store = self._store
+        identifiers = list(self._blocks)
+        blocks = [self._blocks[identifier] for identifier in identifiers]
+        counts = [len(block['n_samples']) for block in blocks]
+
+        columns = {field: np.concatenate(
+            [block[field] for block in blocks]) if blocks else np.empty(0)
+            for field in SUMMARY_FIELDS}
+
+        # Row of each indexed spectrum in its block, used to rebuild the
+        # identifiers of catalogue spectra
+        columns['block'] = np.repeat(np.arange(len(blocks)), counts)
+        columns['local'] = np.concatenate(
+            [np.arange(count) for count in counts]) if blocks \
+            else np.empty(0, dtype=int)
+
+        def key(row):
+            block = blocks[columns['block'][row]]
+            identifier = identifiers[columns['block'][row]]
+
+            if block['catalogue'] is not None:
+                return '{}{}{}'.format(identifier, CATALOGUE_SEPARATOR,
+                                       columns['local'][row])
+
+            return identifier
+
+        def values(row):
+            """Return the spectral axis, in Angstrom, and flux of a row."""
+            catalogue = blocks[columns['block'][row]]['catalogue']
+
+            # Catalogue spectra are read from the buffers of the catalogue
+            # rather than materialized as data objects
+            if catalogue is not None:
+                _, values = catalogue._slice(int(columns['local'][row]))
+
+                return (_to_index_unit(catalogue.spectral_axis[values],
+                                       catalogue.spectral_axis_unit),
+                        catalogue.flux[values])
+
+            data = dict.get(store, identifiers[columns['block'][row]])
+
+            # Data objects that are not loaded are read from their stored
+            # arrays, without being loaded into the store
+            if isinstance(data, DeferredData):
+                return (_to_index_unit(data.array('spectral_axis'),
+                                       data.entry['spectral_axis_unit']),
+                        data.array('flux'))
+
+            return (_to_index_unit(data.spectral_axis.value,
+                                   data.spectral_axis.unit),
+                    data.flux.value)
+
+        self._key = key
+        self._values = values
+        self._columns = columns
+        self._tree = _IntervalTree(columns['spectral_min'],
+                                   columns['spectral_max'])
+
+    def __len__(self):
+        return sum(len(block['n_samples']) for block in self._blocks.values())
+
+    def query(self, spectral_range=None, predicates=None, unit=INDEX_UNIT,
+              slices=False):
+        """
+        Find the spectra covering a spectral range whose statistics match
+        all of the given predicates.
+
+        Parameters
+        ----------
+        spectral_range : tuple, optional
+            Lower and upper bound of the spectral range, in `unit`.
+        predicates : list of tuple, optional
+            Predicates of the form ``(field, operator, value)``, with `field`
+            one of `SUMMARY_FIELDS` and `operator` one of ``<``, ``<=``,
+            ``>``, ``>=``, ``==`` and ``!=``. When a spectral range is given,
+            flux predicates apply to the values within the range. Values are
+            compared in the flux unit of each spectrum.
+        unit : str or `~astropy.units.Unit`
+            Unit of the spectral range.
+        slices : bool
+            If set, the index range of the values within the spectral range
+            is returned with the identifier of each spectrum.
+
+        Returns
+        -------
+        : list
+            The identifiers of the matching spectra, or dicts with the
+            `identifier`, `start` and `stop` of each slice if `slices` is set.
+        """
+        predicates = [(field, _OPERATORS[op], value)
+                      for field, op, value in predicates or []]
+
+        for field, _, _ in predicates:
+            if field not in SUMMARY_FIELDS:
+                raise ValueError("Unknown summary field '{}'.".format(field))
+
+        if self._tree is None:
+            self._build()
+
+        columns = self._columns
+
+        if spectral_range is not None:
+            lo, hi = sorted(_to_index_unit(spectral_range, unit))
+            rows = np.sort(self._tree.overlap(lo, hi))
+        else:
+            rows = np.arange(len(columns['n_samples']))
+
+        # Predicates are decided from the summary of whole spectra, except
+        # for flux predicates on a spectral range, which can only be ruled
+        # out when even the whole spectrum does not match
+        exact = []
+
+        for field, compare, value in predicates:
+            if spectral_range is None or not field.startswith('flux'):
+                rows = rows[compare(columns[field][rows], value)]
+            elif (field, compare) in (('flux_max', operator.gt),
+                                      ('flux_max', operator.ge),
+                                      ('flux_min', operator.lt),
+                                      ('flux_min', operator.le)):
+                rows = rows[compare(columns[field][rows], value)]
+                exact.append((field, compare, value))
+            else:
+                exact.append((field, compare, value))
+
+        if spectral_range is None:
+            return [{'identifier': self._key(row), 'start': 0,
+                     'stop': int(columns['n_samples'][row])}
+                    if slices else self._key(row) for row in rows]
+
+        return self._match_slices(rows, lo, hi, exact, slices)
+
+    def _match_slices(self, rows, lo, hi, predicates, slices):
+        results = []
+
+        for row in rows:
+            spectral_axis, flux = self._values(row)
+            inside = np.flatnonzero((spectral_axis >= lo)
+                                    & (spectral_axis <= hi))
+
+            if not len(inside):
+                continue
+
+            start, stop = int(inside[0]), int(inside[-1]) + 1
+
+            if predicates:
+                flux = np.asarray(flux[..., start:stop],
+                                  dtype=float).reshape(-1)
+                stats = _summarize(spectral_axis[start:stop], flux,
+                                   np.array([0, len(flux)]))
+
+                if not all(compare(stats[field][0], value)
+                           for field, compare, value in predicates):
+                    continue
+
+            identifier = self._key(row)
+            results.append({'identifier': identifier, 'start': start,
+                            'stop': stop} if slices else identifier)
+
+        return results
+
+
+# Initialize the spectral index of the store
+spectral_index = SpectralIndex()
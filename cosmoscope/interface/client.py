@@ -5,15 +5,92 @@ import msgpack
 import json
 from zerorpc import Client, Puller, Pusher, Subscriber
 from zmq.error import ZMQError
+import numpy as np
 
+from ..transport import unpack, unpack_array
 from ..utils.singleton import Singleton
 
 
 class SubscriberAPI(Subscriber, metaclass=Singleton):
+    """
+    Subscriber service receiving change events from the server. Data objects
+    that are watched with `watch` are kept as local replicas that are patched
+    with the deltas sent by the server, rather than queried again in full.
+    """
     def __init__(self, client=None, *args, **kwargs):
         super(SubscriberAPI, self).__init__(*args, **kwargs)
         # Setup pusher service
         self.client = client
+        self.replicas = {}
+        self._listeners = []
+
+    def subscribe(self, callback):
+        """
+        Add a callback that is called as ``callback(event, identifier)`` for
+        every `data_updated` and `data_removed` event received.
+        """
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        """Remove a callback previously added with `subscribe`."""
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _notify(self, event, identifier, **info):
+        for callback in list(self._listeners):
+            callback(event, identifier, **info)
+
+    def watch(self, identifier):
+        """
+        Start keeping a local replica of the data object with the given
+        identifier and return it.
+        """
+        if identifier not in self.replicas:
+            self._fetch(identifier)
+
+        return self.replicas[identifier]
+
+    def unwatch(self, identifier):
+        """Stop keeping a local replica of the data object."""
+        self.replicas.pop(identifier, None)
+
+    def _fetch(self, identifier):
+        replica = unpack(self.client.query_data(identifier, True))
+
+        # Received arrays are read-only views on the message buffer
+        for key in ('spectral_axis', 'flux'):
+            replica[key] = np.array(replica[key])
+
+        self.replicas[identifier] = replica
+
+    def data_updated(self, identifier, delta):
+        """
+        Patch the local replica of a data object with the changed values.
+        Replicas that missed an update are queried again in full.
+        """
+        self._notify('data_updated', identifier, delta=delta)
+
+        replica = self.replicas.get(identifier)
+
+        if replica is None:
+            return
+
+        if delta['reload'] or delta['previous_version'] != replica['version']:
+            self._fetch(identifier)
+            return
+
+        replica.update(delta['fields'])
+
+        for start, stop, values in delta['arrays'].get('data', []):
+            replica['flux'][..., start:stop] = unpack_array(values)
+
+        replica['version'] = delta['version']
+
+    def data_removed(self, identifier):
+        """Drop the local replica of a removed data object."""
+        self._notify('data_removed', identifier)
+        self.unwatch(identifier)
 
 
 def launch(subscriber_address=None, client_address=None):
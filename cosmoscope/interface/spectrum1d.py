@@ -1,11 +1,148 @@
 from ..store import store
+from ..transport import ARRAY_EXT_CODE, unpack_array
 from .client import SubscriberAPI
 
 import jsonpickle
+import msgpack
 
 # Get the client singleton
 subscriber = SubscriberAPI()
 
+# Attributes that never change for a given data object
+IMMUTABLE_ATTRIBUTES = ('identifier', 'spectral_axis', 'wcs')
+
+
+class AttributeCache:
+    """
+    Client-side cache of the attributes of remote data objects. Cached values
+    are tagged with the version of the data object they were queried at, and
+    are dropped when the subscriber receives a change event for the data
+    object. Immutable attributes are kept until the data object is removed.
+
+    Parameters
+    ----------
+    subscriber : `~cosmoscope.interface.client.SubscriberAPI`
+        The subscriber receiving change events from the server.
+    """
+    def __init__(self, subscriber):
+        self._values = {}
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+
+        subscriber.subscribe(self._invalidate)
+
+    def _invalidate(self, event, identifier, **info):
+        if event == 'data_removed':
+            self._values.pop(identifier, None)
+            self._versions.pop(identifier, None)
+            return
+
+        # Values queried before this event are now stale
+        self._versions[identifier] = self._versions.get(identifier, 0) + 1
+
+        values = self._values.get(identifier, {})
+
+        for name in list(values):
+            if name not in IMMUTABLE_ATTRIBUTES:
+                del values[name]
+
+    def get(self, identifier, name, query):
+        """
+        Return the cached attribute, calling ``query(identifier, name)`` to
+        retrieve it if it is not cached.
+        """
+        values = self._values.setdefault(identifier, {})
+        version = self._versions.get(identifier, 0)
+
+        if name in values and (name in IMMUTABLE_ATTRIBUTES
+                               or values[name][0] == version):
+            self.hits += 1
+            return values[name][1]
+
+        self.misses += 1
+        value = query(identifier, name)
+        self.put(identifier, name, value, version)
+
+        return value
+
+    def version(self, identifier):
+        """
+        Return the local version of a data object, to be passed to `put` for
+        values queried from this point on.
+        """
+        return self._versions.get(identifier, 0)
+
+    def missing(self, identifier, names):
+        """Return the attribute names that are not cached."""
+        values = self._values.get(identifier, {})
+        version = self._versions.get(identifier, 0)
+
+        return [name for name in names
+                if name not in values
+                or (name not in IMMUTABLE_ATTRIBUTES
+                    and values[name][0] != version)]
+
+    def put(self, identifier, name, value, version):
+        """
+        Cache an attribute value queried at the given local version. The
+        value is dropped if a change event arrived since.
+        """
+        if self._versions.get(identifier, 0) == version:
+            self._values.setdefault(identifier, {})[name] = (version, value)
+
+    def clear(self):
+        self._values.clear()
+
+
+cache = AttributeCache(subscriber)
+
+
+def _decode_attribute(data_attr):
+    # Arrays are sent as raw buffers, everything else is jsonpickled
+    if isinstance(data_attr, msgpack.ExtType) \
+            and data_attr.code == ARRAY_EXT_CODE:
+        return unpack_array(data_attr)
+
+    return jsonpickle.decode(data_attr)
+
+
+def _query_attribute(identifier, name):
+    return _decode_attribute(
+        subscriber.client.query_data_attribute(identifier, name, True))
+
+
+def prefetch(spectra, names):
+    """
+    Query the given attributes of several remote spectra in a single call
+    and store them in the attribute cache.
+
+    Parameters
+    ----------
+    spectra : list of `Spectrum1D`
+        The spectra to prefetch.
+    names : list of str
+        The attribute names to prefetch.
+    """
+    requests, versions = [], []
+
+    for spectrum in spectra:
+        identifier = spectrum._identifier
+        missing = cache.missing(identifier, names)
+
+        if missing:
+            requests.append((identifier, missing))
+            versions.append(cache.version(identifier))
+
+    if not requests:
+        return
+
+    results = subscriber.client.query_batch(requests, True)
+
+    for (identifier, _), version, result in zip(requests, versions, results):
+        for name, data_attr in result.items():
+            cache.put(identifier, name, _decode_attribute(data_attr), version)
+
 
 class Spectrum1D:
     """
@@ -19,7 +156,8 @@ class Spectrum1D:
             {'args': packed_data_args, 'kwargs': packed_data_kwargs})
 
     def __getattribute__(self, name):
-        data_attr = subscriber.client.query_data_attribute(self._identifier, name)
-        data_attr = jsonpickle.decode(data_attr)
+        # Private attributes live on the proxy itself
+        if name.startswith('_'):
+            return object.__getattribute__(self, name)
 
-        return data_attr
\ No newline at end of file
+        return cache.get(self._identifier, name, _query_attribute)
@@ -1,8 +1,120 @@
 import logging
+import os
+import threading
+from collections import OrderedDict
 from functools import wraps
 
 from astropy.io import registry as io_registry
 
+__all__ = ['data_loader', 'custom_writer', 'identify_format',
+           'loader_formats']
+
+# Number of file identification results kept
+IDENTIFY_CACHE_SIZE = 4096
+
+# Identified formats keyed by file path, size and modification time
+_identified = OrderedDict()
+_identified_lock = threading.Lock()
+
+# Memoized table of loader formats, with the registry state it was built at
+_formats = None
+
+
+def _registry_state():
+    """
+    Return a value that changes when readers, writers or identifiers are
+    registered, so that cached results are not reused.
+    """
+    return (len(io_registry._readers), len(io_registry._writers),
+            len(io_registry._identifiers))
+
+
+def _open_shared(path):
+    """
+    Open a file once for all identifier functions. FITS files are parsed into
+    an `~astropy.io.fits.HDUList`, so that their headers are read once rather
+    than by each identifier, and other files are opened in binary mode.
+    """
+    from astropy.io import fits
+
+    fileobj = open(path, 'rb')
+
+    if fileobj.read(6) != b'SIMPLE':
+        fileobj.seek(0)
+        return fileobj, fileobj
+
+    fileobj.seek(0)
+
+    try:
+        return fileobj, fits.open(fileobj)
+    except Exception:
+        fileobj.seek(0)
+        return fileobj, fileobj
+
+
+def identify_format(path):
+    """
+    Return the formats whose identifier functions accept a file. Results are
+    cached by path, size and modification time, and the file is opened and
+    its headers parsed once for all identifier functions.
+
+    Parameters
+    ----------
+    path : str
+        Path of the data file.
+
+    Returns
+    -------
+    : list
+        The names of the matching formats.
+    """
+    from .data import Data
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns, _registry_state())
+
+    with _identified_lock:
+        if key in _identified:
+            _identified.move_to_end(key)
+            return list(_identified[key])
+
+    fileobj, shared = _open_shared(path)
+
+    try:
+        formats = io_registry.identify_format(
+            'read', Data, path, fileobj, (shared,), {})
+    finally:
+        if shared is not fileobj:
+            shared.close()
+
+        fileobj.close()
+
+    with _identified_lock:
+        _identified[key] = tuple(formats)
+
+        while len(_identified) > IDENTIFY_CACHE_SIZE:
+            _identified.popitem(last=False)
+
+    return formats
+
+
+def loader_formats():
+    """
+    Return the names of the formats that data can be read from. The table of
+    formats is built once and rebuilt when the registry changes.
+    """
+    global _formats
+
+    from specutils import Spectrum1D
+
+    state = _registry_state()
+
+    if _formats is None or _formats[0] != state:
+        _formats = (state, list(io_registry.get_formats(Spectrum1D)['Format']))
+
+    return list(_formats[1])
+
 
 def data_loader(label, identifier=None):
     """
@@ -0,0 +1,136 @@
+"""Contains the loader reading data files off the server loop."""
+import logging
+import os
+
+import gevent
+from gevent.pool import Pool
+
+__all__ = ['Loader', 'loader']
+
+# Number of files read at once when reading in the gevent thread pool
+THREAD_CONCURRENCY = 8
+
+
+def _read_file(path, format=None):
+    """
+    Read a data file with the readers of the astropy io registry and return
+    the arguments needed to rebuild it as a data object. Runs in a worker
+    thread or process, so the data object read is not registered with the
+    store.
+    """
+    from astropy.io import registry as io_registry
+
+    from .data import Data
+    from .io import identify_format
+    from .mixins import deferred_registration
+
+    # Identify the format with the cached, shared header identification
+    # rather than letting the registry open the file for every identifier
+    if format is None:
+        formats = identify_format(path)
+
+        if len(formats) != 1:
+            raise io_registry.IORegistryError(
+                "Format of {} could not be identified, it matches: "
+                "{}".format(path, ', '.join(formats) or 'no format'))
+
+        format = formats[0]
+
+    with deferred_registration():
+        spectrum = io_registry.read(Data, path, format=format)
+
+    return {'flux': spectrum.flux,
+            'spectral_axis': spectrum.spectral_axis,
+            'uncertainty': spectrum.uncertainty,
+            'mask': spectrum.mask,
+            'meta': dict(spectrum.meta),
+            'name': getattr(spectrum, 'name', None)
+            or os.path.basename(path)}
+
+
+def _list_files(path):
+    """Return the files to load for a file or directory path."""
+    if not os.path.isdir(path):
+        return [path]
+
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if not name.startswith('.')
+            and os.path.isfile(os.path.join(path, name))]
+
+
+class Loader:
+    """
+    Reads data files without blocking the server. Files are parsed in the
+    worker processes of the operation executor when it is enabled, and in the
+    gevent thread pool otherwise, while data objects are only created and
+    registered on the server loop.
+    """
+    def _read(self, path, format=None):
+        from .operations.executor import executor
+
+        threadpool = gevent.get_hub().threadpool
+
+        if executor.enabled:
+            future = executor.pool.submit(_read_file, path, format)
+
+            return threadpool.apply(future.result)
+
+        return threadpool.apply(_read_file, (path, format))
+
+    def load(self, path, format=None, callback=None):
+        """
+        Load a data file, or every file of a directory in parallel, into the
+        store.
+
+        Parameters
+        ----------
+        path : str
+            Path of a data file or of a directory of data files.
+        format : str, optional
+            Format of the files in the astropy io registry. By default, the
+            format is identified from each file.
+        callback : callable, optional
+            Called on the server loop after each file is read, as
+            ``callback(path, identifier, error, n_done, n_files)``. The
+            `identifier` is `None` and `error` holds the error message if
+            the file could not be read.
+
+        Returns
+        -------
+        : dict
+            The identifiers of the `loaded` data objects, and the error
+            messages of the `failed` files by path.
+        """
+        from .data import Data
+        from .operations.executor import executor
+
+        paths = _list_files(path)
+        loaded, failed = [], {}
+
+        def load_file(file_path):
+            identifier, error = None, None
+
+            try:
+                data = Data(**self._read(file_path, format))
+                identifier = data.identifier
+                loaded.append(identifier)
+            except Exception as e:
+                logging.error("Failed to load %s: %s", file_path, e)
+                error = failed[file_path] = str(e)
+
+            if callback is not None:
+                callback(file_path, identifier, error,
+                         len(loaded) + len(failed), len(paths))
+
+        pool = Pool(executor._max_workers if executor.enabled
+                    else THREAD_CONCURRENCY)
+        pool.map(load_file, paths)
+
+        logging.info("Loaded %d of %d files from %s.",
+                     len(loaded), len(paths), path)
+
+        return {'loaded': loaded, 'failed': failed}
+
+
+# Initialize the data loader
+loader = Loader()
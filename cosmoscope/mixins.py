@@ -1,6 +1,36 @@
 """Registries used in package."""
+import os
+import threading
 import uuid
-from .store import Store
+from contextlib import contextmanager
+
+# Per-thread state of the store registration
+_registration = threading.local()
+
+
+@contextmanager
+def deferred_registration():
+    """
+    Create instances of classes using `StoreRegistry` without registering
+    them with the store, e.g. when reading files in worker threads.
+    """
+    _registration.deferred = True
+
+    try:
+        yield
+    finally:
+        _registration.deferred = False
+
+
+def new_identifiers(count):
+    """
+    Return `count` new unique identifiers, like those assigned by
+    `StoreRegistry`, generating the random bits of all of them at once.
+    """
+    random = os.urandom(16 * count)
+
+    return [str(uuid.UUID(bytes=random[i:i + 16], version=4))
+            for i in range(0, 16 * count, 16)]
 
 
 class StoreRegistry(type):
@@ -10,13 +40,16 @@ class StoreRegistry(type):
     """
     def __call__(cls, *args, **kwargs):
         # Import in the call function to avoid circular imports
-        # from .store import store
+        from .store import store
 
         instance = super(StoreRegistry, cls).__call__(*args, **kwargs)
 
         # Assign the instance a unique identifier
         instance._identifier = str(uuid.uuid4())
 
+        if getattr(_registration, 'deferred', False):
+            return instance
+
         store.register(instance)
 
         return instance
@@ -0,0 +1,36 @@
+import numpy as np
+
+from .operation import reversible_operation
+
+__all__ = ['scale_data', 'clip_data']
+
+
+@reversible_operation("Scale", elementwise=True, cache=True)
+def scale_data(data, factor, context, offset=0.):
+    """
+    Multiply data by a factor and add an offset.
+    """
+    context['old_data'] = data
+
+    return np.asarray(data) * factor + offset
+
+
+@scale_data.register_undo
+def unscale_data(context):
+    return context['old_data']
+
+
+@reversible_operation("Clip", elementwise=True, cache=True)
+def clip_data(data, lower, upper, context):
+    """
+    Limit data to the interval between `lower` and `upper`. Either bound may
+    be `None`.
+    """
+    context['old_data'] = data
+
+    return np.clip(data, lower, upper)
+
+
+@clip_data.register_undo
+def unclip_data(context):
+    return context['old_data']
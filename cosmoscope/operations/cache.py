@@ -0,0 +1,316 @@
+"""Contains the content-addressed cache of operation results."""
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+from astropy.units import UnitBase
+
+__all__ = ['ResultCache', 'result_cache', 'CACHE_PATH']
+
+CACHE_PATH = os.path.join(os.path.expanduser("~/.cosmoscope"), "cache")
+
+# Default maximum number of bytes of results held in memory
+MEMORY_BUDGET = 2 ** 28
+
+# Default maximum number of bytes of results written to disk
+DISK_BUDGET = 2 ** 32
+
+
+# Scalar types hashed by their representation
+_SCALARS = (type(None), bool, int, float, complex, str, bytes, np.generic)
+
+
+def _numeric_array(values):
+    """
+    Return a sequence of numbers as an array, or `None` if it holds anything
+    else, so that long sequences are hashed at once.
+    """
+    if not values or not all(isinstance(x, (bool, int, float, complex,
+                                            np.number, np.bool_))
+                             for x in values):
+        return None
+
+    array = np.array(values)
+
+    return None if array.dtype.hasobject else array
+
+
+def _token(value, digest):
+    """
+    Feed a stable representation of an argument value into a hash. Data
+    objects are identified by their identifier and version, arrays and
+    sequences of numbers by their bytes.
+
+    Raises
+    ------
+    TypeError
+        If the value has no stable representation.
+    """
+    # Astropy kernels are identified by their array
+    value = getattr(value, 'array', value)
+
+    if isinstance(value, np.ndarray):
+        unit = getattr(value, 'unit', None)
+        value = np.ascontiguousarray(getattr(value, 'value', value))
+
+        if value.dtype.hasobject:
+            raise TypeError("Object arrays can not be hashed.")
+
+        digest.update('{}{}{}'.format(value.dtype.str, value.shape,
+                                      unit).encode())
+        digest.update(value.view(np.uint8).reshape(-1))
+    elif hasattr(value, 'identifier') and hasattr(value, 'version'):
+        # Data objects and catalogues change version whenever they change
+        digest.update('{}{}{}'.format(type(value).__name__, value.identifier,
+                                      value.version).encode())
+    elif isinstance(value, dict):
+        digest.update('dict{}'.format(len(value)).encode())
+
+        for key in sorted(value):
+            digest.update(repr(key).encode())
+            _token(value[key], digest)
+    elif isinstance(value, (list, tuple)):
+        digest.update('{}{}'.format(type(value).__name__, len(value)).encode())
+        array = _numeric_array(value)
+
+        if array is not None:
+            _token(array, digest)
+        else:
+            for item in value:
+                _token(item, digest)
+    elif isinstance(value, UnitBase):
+        digest.update('unit{}'.format(value.to_string()).encode())
+    elif isinstance(value, _SCALARS):
+        digest.update('{}{!r}'.format(type(value).__name__, value).encode())
+    else:
+        raise TypeError("Values of type {} can not be hashed.".format(
+            type(value).__name__))
+
+
+def content_key(*values, parent=None):
+    """
+    Return a hash of the content of the given values. Arrays are hashed by
+    their bytes, so equal arrays give equal keys whatever object holds them.
+
+    Raises
+    ------
+    TypeError
+        If a value has no stable representation.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+
+    if parent is not None:
+        digest.update(parent.encode())
+
+    _token(values, digest)
+
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Cache of operation results keyed by a hash of the operation and the
+    content of its arguments. Results are kept in a least recently used
+    memory tier and, if a `path` is set, written to an on-disk tier that
+    outlives the server.
+
+    Cached arrays are read-only copies, as they are shared by every later
+    caller that receives them.
+
+    Parameters
+    ----------
+    memory_budget : int
+        Maximum number of bytes of results held in memory.
+    path : str, optional
+        Directory of the on-disk tier. If `None`, results are only cached in
+        memory.
+    disk_budget : int
+        Maximum number of bytes of results written to disk.
+    """
+    def __init__(self, memory_budget=MEMORY_BUDGET, path=None,
+                 disk_budget=DISK_BUDGET):
+        self.memory_budget = memory_budget
+        self.path = path
+        self.disk_budget = disk_budget
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0,
+                      'evictions': 0, 'memory_bytes': 0, 'disk_bytes': 0}
+        self._entries = OrderedDict()
+        # Size of each result file of the disk tier, oldest written first,
+        # listed the first time a result is written to the current path
+        self._files = None
+        self._files_path = None
+
+    @property
+    def enabled(self):
+        return bool(self.memory_budget) or self.path is not None
+
+    def key(self, operation, args, kwargs):
+        """
+        Return the cache key of an operation invoked with arguments, or
+        `None` if an argument can not be hashed.
+        """
+        function = operation._function
+
+        try:
+            return content_key('{}.{}'.format(function.__module__,
+                                              function.__name__),
+                               args, kwargs)
+        except TypeError:
+            logging.debug("Result of %s is not cached.", operation.name,
+                          exc_info=True)
+            return None
+
+    def get(self, key, args):
+        """
+        Return the cached result and context for a key, or `None`. Context
+        values that were call arguments are taken from `args`.
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            result, context = self._entries[key]
+        else:
+            entry = self._read(key)
+
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            self.stats['disk_hits'] += 1
+            self._remember(key, *entry)
+            result, context = entry
+
+        context = {name: args[value] if isinstance(value, int) else value
+                   for name, value in context.items()}
+
+        return result, context
+
+    def put(self, key, result, context, args):
+        """
+        Cache the result and context of an operation. Only array results are
+        cached, and only if every context value is an array or one of the
+        call arguments.
+        """
+        if not isinstance(result, np.ndarray) or result.dtype.hasobject:
+            return
+
+        # Context values that are call arguments are stored by their index
+        references = {}
+
+        for name, value in context.items():
+            for index, arg in enumerate(args):
+                if value is arg:
+                    references[name] = index
+                    break
+            else:
+                if not isinstance(value, np.ndarray):
+                    return
+
+                references[name] = value
+
+        # The caller keeps its own, writable, result
+        self._remember(key, result.copy() if self.memory_budget else result,
+                       references)
+        self._write(key, result, references)
+
+    def _remember(self, key, result, context):
+        if not self.memory_budget:
+            return
+
+        result.setflags(write=False)
+
+        self._entries[key] = (result, context)
+        self.stats['memory_bytes'] += self._nbytes(result, context)
+
+        while self.stats['memory_bytes'] > self.memory_budget \
+                and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.stats['memory_bytes'] -= self._nbytes(*evicted)
+            self.stats['evictions'] += 1
+
+    @staticmethod
+    def _nbytes(result, context):
+        return result.nbytes + sum(value.nbytes for value in context.values()
+                                   if isinstance(value, np.ndarray))
+
+    def _file_path(self, key):
+        return os.path.join(self.path, '{}.npz'.format(key))
+
+    def _write(self, key, result, context):
+        if self.path is None or os.path.exists(self._file_path(key)):
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        files = self._disk_files()
+
+        arrays = {'context_' + name: value for name, value in context.items()
+                  if isinstance(value, np.ndarray)}
+        references = {name: value for name, value in context.items()
+                      if isinstance(value, int)}
+
+        try:
+            np.savez(self._file_path(key), result=result,
+                     references=np.array(json.dumps(references)), **arrays)
+        except OSError:
+            logging.exception("Failed to write result to disk cache.")
+            return
+
+        files[self._file_path(key)] = os.path.getsize(self._file_path(key))
+        self.stats['disk_bytes'] += files[self._file_path(key)]
+        self._trim_disk()
+
+    def _read(self, key):
+        if self.path is None or not os.path.exists(self._file_path(key)):
+            return None
+
+        with np.load(self._file_path(key), allow_pickle=False) as arrays:
+            context = json.loads(str(arrays['references']))
+            context.update({name[len('context_'):]: arrays[name]
+                            for name in arrays.files
+                            if name.startswith('context_')})
+
+            return arrays['result'], context
+
+    def _disk_files(self):
+        """
+        Return the size of each result file of the disk tier, oldest written
+        first. The directory is only listed once per path, and the sizes are
+        kept up to date as results are written and removed.
+        """
+        if self._files is None or self._files_path != self.path:
+            files = [os.path.join(self.path, name)
+                     for name in os.listdir(self.path)
+                     if name.endswith('.npz')]
+            files.sort(key=os.path.getmtime)
+
+            self._files = OrderedDict(
+                (file_path, os.path.getsize(file_path)) for file_path in files)
+            self._files_path = self.path
+            self.stats['disk_bytes'] = sum(self._files.values())
+
+        return self._files
+
+    def _trim_disk(self):
+        """Remove the least recently written results over the disk budget."""
+        files = self._disk_files()
+
+        while self.stats['disk_bytes'] > self.disk_budget and len(files) > 1:
+            file_path, size = files.popitem(last=False)
+            self.stats['disk_bytes'] -= size
+
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """Drop the results held in memory."""
+        self._entries.clear()
+        self.stats['memory_bytes'] = 0
+
+
+# Initialize the operation result cache
+result_cache = ResultCache()
@@ -0,0 +1,403 @@
+"""Contains the coaddition of many data objects into one."""
+import tempfile
+from collections import deque
+
+import gevent
+import numpy as np
+
+from .operation import reversible_operation
+from .resample import _resampling_weights
+
+__all__ = ['coadd_data', 'COADD_METHODS']
+
+COADD_METHODS = ('mean', 'clipped_mean', 'median')
+
+# Number of data objects reduced at once by a worker thread
+COADD_CHUNK_SIZE = 64
+
+# Maximum number of bytes of values held at once to compute medians, shared
+# by the blocks of the spectral axis computed concurrently
+MEDIAN_BUDGET = 2 ** 27
+
+
+class _Input:
+    """
+    Values of a data object to coadd, converted to the flux unit and
+    resampled onto the spectral axis of the coadd on demand. The arrays are
+    copied, as worker threads read them while the store may update the data
+    object in place.
+    """
+    __slots__ = ('flux', 'sigma', 'mask', 'scale', 'resampling')
+
+    def __init__(self, data, grid, unit, weighted):
+        from astropy.nddata import StdDevUncertainty
+        from astropy.units import spectral
+
+        if weighted and data.uncertainty is None:
+            raise ValueError("Data object {} has no uncertainty to weight "
+                             "by.".format(data.identifier))
+
+        uncertainty = data.uncertainty
+
+        # Conversions are skipped for the usual case of data objects with
+        # standard deviations and shared units, as they would otherwise
+        # dominate the time spent per data object
+        if uncertainty is not None \
+                and not isinstance(uncertainty, StdDevUncertainty):
+            uncertainty = uncertainty.represent_as(StdDevUncertainty)
+
+        self.flux = np.array(data.flux.value)
+        self.sigma = np.array(uncertainty.array) \
+            if uncertainty is not None else None
+        self.mask = np.array(data.mask) if data.mask is not None else None
+        self.scale = 1 if data.flux.unit == unit \
+            else data.flux.unit.to(unit)
+
+        source = data.spectral_axis.value \
+            if data.spectral_axis.unit == grid.unit \
+            else data.spectral_axis.to_value(grid.unit,
+                                             equivalencies=spectral())
+        self.resampling = None if np.array_equal(source, grid.value) \
+            else _resampling_weights(source, grid.value, 'linear')
+
+    def values(self):
+        """
+        Return the flux, uncertainty and mask on the spectral axis of the
+        coadd. Values outside of the data object are NaN.
+        """
+        if self.resampling is None:
+            flux, sigma, mask = self.flux, self.sigma, self.mask
+        else:
+            flux = self.resampling.apply(self.flux)
+            sigma, mask = self.resampling.propagate(self.sigma, self.mask)
+
+        if self.scale != 1:
+            flux = flux * self.scale
+            sigma = sigma * self.scale if sigma is not None else None
+
+        return flux, sigma, mask
+
+
+def _weights(flux, sigma, mask, weighted):
+    """
+    Return the weight of each value, inverse variances if `weighted`, with
+    masked and non-finite values given a weight of zero.
+    """
+    valid = np.isfinite(flux)
+
+    if mask is not None:
+        valid &= ~np.asarray(mask, dtype=bool)
+
+    if not weighted:
+        return valid.astype(float)
+
+    with np.errstate(divide='ignore'):
+        weights = 1 / np.asarray(sigma, dtype=float) ** 2
+
+    return np.where(valid & np.isfinite(weights), weights, 0.)
+
+
+class _Accumulator:
+    """
+    Running weighted mean, sum of squared deviations and propagated variance
+    of each value of a spectrum. Accumulators of separate chunks of spectra
+    are merged with the pairwise update of Chan et al., so chunks can be
+    reduced in any order.
+    """
+    def __init__(self, size):
+        self.weight = np.zeros(size)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+        self.count = np.zeros(size, dtype=np.int64)
+        # Sum of the squared weighted uncertainties, and number of values
+        # with an uncertainty
+        self.variance = np.zeros(size)
+        self.uncertain = np.zeros(size, dtype=np.int64)
+
+    @classmethod
+    def reduce(cls, values, sigmas, weights):
+        """
+        Return the accumulator of a stack of spectra, ignoring values with a
+        weight of zero.
+        """
+        accumulator = cls(values.shape[1])
+        values = np.where(weights > 0, values, 0.)
+
+        accumulator.weight = weights.sum(axis=0)
+        accumulator.count = np.count_nonzero(weights, axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            accumulator.mean = np.where(
+                accumulator.weight > 0,
+                (weights * values).sum(axis=0) / accumulator.weight, 0.)
+
+        accumulator.m2 = (weights * (values - accumulator.mean) ** 2).sum(
+            axis=0)
+
+        uncertain = (weights > 0) & np.isfinite(sigmas)
+        accumulator.variance = np.where(
+            uncertain, (weights * sigmas) ** 2, 0.).sum(axis=0)
+        accumulator.uncertain = np.count_nonzero(uncertain, axis=0)
+
+        return accumulator
+
+    def merge(self, other):
+        weight = self.weight + other.weight
+        delta = other.mean - self.mean
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(weight > 0, other.weight / weight, 0.)
+
+        self.mean += delta * fraction
+        self.m2 += other.m2 + delta ** 2 * self.weight * fraction
+        self.weight = weight
+        self.count += other.count
+        self.variance += other.variance
+        self.uncertain += other.uncertain
+
+    @property
+    def spread(self):
+        """Weighted standard deviation of the values."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.m2 / self.weight)
+
+    def result(self):
+        """
+        Return the mean, its uncertainty and the mask of values without any
+        input. The uncertainty is propagated from the input uncertainties
+        where all inputs have one, and the standard error of the mean is used
+        otherwise.
+        """
+        mask = self.count == 0
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            propagated = np.sqrt(self.variance) / self.weight
+            scatter = np.sqrt(self.m2 / self.weight / (self.count - 1))
+
+        uncertainty = np.where(self.uncertain == self.count, propagated,
+                               np.where(self.count > 1, scatter, np.nan))
+
+        return (np.where(mask, np.nan, self.mean),
+                np.where(mask, np.nan, uncertainty), mask)
+
+
+def _map_chunks(function, chunks, *args):
+    """
+    Call ``function(chunk, *args)`` for each chunk in the gevent thread pool,
+    where numpy releases the GIL, and yield the results in order. Chunks are
+    only taken once a thread is free, so the number of chunks in memory is
+    bounded by the size of the pool.
+    """
+    threadpool = gevent.get_hub().threadpool
+    pending = deque()
+
+    for chunk in chunks:
+        pending.append(threadpool.spawn(function, chunk, *args))
+
+        if len(pending) >= threadpool.maxsize:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def _chunks(identifiers, grid, unit, weighted):
+    """
+    Read the data objects to coadd from the store, one chunk at a time,
+    applying their pending lazy operations first.
+    """
+    from .graph import materialized_data
+
+    for start in range(0, len(identifiers), COADD_CHUNK_SIZE):
+        yield [_Input(materialized_data(identifier), grid, unit, weighted)
+               for identifier in identifiers[start:start + COADD_CHUNK_SIZE]]
+
+
+def _reduce_chunk(inputs, size, weighted, center=None, limit=None):
+    """
+    Reduce a chunk of inputs to an accumulator, ignoring values further than
+    `limit` from `center` if given.
+    """
+    values, sigmas, weights = (np.empty((len(inputs), size))
+                               for _ in range(3))
+
+    for row, item in enumerate(inputs):
+        flux, sigma, mask = item.values()
+        values[row] = flux
+        sigmas[row] = sigma if sigma is not None else np.nan
+        weights[row] = _weights(flux, sigma, mask, weighted)
+
+    if center is not None:
+        with np.errstate(invalid='ignore'):
+            weights[np.abs(values - center) > limit] = 0
+
+    return _Accumulator.reduce(values, sigmas, weights)
+
+
+def _accumulate(identifiers, grid, unit, weighted, center=None, limit=None):
+    total = _Accumulator(len(grid))
+
+    for accumulator in _map_chunks(
+            _reduce_chunk, _chunks(identifiers, grid, unit, weighted),
+            len(grid), weighted, center, limit):
+        total.merge(accumulator)
+
+    return total
+
+
+def _gather_chunk(inputs, size):
+    """
+    Return the values of a chunk of inputs on the spectral axis of the
+    coadd, with masked and non-finite values set to NaN.
+    """
+    values = np.empty((len(inputs), size))
+
+    for row, item in enumerate(inputs):
+        flux, sigma, mask = item.values()
+        values[row] = np.where(_weights(flux, sigma, mask, False) > 0, flux,
+                               np.nan)
+
+    return values
+
+
+def _median_block(block, spilled):
+    """
+    Return the median, its uncertainty and the mask of a range of the
+    spectral axis, reading the values of all inputs in that range.
+    """
+    start, stop = block
+    values = np.array(spilled[:, start:stop])
+
+    count = np.count_nonzero(~np.isnan(values), axis=0)
+    mask = count == 0
+    values[:, mask] = 0
+
+    median = np.nanmedian(values, axis=0)
+
+    # The standard error of the median of normal values is sqrt(pi / 2)
+    # times the standard error of the mean
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(values, axis=0) / count
+        variance = np.nansum((values - mean) ** 2, axis=0) / (count - 1)
+        uncertainty = np.sqrt(np.pi / 2 * variance / count)
+
+    uncertainty[count < 2] = np.nan
+    median[mask] = np.nan
+
+    return median, uncertainty, mask
+
+
+def _median(identifiers, grid, unit):
+    """
+    Return the median, its uncertainty and the mask of the data objects.
+    The values of the data objects are streamed to a temporary file, which
+    is then read back in blocks of the spectral axis, so that only the
+    values of the blocks computed concurrently are held in memory.
+    """
+    concurrency = gevent.get_hub().threadpool.maxsize
+
+    with tempfile.TemporaryFile() as f:
+        spilled = np.memmap(f, dtype=float, mode='w+',
+                            shape=(len(identifiers), len(grid)))
+        row = 0
+
+        for values in _map_chunks(_gather_chunk,
+                                  _chunks(identifiers, grid, unit, False),
+                                  len(grid)):
+            spilled[row:row + len(values)] = values
+            row += len(values)
+
+        width = max(MEDIAN_BUDGET // (8 * len(identifiers) * concurrency), 1)
+        blocks = [(start, min(start + width, len(grid)))
+                  for start in range(0, len(grid), width)]
+
+        result = [np.concatenate(arrays) for arrays in zip(
+            *_map_chunks(_median_block, blocks, spilled))]
+
+        del spilled
+
+    return result
+
+
+@reversible_operation("Coadd")
+def coadd_data(identifiers, context, method='mean', weighted=True, sigma=3.,
+               iterations=5, name=None):
+    """
+    Coadd data objects in the store into a new data object, on the spectral
+    axis and in the flux unit of the first one. Data objects are streamed
+    from the store in chunks reduced in parallel, so memory use does not grow
+    with their number, and their pending lazy operations are applied first.
+    Masked and non-finite values are ignored, and data objects on another
+    spectral axis are resampled linearly.
+
+    Parameters
+    ----------
+    identifiers : list of str
+        The data objects to coadd.
+    method : str
+        ``mean``, ``clipped_mean``, iteratively rejecting values further than
+        `sigma` standard deviations from the mean, or ``median``.
+    weighted : bool
+        Whether means are weighted by inverse variance, in which case all
+        data objects must have uncertainties. Medians are not weighted.
+    sigma : float
+        Rejection threshold of ``clipped_mean``.
+    iterations : int
+        Maximum number of rejection passes of ``clipped_mean``.
+    name : str, optional
+        Name of the new data object.
+    """
+    from astropy.nddata import StdDevUncertainty
+    from astropy.units import Quantity
+
+    from ..data import Data
+    from .graph import materialized_data
+
+    if method not in COADD_METHODS:
+        raise ValueError("Unknown coadd method '{}', expected one of "
+                         "{}.".format(method, ', '.join(COADD_METHODS)))
+
+    identifiers = list(identifiers)
+
+    if not identifiers:
+        raise ValueError("No data objects to coadd.")
+
+    reference = materialized_data(identifiers[0])
+    grid = Quantity(reference.spectral_axis)
+    unit = reference.flux.unit
+
+    if method == 'median':
+        flux, uncertainty, mask = _median(identifiers, grid, unit)
+    else:
+        total = _accumulate(identifiers, grid, unit, weighted)
+
+        # Each rejection pass streams the data objects again, rejecting
+        # values relative to the mean and spread of the previous pass
+        for _ in range(iterations if method == 'clipped_mean' else 0):
+            clipped = _accumulate(identifiers, grid, unit, weighted,
+                                  center=total.mean,
+                                  limit=sigma * total.spread)
+            converged = np.array_equal(clipped.count, total.count)
+            total = clipped
+
+            if converged:
+                break
+
+        flux, uncertainty, mask = total.result()
+
+    data = Data(Quantity(flux, unit), spectral_axis=grid,
+                uncertainty=StdDevUncertainty(uncertainty), mask=mask,
+                name=name or 'Coadd of {} spectra'.format(len(identifiers)))
+
+    context['identifier'] = data.identifier
+
+    return data.identifier
+
+
+@coadd_data.register_undo
+def uncoadd_data(context):
+    from ..store import store
+
+    store.unregister(context['identifier'])
+
+    return context['identifier']
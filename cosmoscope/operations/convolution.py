@@ -0,0 +1,219 @@
+"""Contains convolution routines used by the filter operations."""
+import tempfile
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+__all__ = ['kernel_array', 'fft_convolve', 'direct_convolve',
+           'blockwise_convolve', 'choose_engine', 'convolve', 'ENGINES']
+
+# Kernel size from which the FFT is faster than direct convolution, for
+# arrays of fewer than a number of samples and for larger arrays, as measured
+# by `benchmarks/bench_smooth.py`. The fixed cost of the FFT dominates for
+# short arrays.
+FFT_KERNEL_SIZES = ((10 ** 3, 129), (10 ** 4, 65), (10 ** 5, 49))
+FFT_KERNEL_SIZE = 57
+
+# Number of samples per block when streaming through memory-mapped arrays
+STREAM_BLOCK_SIZE = 2 ** 20
+
+# Number of samples from which memory-mapped arrays are streamed block-wise.
+# Streaming is slower than convolving the whole array at once for the sizes
+# measured by `benchmarks/bench_smooth.py`, so it is kept for arrays too
+# large to comfortably hold in memory with the intermediate results.
+STREAM_THRESHOLD = 2 ** 24
+
+
+def kernel_array(kernel):
+    """
+    Return the normalized array of an astropy kernel or array-like kernel.
+    """
+    array = np.asarray(getattr(kernel, 'array', kernel), dtype=float)
+
+    if array.ndim != 1 or array.shape[0] % 2 == 0:
+        raise ValueError("Kernel must be one-dimensional with an odd size.")
+
+    return array / array.sum()
+
+
+def _fft_length(n):
+    """Return a length no smaller than `n` with only small prime factors."""
+    length = 1
+
+    while length < n:
+        length *= 2
+
+    # A multiple of 3 close to `n` is often much shorter than a power of two
+    three = 3 * 2 ** max(int(np.ceil(np.log2(n / 3.))), 0)
+
+    return min(length, three) if three >= n else length
+
+
+def fft_convolve(array, kernel):
+    """
+    Convolve each row of an array with a kernel using the FFT. The result
+    matches `astropy.convolution.convolve` with its default arguments: the
+    kernel is normalized, values outside the array are filled with zero, and
+    NaN values are interpolated over.
+
+    Parameters
+    ----------
+    array : `~numpy.ndarray`
+        One-dimensional array, or two-dimensional array whose rows are
+        convolved independently.
+    kernel : `~astropy.convolution.Kernel1D` or array-like
+        The convolution kernel, with an odd number of elements.
+
+    Returns
+    -------
+    : `~numpy.ndarray`
+        The convolved array.
+    """
+    kernel = kernel_array(kernel)
+    array = np.asarray(array, dtype=float)
+
+    n_samples, n_kernel = array.shape[-1], kernel.shape[0]
+    offset = n_kernel // 2
+
+    # Long arrays are split into overlapping blocks that are transformed
+    # together (overlap-save), which is cheaper than one very long transform
+    block_size = _fft_length(8 * n_kernel)
+
+    if n_samples > 4 * block_size:
+        n_blocks = -(-n_samples // block_size)
+        padded = np.zeros(array.shape[:-1] + (
+            n_blocks * block_size + 2 * offset,))
+        padded[..., offset:offset + n_samples] = array
+
+        # Values outside the array are zero filled, not NaN
+        windows = sliding_window_view(
+            padded, block_size + 2 * offset, axis=-1)[..., ::block_size, :]
+
+        result = fft_convolve(windows, kernel)[..., offset:offset + block_size]
+
+        return result.reshape(array.shape[:-1] + (-1,))[..., :n_samples]
+
+    length = _fft_length(n_samples + n_kernel - 1)
+
+    kernel_fft = np.fft.rfft(kernel, length)
+
+    def convolve(values):
+        result = np.fft.irfft(np.fft.rfft(values, length) * kernel_fft, length)
+        return result[..., offset:offset + n_samples]
+
+    nans = np.isnan(array)
+
+    if not nans.any():
+        return convolve(array)
+
+    # Interpolate over NaN values by renormalizing with the kernel weight of
+    # the valid values. The zero filled boundary counts as valid.
+    result = convolve(np.where(nans, 0., array))
+    weight = 1. - convolve(nans.astype(float))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result /= weight
+
+    result[np.isclose(weight, 0., atol=1e-10)] = np.nan
+
+    return result
+
+
+def direct_convolve(array, kernel):
+    """
+    Convolve each row of an array with a kernel using direct convolution.
+    See `fft_convolve`.
+    """
+    from astropy.convolution import convolve as astropy_convolve
+
+    kernel = kernel_array(kernel)
+    array = np.asarray(array, dtype=float)
+
+    if array.ndim == 1:
+        return astropy_convolve(array, kernel)
+
+    return np.array([astropy_convolve(row, kernel) for row in array])
+
+
+def blockwise_convolve(array, kernel, block_size=STREAM_BLOCK_SIZE,
+                       out=None):
+    """
+    Convolve a one-dimensional array with a kernel one block at a time, so
+    that only a block of the array is in memory at once. Each block is read
+    with a margin of half the kernel size on either side, so the result is
+    identical to convolving the whole array. See `fft_convolve`.
+
+    Parameters
+    ----------
+    out : `~numpy.ndarray`, optional
+        Array in which to write the result. By default, the result is
+        written to a memory-mapped temporary file that is removed once the
+        array is no longer referenced.
+    """
+    kernel = kernel_array(kernel)
+    n_samples, offset = array.shape[-1], kernel.shape[0] // 2
+
+    if out is None:
+        out = np.memmap(tempfile.TemporaryFile(), dtype=float, mode='w+',
+                        shape=array.shape)
+
+    engine = ENGINES[choose_engine(min(block_size, n_samples),
+                                   kernel.shape[0])]
+
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        block_start = max(start - offset, 0)
+        block_stop = min(stop + offset, n_samples)
+
+        result = engine(array[..., block_start:block_stop], kernel)
+        out[..., start:stop] = result[..., start - block_start:
+                                      stop - block_start]
+
+    return out
+
+
+ENGINES = {'direct': direct_convolve,
+           'fft': fft_convolve,
+           'blockwise': blockwise_convolve}
+
+
+def choose_engine(n_samples, n_kernel, memmapped=False):
+    """
+    Return the name of the fastest convolution engine for an array and kernel
+    of the given sizes. Large memory-mapped arrays are streamed block-wise so
+    they are never loaded in memory at once.
+    """
+    if memmapped and n_samples > STREAM_THRESHOLD:
+        return 'blockwise'
+
+    threshold = next((size for limit, size in FFT_KERNEL_SIZES
+                      if n_samples < limit), FFT_KERNEL_SIZE)
+
+    return 'fft' if n_kernel >= threshold else 'direct'
+
+
+def convolve(array, kernel, engine=None):
+    """
+    Convolve an array with a kernel, with results matching
+    `astropy.convolution.convolve` with its default arguments.
+
+    Parameters
+    ----------
+    array : `~numpy.ndarray`
+        One-dimensional array, or two-dimensional array whose rows are
+        convolved independently.
+    kernel : `~astropy.convolution.Kernel1D` or array-like
+        The convolution kernel, with an odd number of elements.
+    engine : {'direct', 'fft', 'blockwise'}, optional
+        The convolution engine. By default, it is chosen with
+        `choose_engine`.
+    """
+    if engine is None:
+        engine = choose_engine(np.shape(array)[-1],
+                               kernel_array(kernel).shape[0],
+                               memmapped=isinstance(array, np.memmap))
+
+    if engine not in ENGINES:
+        raise ValueError("Unknown convolution engine '{}'.".format(engine))
+
+    return ENGINES[engine](array, kernel)
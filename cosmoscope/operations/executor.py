@@ -0,0 +1,216 @@
+"""Contains the process pool used to run operations off the server loop."""
+import importlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import gevent
+import numpy as np
+from astropy.units import Quantity
+
+__all__ = ['Executor', 'executor']
+
+
+class _SharedArray:
+    """
+    Picklable description of an array held in a shared memory block. Only
+    this description is sent between processes, not the array itself.
+    """
+    def __init__(self, array):
+        from multiprocessing.shared_memory import SharedMemory
+
+        self.unit = array.unit.to_string() \
+            if isinstance(array, Quantity) else None
+
+        array = np.asarray(array)
+
+        self.dtype = array.dtype.str
+        self.shape = array.shape
+        self._memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name = self._memory.name
+
+        np.ndarray(self.shape, dtype=self.dtype,
+                   buffer=self._memory.buf)[...] = array
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k != '_memory'}
+
+    def attach(self, copy=False):
+        """
+        Return the shared array. Unless `copy` is set, the array is a view on
+        the shared memory block, which stays attached for as long as the view
+        is alive.
+        """
+        from multiprocessing.shared_memory import SharedMemory
+
+        memory = SharedMemory(name=self.name)
+        array = np.ndarray(self.shape, dtype=self.dtype, buffer=memory.buf)
+
+        if copy:
+            array = np.array(array)
+            memory.close()
+        else:
+            # Keep the block open as long as the array is referenced
+            array = array.view(_SharedView)
+            array._memory = memory
+
+        if self.unit is not None:
+            return Quantity(array, unit=self.unit, copy=False)
+
+        return array
+
+    def release(self):
+        """Free the shared memory block."""
+        if getattr(self, '_memory', None) is None:
+            from multiprocessing.shared_memory import SharedMemory
+
+            # Blocks created by a worker are released by the server
+            self._memory = SharedMemory(name=self.name)
+
+        self._memory.close()
+        self._memory.unlink()
+        self._memory = None
+
+
+class _SharedView(np.ndarray):
+    """Array view that keeps its shared memory block attached."""
+    def __array_finalize__(self, obj):
+        self._memory = getattr(obj, '_memory', None)
+
+
+class _ArgumentReference:
+    """Placeholder for a context value that is one of the call arguments."""
+    def __init__(self, index):
+        self.index = index
+
+
+def _share(value):
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        return _SharedArray(value)
+
+    return value
+
+
+def _unshare(value, copy=False):
+    if isinstance(value, _SharedArray):
+        return value.attach(copy=copy)
+
+    return value
+
+
+def _run_operation(module_name, name, args, kwargs):
+    """
+    Entry point of the worker processes. Runs the operation with the shared
+    array arguments, and returns the result and context with any arrays moved
+    to new shared memory blocks.
+    """
+    from .operation import FunctionalOperation
+
+    function = getattr(importlib.import_module(module_name), name)
+
+    if isinstance(function, FunctionalOperation):
+        function = function._function
+
+    args = [_unshare(x) for x in args]
+    kwargs = {k: _unshare(v) for k, v in kwargs.items()}
+    context = {}
+
+    result = function(*args, context=context, **kwargs)
+
+    # Arrays in the context that are call arguments are already held by the
+    # server and are not sent back
+    for key, value in context.items():
+        for index, arg in enumerate(args):
+            if value is arg:
+                context[key] = _ArgumentReference(index)
+                break
+        else:
+            context[key] = _share(value)
+
+    return _share(result), context
+
+
+class Executor:
+    """
+    Runs operations in a pool of worker processes so that CPU-bound
+    operations do not block the server. Array arguments and results are
+    passed through shared memory instead of being pickled. The executor is
+    disabled, and operations run inline, until it is configured with a number
+    of workers.
+    """
+    def __init__(self):
+        self._pool = None
+        self._max_workers = None
+
+    @property
+    def enabled(self):
+        return bool(self._max_workers)
+
+    def configure(self, max_workers=None):
+        """
+        Set the number of worker processes. A value of `None` or 0 disables
+        the executor.
+        """
+        self.shutdown()
+        self._max_workers = max_workers
+
+        if self.enabled:
+            logging.info("Running operations in %d worker processes.",
+                         max_workers)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            # Forking is unsafe once the zmq and gevent machinery are running
+            self._pool = ProcessPoolExecutor(
+                max_workers=self._max_workers,
+                mp_context=multiprocessing.get_context('spawn'))
+
+        return self._pool
+
+    def run(self, operation, args, kwargs, context):
+        """
+        Run the function of a `FunctionalOperation` in a worker process and
+        return its result. Other greenlets keep running while waiting on the
+        worker, and `context` is updated with the context set by the function.
+        """
+        function = operation._function
+        shared_args = [_share(x) for x in args]
+        shared_kwargs = {k: _share(v) for k, v in kwargs.items()}
+
+        try:
+            future = self.pool.submit(
+                _run_operation, function.__module__, function.__name__,
+                shared_args, shared_kwargs)
+
+            result, child_context = gevent.get_hub().threadpool.apply(
+                future.result)
+        finally:
+            for value in shared_args + list(shared_kwargs.values()):
+                if isinstance(value, _SharedArray):
+                    value.release()
+
+        for key, value in child_context.items():
+            if isinstance(value, _ArgumentReference):
+                context[key] = args[value.index]
+            else:
+                context[key] = _unshare(value, copy=True)
+
+                if isinstance(value, _SharedArray):
+                    value.release()
+
+        output = _unshare(result, copy=True)
+
+        if isinstance(result, _SharedArray):
+            result.release()
+
+        return output
+
+
+# Initialize the operation executor
+executor = Executor()
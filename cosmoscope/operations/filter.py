@@ -1,13 +1,21 @@
-from ..interfaces.decorators import reversible_operation
+from collections import defaultdict
 
-__all__ = ['smooth_data']
+import numpy as np
 
+from .convolution import convolve, fft_convolve
+from .operation import reversible_operation
 
-@reversible_operation("Apply Smooth")
-def smooth_data(data, kernel, context):
-    from astropy.convolution import convolve
+__all__ = ['smooth_data', 'smooth_data_batch']
 
-    conv_data = convolve(data, kernel)
+
+@reversible_operation("Apply Smooth", parallel=True, cache=True)
+def smooth_data(data, kernel, context, engine=None):
+    """
+    Smooth data with a kernel. Unless an `engine` is given, direct
+    convolution is used for small kernels, FFT convolution for large kernels,
+    and block-wise convolution for large memory-mapped arrays.
+    """
+    conv_data = convolve(data, kernel, engine=engine)
     context['old_data'] = data
 
     return conv_data
@@ -15,6 +23,42 @@ def smooth_data(data, kernel, context):
 
 @smooth_data.register_undo
 def unsmooth_data(context):
-    print("Unsmoothing data")
-
     return context['old_data']
+
+
+@reversible_operation("Apply Smooth to Batch")
+def smooth_data_batch(identifiers, kernel, context):
+    """
+    Smooth the flux of many data objects in the store with the same kernel.
+    Data objects of the same length are stacked and convolved at once with a
+    batched FFT convolution. The whole batch is undone as one operation.
+    """
+    from ..store import store
+
+    # Group the data objects that can be stacked into one array
+    groups = defaultdict(list)
+
+    for identifier in identifiers:
+        groups[store[identifier].data.shape].append(identifier)
+
+    context['old_data'] = {}
+
+    for group in groups.values():
+        stack = np.stack([store[identifier].data for identifier in group])
+        conv_stack = fft_convolve(stack, kernel)
+
+        for identifier, old_data, conv_data in zip(group, stack, conv_stack):
+            context['old_data'][identifier] = old_data
+            store.update(identifier, {'data': conv_data})
+
+    return list(identifiers)
+
+
+@smooth_data_batch.register_undo
+def unsmooth_data_batch(context):
+    from ..store import store
+
+    for identifier, old_data in context['old_data'].items():
+        store.update(identifier, {'data': old_data})
+
+    return list(context['old_data'])
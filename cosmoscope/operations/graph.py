@@ -0,0 +1,343 @@
+"""Contains the lazy operation graph used to defer and fuse operations."""
+import logging
+import os
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from ..utils.memmap import MEMMAP_PATH, release_on_collect, to_memmap
+from .cache import content_key
+from .history import HistoryEntry, histories
+from .operation import Operation
+
+__all__ = ['Node', 'SourceNode', 'Pipeline', 'Graph', 'LazyOperation',
+           'graph', 'materialized_data']
+
+# Number of samples per block when fusing elementwise operations, small
+# enough for the intermediate values of a block to stay in the CPU cache
+FUSED_BLOCK_SIZE = 2 ** 14
+
+# Maximum number of bytes of memoized results
+MEMO_BUDGET = 2 ** 28
+
+
+class SourceNode:
+    """
+    Root of a pipeline, reading the flux of a data object as it was when the
+    pipeline was started. The flux is read from the data object in the
+    store, which the pipeline is dropped for if anything else changes it,
+    and is only copied, to a memory-mapped file, once the pipeline writes a
+    result to the data object.
+    """
+    def __init__(self, identifier, data):
+        self.identifier = identifier
+        self.key = content_key(identifier, data.version)
+        self._array = None
+
+    @property
+    def array(self):
+        from ..store import store
+
+        if self._array is not None:
+            return self._array
+
+        array = store[self.identifier].data.view()
+        array.setflags(write=False)
+
+        return array
+
+    def detach(self, data):
+        """
+        Copy the flux to a memory-mapped file before the data object is
+        changed.
+        """
+        if self._array is not None:
+            return
+
+        path = os.path.join(MEMMAP_PATH, 'lazy',
+                            '{}.npy'.format(uuid.uuid4()))
+
+        self._array = to_memmap(data.data, path)
+        self._array.setflags(write=False)
+        release_on_collect(self, path)
+
+
+class Node:
+    """
+    Deferred application of an operation to the result of a parent node. The
+    key of a node hashes the operation, its arguments and the key of its
+    parent, so equal nodes share their memoized result.
+
+    Parameters
+    ----------
+    operation : `~cosmoscope.operations.operation.FunctionalOperation`
+        The operation, taking the data array as first argument.
+    parent : `Node` or `SourceNode`
+        The node whose result the operation is applied to.
+    args, kwargs
+        The other arguments of the operation.
+    """
+    def __init__(self, operation, parent, args=(), kwargs=None):
+        self.operation = operation
+        self.parent = parent
+        self.args = args
+        self.kwargs = kwargs or {}
+
+        function = operation._function
+        self.key = content_key(
+            '{}.{}'.format(function.__module__, function.__name__),
+            self.args, self.kwargs, parent=parent.key)
+
+    @property
+    def elementwise(self):
+        return self.operation.elementwise
+
+    def apply(self, array):
+        return self.operation._function(array, *self.args, context={},
+                                        **self.kwargs)
+
+
+def _fused(nodes, array):
+    """
+    Apply consecutive elementwise nodes in one pass over the array, one block
+    at a time, so that no full size intermediate array is allocated.
+    """
+    out = None
+
+    for start in range(0, max(array.shape[-1], 1), FUSED_BLOCK_SIZE):
+        block = array[..., start:start + FUSED_BLOCK_SIZE]
+
+        for node in nodes:
+            block = node.apply(block)
+
+        if out is None:
+            out = np.empty(array.shape, dtype=np.result_type(block))
+
+        out[..., start:start + FUSED_BLOCK_SIZE] = block
+
+    return out
+
+
+class Pipeline:
+    """
+    Chain of lazy operations applied to the flux of a data object. The
+    head of the pipeline is moved back on undo, and the undone nodes are
+    kept until another operation is applied, so redoing them reuses their
+    memoized results.
+    """
+    def __init__(self, source):
+        self.nodes = [source]
+        self.position = 0
+        self.materialized = source.key
+
+    @property
+    def head(self):
+        return self.nodes[self.position]
+
+    @property
+    def pending(self):
+        """Whether the head has not been written to the data object yet."""
+        return self.head.key != self.materialized
+
+    def apply(self, operation, args, kwargs):
+        del self.nodes[self.position + 1:]
+
+        self.nodes.append(Node(operation, self.head, args, kwargs))
+        self.position += 1
+
+        return self.head
+
+    def undo(self, key):
+        """
+        Move the head back from the node with the given key, which must be
+        the head, so that undoing never moves back past the operations
+        applied since, e.g. by another client session.
+        """
+        if self.head.key != key:
+            raise ValueError("Lazy operations applied after this one must be "
+                             "undone first.")
+
+        self.position -= 1
+
+
+class Graph:
+    """
+    Graph of lazy operations applied to data objects in the store. Operations
+    are only evaluated when the data object is queried, at which point runs
+    of consecutive elementwise operations are fused into a single pass, and
+    the results are memoized by node key.
+
+    Parameters
+    ----------
+    memo_budget : int
+        Maximum number of bytes of memoized results.
+    """
+    def __init__(self, memo_budget=MEMO_BUDGET):
+        self.memo_budget = memo_budget
+        self.pipelines = {}
+        self.stats = {'hits': 0, 'misses': 0, 'fused': 0}
+        self._memo = OrderedDict()
+        self._memo_bytes = 0
+        self._materializing = False
+
+    def _remember(self, key, array):
+        array.setflags(write=False)
+
+        self._memo[key] = array
+        self._memo_bytes += array.nbytes
+
+        while self._memo_bytes > self.memo_budget and len(self._memo) > 1:
+            _, evicted = self._memo.popitem(last=False)
+            self._memo_bytes -= evicted.nbytes
+
+    def pipeline(self, identifier):
+        """Return the pipeline of a data object, starting it if needed."""
+        from ..store import store
+
+        if identifier not in self.pipelines:
+            self.pipelines[identifier] = Pipeline(
+                SourceNode(identifier, store[identifier]))
+
+        return self.pipelines[identifier]
+
+    def evaluate(self, node):
+        """Return the result of a node, evaluating its ancestors as needed."""
+        # Walk up to the closest node with a known result
+        chain = []
+
+        while isinstance(node, Node) and node.key not in self._memo:
+            chain.append(node)
+            node = node.parent
+
+        if isinstance(node, Node):
+            self._memo.move_to_end(node.key)
+            result = self._memo[node.key]
+            self.stats['hits'] += 1
+        else:
+            result = node.array
+
+        chain.reverse()
+        index = 0
+
+        while index < len(chain):
+            stop = index + 1
+
+            if chain[index].elementwise:
+                while stop < len(chain) and chain[stop].elementwise:
+                    stop += 1
+
+                result = _fused(chain[index:stop], result)
+                self.stats['fused'] += stop - index - 1
+            else:
+                result = np.asarray(chain[index].apply(result))
+
+            self.stats['misses'] += stop - index
+            self._remember(chain[stop - 1].key, result)
+            index = stop
+
+        return result
+
+    def materialize(self, identifier):
+        """
+        Evaluate the pending operations of a data object, if any, and write
+        the result to the data object in the store.
+        """
+        from ..store import store
+
+        pipeline = self.pipelines.get(identifier)
+
+        if pipeline is None or not pipeline.pending:
+            return
+
+        result = self.evaluate(pipeline.head)
+
+        # The source of the pipeline is read from the data object until now
+        pipeline.nodes[0].detach(store[identifier])
+
+        self._materializing = True
+
+        try:
+            store.update(identifier, {'data': result})
+        finally:
+            self._materializing = False
+
+        pipeline.materialized = pipeline.head.key
+
+    def on_change(self, event, identifier, **info):
+        """
+        Store listener that drops the pipeline of a data object once it is
+        removed, or its flux is changed by anything other than the pipeline.
+        """
+        if self._materializing or identifier not in self.pipelines:
+            return
+
+        if event == 'update' and 'data' not in info.get('diff', {}):
+            return
+
+        pipeline = self.pipelines.pop(identifier)
+
+        if pipeline.pending:
+            logging.warning("Discarded pending lazy operations on %s.",
+                            identifier)
+
+
+class LazyOperation(Operation):
+    """
+    Applies an operation lazily to the flux of a data object in the store.
+    The operation is added to the pipeline of the data object and recorded in
+    the operation history, and undoing it moves the head of the pipeline
+    back.
+
+    Parameters
+    ----------
+    operation : `~cosmoscope.operations.operation.FunctionalOperation`
+        The operation, taking the data array as first argument.
+    """
+    def __init__(self, operation):
+        self.operation = operation
+
+    @property
+    def name(self):
+        return self.operation.name
+
+    def __call__(self, identifier, *args, **kwargs):
+        return self.invoke((identifier,) + args, kwargs)
+
+    def invoke(self, args, kwargs, session=None):
+        """
+        Add the operation to the pipeline of the data object given as first
+        argument and return the key of the new node.
+        """
+        identifier, args = args[0], tuple(args[1:])
+
+        node = graph.pipeline(identifier).apply(self.operation, args, kwargs)
+
+        histories.record(HistoryEntry(
+            self, {'identifier': identifier, 'key': node.key},
+            (identifier,) + args, kwargs, session=session,
+            identifier=identifier))
+
+        return node.key
+
+    def undo(self, context):
+        pipeline = graph.pipelines.get(context['identifier'])
+
+        if pipeline is not None:
+            pipeline.undo(context['key'])
+
+
+# Initialize the lazy operation graph
+graph = Graph()
+
+
+def materialized_data(identifier):
+    """
+    Returns a data object from the store, evaluating any pending lazy
+    operations first.
+    """
+    from ..store import store
+
+    graph.materialize(identifier)
+
+    return store[identifier]
@@ -0,0 +1,444 @@
+"""Contains the bounded history of operations used for undo and redo."""
+import itertools
+import logging
+import os
+import uuid
+import zlib
+
+import numpy as np
+
+from ..utils.memmap import release_on_collect
+
+__all__ = ['History', 'HistoryEntry', 'Histories', 'histories',
+           'HISTORY_PATH']
+
+HISTORY_PATH = os.path.join(os.path.expanduser("~/.cosmoscope"), "history")
+
+# Order in which history entries are created, used to reduce the oldest
+# entries of all histories first
+_created = itertools.count()
+
+
+class _ArrayReference:
+    """Placeholder for an array stored separately in a history entry."""
+    def __init__(self, key):
+        self.key = key
+
+
+class _CompressedArray:
+    """
+    Array compressed with zlib after shuffling its bytes, so that the bytes
+    holding e.g. the sign and exponent of floating point values are stored
+    together, which makes them compress much better.
+    """
+    def __init__(self, array):
+        self.dtype = array.dtype.str
+        self.shape = array.shape
+
+        shuffled = np.ascontiguousarray(array).view(np.uint8).reshape(
+            -1, array.dtype.itemsize).T
+        self.payload = zlib.compress(np.ascontiguousarray(shuffled), 1)
+
+    @property
+    def nbytes(self):
+        return len(self.payload)
+
+    def decompress(self):
+        dtype = np.dtype(self.dtype)
+        shuffled = np.frombuffer(zlib.decompress(self.payload),
+                                 dtype=np.uint8).reshape(dtype.itemsize, -1)
+
+        return np.ascontiguousarray(shuffled.T).view(dtype).reshape(
+            self.shape)
+
+
+def _compact(value, arrays):
+    """
+    Replace the arrays in a (nested) value by references, storing each
+    distinct array object once in `arrays`.
+    """
+    # Array subclasses, e.g. quantities, are kept as they are
+    if type(value) is np.ndarray and not value.dtype.hasobject:
+        key = id(value)
+        arrays.setdefault(key, value)
+        return _ArrayReference(key)
+    elif isinstance(value, dict):
+        return {k: _compact(v, arrays) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_compact(x, arrays) for x in value)
+
+    return value
+
+
+def _expand(value, arrays):
+    if isinstance(value, _ArrayReference):
+        return arrays[value.key]
+    elif isinstance(value, dict):
+        return {k: _expand(v, arrays) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_expand(x, arrays) for x in value)
+
+    return value
+
+
+class HistoryEntry:
+    """
+    A single invocation of an operation, holding the context needed to undo
+    it and the arguments needed to redo it. The arrays held by the entry can
+    be compressed or spilled to disk to reduce its memory usage.
+
+    Arrays are kept whole rather than as deltas of the changed index ranges.
+    Operations put plain arrays in their context and return their result to
+    the caller, so the history never sees which data object an array belongs
+    to nor the ranges computed by `~cosmoscope.store.Store.update`. Arrays
+    shared by the context and the arguments are stored once, and unchanged
+    runs of values compress to almost nothing.
+
+    Parameters
+    ----------
+    operation : `~cosmoscope.operations.operation.FunctionalOperation`
+        The operation that was invoked.
+    context : dict
+        The context set by the operation.
+    args, kwargs
+        The arguments the operation was invoked with.
+    session : str, optional
+        The client session that invoked the operation.
+    identifier : str, optional
+        The data object the operation was invoked on.
+    """
+    def __init__(self, operation, context, args=(), kwargs=None,
+                 session=None, identifier=None):
+        self.operation = operation
+        self.session = session
+        self.identifier = identifier
+        self._arrays = {}
+        self._state = _compact((context, args, kwargs or {}), self._arrays)
+        self._path = None
+        self.created = next(_created)
+
+    @property
+    def name(self):
+        return self.operation.name
+
+    @property
+    def nbytes(self):
+        """Return the number of bytes of arrays held in memory."""
+        if self._path is not None:
+            return 0
+
+        return sum(array.nbytes for array in self._arrays.values())
+
+    @property
+    def compressed(self):
+        return all(isinstance(x, _CompressedArray)
+                   for x in self._arrays.values())
+
+    @property
+    def spilled(self):
+        return self._path is not None
+
+    def _load(self):
+        if self._path is not None:
+            with np.load(self._path, allow_pickle=False) as arrays:
+                stored = {int(k): arrays[k] for k in arrays.files}
+        else:
+            stored = self._arrays
+
+        return {key: x.decompress() if isinstance(x, _CompressedArray) else x
+                for key, x in stored.items()}
+
+    @property
+    def context(self):
+        return _expand(self._state[0], self._load())
+
+    def compress(self):
+        """Compress the arrays held in memory where it saves space."""
+        for key, array in self._arrays.items():
+            if isinstance(array, _CompressedArray):
+                continue
+
+            compressed = _CompressedArray(array)
+
+            if compressed.nbytes < array.nbytes:
+                self._arrays[key] = compressed
+
+    def spill(self, path=HISTORY_PATH):
+        """Write the arrays to disk and release them from memory."""
+        if self._path is not None or not self._arrays:
+            return
+
+        os.makedirs(path, exist_ok=True)
+        file_path = os.path.join(path, '{}.npz'.format(uuid.uuid4()))
+
+        np.savez(file_path, **{str(key): array for key, array
+                               in self._load().items()})
+
+        self._path = file_path
+        self._arrays = {}
+        release_on_collect(self, file_path)
+
+    def undo(self):
+        """Undo the operation."""
+        return self.operation.undo(context=self.context)
+
+    def redo(self):
+        """Invoke the operation again with the same arguments."""
+        _, args, kwargs = _expand(self._state, self._load())
+
+        return self.operation.invoke(args, kwargs, session=self.session)
+
+
+def _enforce_budget(entries, budget, spill, remove):
+    """
+    Reduce the bytes held in memory by history entries, given from oldest to
+    newest, to at most `budget`, using progressively cheaper representations
+    of the oldest entries first. The newest entry is always kept as is, and
+    entries are dropped by calling `remove`.
+    """
+    nbytes = sum(entry.nbytes for entry in entries)
+
+    for reduce in ('compress', 'spill', 'drop'):
+        for entry in entries[:-1]:
+            if nbytes <= budget:
+                return
+
+            before = entry.nbytes
+
+            if reduce == 'compress':
+                entry.compress()
+            elif reduce == 'spill' and spill:
+                entry.spill()
+            elif reduce == 'drop' and before > 0:
+                remove(entry)
+                logging.info("Dropped '%s' from the operation history.",
+                             entry.name)
+                nbytes -= before
+                continue
+
+            nbytes -= before - entry.nbytes
+
+
+class History:
+    """
+    Stack of `HistoryEntry` objects with a bounded memory budget. When the
+    entries hold more than `budget` bytes of arrays in memory, the oldest
+    entries are compressed, then spilled to disk if `spill` is set, and
+    otherwise dropped from the history.
+
+    Parameters
+    ----------
+    budget : int, optional
+        Maximum number of bytes held in memory. If `None`, the history is
+        unbounded.
+    spill : bool
+        Whether entries over budget are spilled to disk rather than dropped.
+    """
+    def __init__(self, budget=None, spill=True):
+        self.budget = budget
+        self.spill = spill
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __getitem__(self, index):
+        return self._entries[index]
+
+    @property
+    def nbytes(self):
+        """Return the number of bytes held in memory by all entries."""
+        return sum(entry.nbytes for entry in self._entries)
+
+    def append(self, entry):
+        self._entries.append(entry)
+        self._enforce_budget()
+
+    def pop(self, index=-1):
+        return self._entries.pop(index)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _enforce_budget(self):
+        if self.budget is None:
+            return
+
+        _enforce_budget(list(self._entries), self.budget, self.spill,
+                        self._entries.remove)
+
+    def report(self):
+        """
+        Return the name, bytes held in memory, and storage state of each
+        entry, from oldest to newest.
+        """
+        return [{'name': entry.name,
+                 'nbytes': entry.nbytes,
+                 'compressed': entry.compressed,
+                 'spilled': entry.spilled}
+                for entry in self._entries]
+
+
+class Histories:
+    """
+    Operation histories of each client session, with a separate history for
+    every data object an operation was invoked on. Undoing and redoing in one
+    history never touches the others, so clients working on different data
+    objects do not interfere with each other. The memory budget is shared by
+    all histories, including the entries that can be redone.
+
+    Parameters
+    ----------
+    budget : int, optional
+        Maximum number of bytes held in memory by all histories.
+    spill : bool
+        Whether entries over budget are spilled to disk rather than dropped.
+    """
+    def __init__(self, budget=None, spill=True):
+        self._budget = budget
+        self.spill = spill
+        self._histories = {}
+        self._undone = {}
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @budget.setter
+    def budget(self, value):
+        self._budget = value
+        self._enforce_budget()
+
+    @property
+    def nbytes(self):
+        return sum(history.nbytes for history in self._histories.values()) \
+            + sum(entry.nbytes for undone in self._undone.values()
+                  for entry in undone)
+
+    def _enforce_budget(self):
+        if self._budget is None:
+            return
+
+        entries = [entry for history in self._histories.values()
+                   for entry in history]
+        entries += [entry for undone in self._undone.values()
+                    for entry in undone]
+        entries.sort(key=lambda entry: entry.created)
+
+        _enforce_budget(entries, self._budget, self.spill, self._remove)
+
+    def _remove(self, entry):
+        """Drop an entry from its history, or from its undone entries."""
+        key = (entry.session, entry.identifier)
+        history = self._histories.get(key)
+
+        if history is not None and entry in history:
+            history._entries.remove(entry)
+        else:
+            self._undone[key].remove(entry)
+
+    def get(self, session=None, identifier=None):
+        """
+        Return the history of a client session for a data object. Operations
+        not invoked on a single data object are in the history with an
+        `identifier` of `None`.
+        """
+        key = (session, identifier)
+
+        if key not in self._histories:
+            # The budget is enforced over all histories at once
+            self._histories[key] = History(spill=self.spill)
+
+        return self._histories[key]
+
+    def record(self, entry):
+        """Add an entry to the history of its session and data object."""
+        key = (entry.session, entry.identifier)
+
+        self.get(*key).append(entry)
+
+        # Undone operations can no longer be redone once a new one is made
+        self._undone.pop(key, None)
+
+        self._enforce_budget()
+
+    def pop(self, session=None, identifier=None):
+        """
+        Pop the last entry off a history and return it. The entry can then
+        be redone with `redo`.
+        """
+        key = (session, identifier)
+
+        if not self._histories.get(key):
+            raise IndexError("No operation to undo.")
+
+        entry = self._histories[key].pop()
+        self._undone.setdefault(key, []).append(entry)
+
+        return entry
+
+    def undo(self, session=None, identifier=None):
+        """
+        Undo the last operation of a history. The operation is put back in
+        the history if it can not be undone.
+        """
+        key = (session, identifier)
+        entry = self.pop(session, identifier)
+
+        try:
+            return entry.undo()
+        except Exception:
+            self._undone[key].remove(entry)
+            self._histories[key].append(entry)
+            raise
+
+    def redo(self, session=None, identifier=None):
+        """Invoke the last undone operation of a history again."""
+        key = (session, identifier)
+        undone = self._undone.get(key)
+
+        if not undone:
+            raise IndexError("No operation to redo.")
+
+        entry = undone.pop()
+
+        try:
+            result = entry.redo()
+        except Exception:
+            undone.append(entry)
+            raise
+
+        # Recording the redone operation cleared the undone operations of
+        # the history, put the remaining ones back so they can be redone too
+        self._undone[key] = undone
+
+        return result
+
+    def forget(self, event, identifier, **info):
+        """
+        Store listener that drops the histories of removed data objects.
+        """
+        if event != 'unregister':
+            return
+
+        for key in [key for key in self._histories if key[1] == identifier]:
+            del self._histories[key]
+            self._undone.pop(key, None)
+
+    def report(self, session=None):
+        """
+        Return the memory usage and storage state of the entries of each
+        history of a client session.
+        """
+        return [{'identifier': identifier,
+                 'nbytes': history.nbytes,
+                 'entries': history.report()}
+                for (key_session, identifier), history
+                in self._histories.items() if key_session == session]
+
+
+# Initialize the operation histories
+histories = Histories()
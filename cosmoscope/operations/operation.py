@@ -2,6 +2,26 @@ import abc
 import logging
 from functools import wraps
 
+from .cache import result_cache
+from .history import HistoryEntry, histories
+
+
+def _dataset_identifier(args, kwargs):
+    """
+    Return the identifier of the single data object in the store that an
+    operation is invoked on, or `None` if it is invoked on none or several.
+    """
+    from ..store import store
+
+    identifiers = set()
+
+    for value in list(args) + list(kwargs.values()):
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            if isinstance(item, str) and item in store:
+                identifiers.add(item)
+
+    return identifiers.pop() if len(identifiers) == 1 else None
+
 
 class Operation(metaclass=abc.ABCMeta):
     """
@@ -10,9 +30,6 @@ class Operation(metaclass=abc.ABCMeta):
     `__call__` method (the forward operation), and the `undo` method (the back-
     ward operation).
     """
-    _stack = []
-    _previous_action = None
-
     @abc.abstractmethod
     def __call__(self, *args, **kwargs):
         raise NotImplementedError
@@ -31,74 +48,136 @@ class Operation(metaclass=abc.ABCMeta):
         return wrapper
 
     @classmethod
-    def pop(cls, index=-1):
+    def pop(cls, session=None, identifier=None):
         """
-        Pop the last operation off the stack and return it.
+        Pop the last history entry off the history of a client session and
+        data object and return it.
 
         Parameters
         ----------
-        index : int
-            Index at which to pop.
+        session : str, optional
+            The client session.
+        identifier : str, optional
+            The data object. Operations not invoked on a single data object
+            are in the history with an identifier of `None`.
 
         Returns
         -------
-        last_op : :class:`~Operation`
-            The operation from the give index popped from stack.
+        last_op : :class:`~cosmoscope.operations.history.HistoryEntry`
+            The history entry popped from the history.
         """
-        last_op = cls._stack.pop(index)
-        cls._previous_action = last_op
-
-        return last_op
+        return histories.pop(session, identifier)
 
     @classmethod
-    def redo(cls):
-        cls._previous_action()
+    def redo(cls, session=None, identifier=None):
+        return histories.redo(session, identifier)
 
 
 class FunctionalOperation(Operation):
-    def __init__(self, function, context=None, name=None, *args, **kwargs):
+    def __init__(self, function, name=None, parallel=False, elementwise=False,
+                 cache=False, *args, **kwargs):
         if not callable(function):
             raise TypeError("{} is not callable.".format(function))
 
         super(FunctionalOperation, self).__init__()
 
         self._function = function
-        self._context = context or {}
         self._name = name if name is not None else function.__name__
+        self._parallel = parallel
+        self.elementwise = elementwise
+        self.cacheable = cache
         self._args = args
         self._kwargs = kwargs
-        self._undo = lambda x: logging.error(
+        self._undo = lambda *args, **kwargs: logging.error(
             "No undo registered for %s", function)
 
     def __call__(self, *args, **kwargs):
-        self._stack.append(self)
+        return self.invoke(args, kwargs)
+
+    def invoke(self, args, kwargs, session=None):
+        """
+        Invoke the operation on behalf of a client session, and record it in
+        the history of that session.
+
+        Parameters
+        ----------
+        args : tuple
+            Positional arguments of the operation.
+        kwargs : dict
+            Keyword arguments of the operation.
+        session : str, optional
+            The client session invoking the operation.
+        """
+        from .executor import executor
+
+        cache_key, cached = None, None
+
+        if self.cacheable and result_cache.enabled:
+            cache_key = result_cache.key(self, args, kwargs)
+            cached = result_cache.get(cache_key, args) \
+                if cache_key is not None else None
+
+        if cached is not None:
+            result, context = cached
+        else:
+            # Each invocation gets its own context, kept by its history entry
+            context = {}
+
+            # CPU-bound operations are run in the worker processes when
+            # available
+            if self._parallel and executor.enabled:
+                result = executor.run(self, args, kwargs, context)
+            else:
+                result = self._function(*args, context=context, **kwargs)
 
-        kwargs.update({'context': self._context})
+            if cache_key is not None:
+                result_cache.put(cache_key, result, context, args)
 
-        return self._function(*args, **kwargs)
+        histories.record(HistoryEntry(
+            self, context, args, kwargs, session=session,
+            identifier=_dataset_identifier(args, kwargs)))
+
+        return result
 
     @property
     def name(self):
         return self._name
 
-    def undo(self, *args, **kwargs):
-        args = () if args is None else args
-        kwargs = {} if kwargs is None else kwargs
-        kwargs.update({'context': self._context})
-
-        print("undoing {}".format(self.name), self._context)
+    def undo(self, *args, context, **kwargs):
+        logging.info("Undoing %s.", self.name)
 
-        return self._undo(*args, **kwargs)
+        return self._undo(*args, context=context, **kwargs)
 
 
-def reversible_operation(name):
-    """Defines a function as a reversible operation."""
-    context = dict()
-
+def reversible_operation(name, parallel=False, elementwise=False,
+                         cache=False):
+    """
+    Defines a function as a reversible operation.
+
+    Parameters
+    ----------
+    name : str
+        Display name of the operation.
+    parallel : bool
+        Whether the operation may be run in a worker process of the
+        `~cosmoscope.operations.executor.Executor`. The function must then be
+        importable from its module, and only pass arrays and picklable
+        objects in its arguments, result and context.
+    elementwise : bool
+        Whether each value of the result only depends on the value at the
+        same index of the data, so that consecutive elementwise operations
+        can be fused when evaluated lazily by the
+        `~cosmoscope.operations.graph.Graph`.
+    cache : bool
+        Whether results are cached by the
+        `~cosmoscope.operations.cache.ResultCache`. The function must then
+        only depend on its arguments and not modify the store.
+    """
     def decorator(func):
-        from ..core.server import ServerAPI
+        from ..server import ServerAPI
 
-        func_op = FunctionalOperation(func, context=context, name=name)
+        func_op = FunctionalOperation(func, name=name, parallel=parallel,
+                                      elementwise=elementwise, cache=cache)
         # Associate the name of the function with the name of the class
         # instance
         func_op.__name__ = func.__name__
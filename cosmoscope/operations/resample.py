@@ -0,0 +1,372 @@
+"""Contains the resampling of data onto new spectral grids."""
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+from scipy import sparse
+from scipy.interpolate import BSpline
+from scipy.sparse.linalg import splu
+
+from .cache import content_key
+from .operation import reversible_operation
+
+__all__ = ['resample', 'resample_data', 'RESAMPLE_METHODS']
+
+RESAMPLE_METHODS = ('linear', 'flux_conserving', 'spline')
+
+# Maximum number of pairs of grids whose resampling weights are kept
+WEIGHTS_CACHE_SIZE = 64
+
+_weights = OrderedDict()
+
+
+class _Weights:
+    """
+    Linear map from the values on a source grid to the values on a target
+    grid, as a sparse matrix with one row per target value. Spline weights
+    first solve for the spline coefficients with a factorized collocation
+    matrix, and then evaluate the splines with the sparse matrix. As every
+    spline value depends on all source values, spline weights can not carry
+    masks, which `resample` handles by fitting only the valid values.
+    """
+    def __init__(self, matrix, outside, solver=None):
+        self.matrix = matrix
+        self.outside = outside
+        self.solver = solver
+
+    def apply(self, values):
+        """
+        Resample values given with the source grid along the first axis.
+        Target values outside of the source grid are set to NaN.
+        """
+        if self.solver is not None:
+            values = self.solver.solve(values)
+
+        result = np.asarray(self.matrix @ values, dtype=float)
+        result[self.outside] = np.nan
+
+        return result
+
+    def propagate(self, uncertainty=None, mask=None):
+        """
+        Resample standard deviation uncertainties, assuming independent
+        errors, and masks, masking the target values that depend on a masked
+        source value.
+        """
+        if uncertainty is not None:
+            uncertainty = np.sqrt(np.asarray(
+                self.matrix.multiply(self.matrix) @ uncertainty ** 2))
+            uncertainty[self.outside] = np.nan
+
+        if mask is not None:
+            if self.solver is not None:
+                raise ValueError("Masks can not be propagated through spline "
+                                 "weights.")
+
+            mask = np.asarray(abs(self.matrix) @ mask.astype(float)) > 0
+            mask[self.outside] = True
+
+        return uncertainty, mask
+
+
+def _linear(source, target):
+    index = np.clip(np.searchsorted(source, target, side='right') - 1,
+                    0, len(source) - 2)
+    fraction = (target - source[index]) / (source[index + 1] - source[index])
+
+    rows = np.repeat(np.arange(len(target)), 2)
+    columns = np.stack([index, index + 1], axis=1).ravel()
+    values = np.stack([1 - fraction, fraction], axis=1).ravel()
+
+    matrix = sparse.csr_matrix((values, (rows, columns)),
+                               shape=(len(target), len(source)))
+
+    return _Weights(matrix, (target < source[0]) | (target > source[-1]))
+
+
+def _bin_edges(grid):
+    middle = (grid[1:] + grid[:-1]) / 2
+
+    return np.concatenate([[2 * grid[0] - middle[0]], middle,
+                           [2 * grid[-1] - middle[-1]]])
+
+
+def _flux_conserving(source, target):
+    """
+    Weights averaging the source values over each target bin, in proportion
+    to the overlap of the source bins, so the integrated flux is conserved.
+    Target bins not fully covered by the source bins are outside.
+    """
+    source_edges, target_edges = _bin_edges(source), _bin_edges(target)
+    lower, upper = target_edges[:-1], target_edges[1:]
+
+    first = np.clip(np.searchsorted(source_edges, lower, side='right') - 1,
+                    0, len(source) - 1)
+    last = np.clip(np.searchsorted(source_edges, upper, side='left') - 1,
+                   0, len(source) - 1)
+    counts = np.maximum(last - first + 1, 0)
+
+    # Pairs of target bins and overlapping source bins
+    rows = np.repeat(np.arange(len(target)), counts)
+    columns = first[rows] + np.arange(counts.sum()) \
+        - np.repeat(np.cumsum(counts) - counts, counts)
+
+    overlap = np.minimum(upper[rows], source_edges[columns + 1]) \
+        - np.maximum(lower[rows], source_edges[columns])
+    values = np.clip(overlap, 0, None) / (upper - lower)[rows]
+
+    matrix = sparse.csr_matrix((values, (rows, columns)),
+                               shape=(len(target), len(source)))
+
+    return _Weights(matrix, (lower < source_edges[0])
+                    | (upper > source_edges[-1]))
+
+
+def _spline(source, target):
+    """Weights of cubic spline interpolation with not-a-knot conditions."""
+    knots = np.concatenate([[source[0]] * 4, source[2:-2], [source[-1]] * 4])
+
+    solver = splu(BSpline.design_matrix(source, knots, 3).tocsc())
+    matrix = BSpline.design_matrix(np.clip(target, source[0], source[-1]),
+                                   knots, 3).tocsr()
+
+    return _Weights(matrix, (target < source[0]) | (target > source[-1]),
+                    solver=solver)
+
+
+def _resampling_weights(source, target, method):
+    """
+    Return the weights resampling values from a source grid onto a target
+    grid, reusing the weights of the last pairs of grids resampled.
+    """
+    key = content_key(method, source, target)
+
+    if key in _weights:
+        _weights.move_to_end(key)
+
+        return _weights[key]
+
+    if method not in RESAMPLE_METHODS:
+        raise ValueError("Unknown resampling method '{}', expected one of "
+                         "{}.".format(method, ', '.join(RESAMPLE_METHODS)))
+
+    if len(source) < (4 if method == 'spline' else 2):
+        raise ValueError("Source grid has too few values to resample with "
+                         "method '{}'.".format(method))
+
+    # Weights are computed for increasing grids, and reordered after
+    reverse_source = source[0] > source[-1]
+    reverse_target = target[0] > target[-1]
+
+    weights = {'linear': _linear,
+               'flux_conserving': _flux_conserving,
+               'spline': _spline}[method](
+        source[::-1] if reverse_source else source,
+        target[::-1] if reverse_target else target)
+
+    if reverse_target:
+        weights.matrix = weights.matrix[::-1]
+        weights.outside = weights.outside[::-1]
+
+    if reverse_source:
+        if weights.solver is None:
+            weights.matrix = weights.matrix[:, ::-1]
+        else:
+            weights.solver = _ReversedSolver(weights.solver)
+
+    _weights[key] = weights
+
+    while len(_weights) > WEIGHTS_CACHE_SIZE:
+        _weights.popitem(last=False)
+
+    return weights
+
+
+class _ReversedSolver:
+    """Solver of the spline coefficients of values on a decreasing grid."""
+    def __init__(self, solver):
+        self.solver = solver
+
+    def solve(self, values):
+        return self.solver.solve(np.ascontiguousarray(values[::-1]))
+
+
+def _resample_spline(flux, source, target, valid):
+    """
+    Interpolate a stack of spectra with cubic splines through their valid
+    values only, so that masked and non-finite values do not affect any
+    result. Spectra with the same valid values share their weights.
+
+    Returns
+    -------
+    flux, mask : `~numpy.ndarray`
+        The interpolated values, and a mask of the values outside of the
+        valid values, or between valid values that are not adjacent on the
+        source grid.
+    """
+    result = np.full((len(flux), len(target)), np.nan)
+    mask = np.ones(result.shape, dtype=bool)
+
+    # Interpolated values bridging invalid source values
+    gaps = abs(_resampling_weights(source, target, 'linear').matrix) \
+        @ (~valid).T.astype(float) > 0
+
+    patterns, inverse = np.unique(valid, axis=0, return_inverse=True)
+
+    for index, pattern in enumerate(patterns):
+        rows = np.flatnonzero(inverse.reshape(-1) == index)
+        columns = np.flatnonzero(pattern)
+
+        # Spectra with too few valid values are left masked
+        if len(columns) < 4:
+            continue
+
+        weights = _resampling_weights(source[columns], target, 'spline')
+        result[rows] = weights.apply(flux[rows][:, columns].T).T
+        mask[rows] = weights.outside | gaps[:, rows[0]]
+
+    result[mask] = np.nan
+
+    return result, mask
+
+
+def resample(flux, source, target, method='linear', uncertainty=None,
+             mask=None):
+    """
+    Resample spectra sharing a source grid onto a target grid.
+
+    Parameters
+    ----------
+    flux : `~numpy.ndarray`
+        Values of one spectrum, or of a stack of spectra along the first
+        axis, on the source grid.
+    source, target : `~numpy.ndarray`
+        Monotonic source and target grids, in the same unit.
+    method : str
+        One of ``linear``, ``flux_conserving`` or ``spline``.
+    uncertainty : `~numpy.ndarray`, optional
+        Standard deviation uncertainties of the values. Uncertainties are
+        not propagated through spline interpolation.
+    mask : `~numpy.ndarray`, optional
+        Masks of the values. Splines are fitted to the unmasked finite
+        values only.
+
+    Returns
+    -------
+    flux, uncertainty, mask : `~numpy.ndarray`
+        The values on the target grid. Values outside of the source grid are
+        NaN and masked.
+    """
+    source = np.asarray(source, dtype=float)
+    target = np.asarray(target, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+
+    if method == 'spline':
+        stack = flux.reshape(-1, flux.shape[-1])
+        valid = np.isfinite(stack)
+
+        if mask is not None:
+            valid &= ~np.asarray(mask, dtype=bool).reshape(stack.shape)
+
+        result, result_mask = _resample_spline(stack, source, target, valid)
+        shape = flux.shape[:-1] + (len(target),)
+
+        return (result.reshape(shape), None,
+                result_mask.reshape(shape)
+                if mask is not None or not valid.all() else None)
+
+    weights = _resampling_weights(source, target, method)
+
+    result = weights.apply(flux.T).T
+
+    uncertainty, mask = weights.propagate(
+        np.asarray(uncertainty, dtype=float).T
+        if uncertainty is not None else None,
+        np.asarray(mask, dtype=bool).T if mask is not None else None)
+
+    return (result,
+            uncertainty.T if uncertainty is not None else None,
+            mask.T if mask is not None else None)
+
+
+@reversible_operation("Resample")
+def resample_data(identifiers, spectral_axis, context, method='linear',
+                  unit=None):
+    """
+    Resample data objects in the store onto a common spectral axis, creating
+    a new data object for each of them. Data objects on the same grid are
+    stacked and resampled at once, with the weights of their grid computed
+    only once. Undoing removes the new data objects.
+    """
+    from astropy.nddata import StdDevUncertainty
+    from astropy.units import Quantity, spectral
+
+    from ..data import Data
+    from ..mixins import new_identifiers
+    from ..store import store
+    from .graph import materialized_data
+
+    if isinstance(identifiers, str):
+        identifiers = [identifiers]
+
+    datasets = [materialized_data(identifier) for identifier in identifiers]
+    target = Quantity(spectral_axis, unit if unit is not None
+                      else datasets[0].spectral_axis.unit)
+
+    # Group the data objects by source grid
+    groups = defaultdict(list)
+    grids = {}
+
+    for index, data in enumerate(datasets):
+        grid = data.spectral_axis.to_value(target.unit,
+                                           equivalencies=spectral())
+        key = content_key(grid)
+        grids[key] = grid
+        groups[key].append(index)
+
+    resampled = [None] * len(datasets)
+
+    for key, group in groups.items():
+        members = [datasets[index] for index in group]
+        has_uncertainty = method != 'spline' and all(
+            data.uncertainty is not None for data in members)
+        has_mask = any(data.mask is not None for data in members)
+
+        flux, uncertainty, mask = resample(
+            np.stack([data.flux.value for data in members]),
+            grids[key], target.value, method=method,
+            uncertainty=np.stack([
+                data.uncertainty.represent_as(StdDevUncertainty).array
+                for data in members]) if has_uncertainty else None,
+            mask=np.stack([
+                data.mask if data.mask is not None
+                else np.zeros(data.flux.shape, dtype=bool)
+                for data in members]) if has_mask else None)
+
+        for row, (index, data) in enumerate(zip(group, members)):
+            resampled[index] = {
+                'flux': Quantity(flux[row], data.flux.unit),
+                'spectral_axis': target,
+                'uncertainty': StdDevUncertainty(uncertainty[row])
+                if uncertainty is not None else None,
+                'mask': mask[row] if mask is not None
+                else np.isnan(flux[row]),
+                'meta': dict(data.meta),
+                'name': '{} (resampled)'.format(data.name)}
+
+    registered = store.register_many(
+        Data.restore(identifier, **arguments) for identifier, arguments
+        in zip(new_identifiers(len(resampled)), resampled))
+
+    context['identifiers'] = registered
+
+    return registered
+
+
+@resample_data.register_undo
+def unresample_data(context):
+    from ..store import store
+
+    for identifier in context['identifiers']:
+        store.unregister(identifier)
+
+    return list(context['identifiers'])
@@ -1,19 +1,40 @@
 import logging
+import os
+import uuid
 
 import signal
 import gevent
 import msgpack
-from zerorpc import Publisher, Puller, Pusher, Server
+from zerorpc import Publisher, Puller, Pusher, Server, stream
 import numpy as np
 import jsonpickle
 
-from .store import store
+from .session import Autosave
+from .store import SAVE_PATH, store
+from .catalogue import Catalogue
 from .data import Data
-from .operations.operation import Operation
+from .index import spectral_index
+from .io import loader_formats
+from .loader import loader
+from .operations.cache import CACHE_PATH, result_cache
+from .operations.executor import executor
+from .operations.graph import LazyOperation, graph, materialized_data
+from .operations.history import histories
+from .transport import pack_array, unpack
 from .utils.singleton import Singleton
 
 __all__ = ['ServerAPI']
 
+# Default number of samples sent per chunk when streaming data
+CHUNK_SIZE = 2 ** 16
+
+# Fraction of an array that may change before subscribers are told to reload
+# the data instead of being sent the changed values
+DELTA_FRACTION = 0.5
+
+# Number of seconds the result of a finished job is kept for `query_job`
+JOB_EXPIRY = 600
+
 
 class ServerAPI(Server, metaclass=Singleton):
     """
@@ -23,18 +44,229 @@ class ServerAPI(Server, metaclass=Singleton):
     def __init__(self, publisher=None, *args, **kwargs):
         super(ServerAPI, self).__init__(*args, **kwargs)
         self.publisher = publisher
+        self._jobs = {}
+
+    def call_operation(self, session, name, *args):
+        """
+        Invoke an operation on behalf of a client session. The operation is
+        recorded in the history of that session, so that it is undone and
+        redone independently of the operations of other clients.
+
+        Parameters
+        ----------
+        session : str
+            Identifier chosen by the client for its session.
+        name : str
+            Name of the operation on the server api, e.g. `smooth_data`.
+        args
+            Arguments passed to the operation.
+        """
+        return getattr(self, name).invoke(args, {}, session=session)
+
+    def apply_lazy(self, session, identifier, name, *args):
+        """
+        Apply an operation lazily to the flux of a data object. The operation
+        is only evaluated once the data object is queried, together with any
+        other operations applied lazily in the meantime. Undoing it does not
+        recompute anything.
+
+        Parameters
+        ----------
+        session : str
+            Identifier chosen by the client for its session.
+        identifier : str
+            Identifier of the data object in the store.
+        name : str
+            Name of the operation on the server api, e.g. `smooth_data`. The
+            operation must take the data array as its first argument.
+        args
+            The other arguments passed to the operation.
+
+        Returns
+        -------
+        : str
+            The key of the node added to the operation graph.
+        """
+        return LazyOperation(getattr(self, name)).invoke(
+            (identifier,) + args, {}, session=session)
+
+    def query_lazy(self, identifier):
+        """
+        Returns the state of the lazy operations applied to a data object,
+        and the memoization counters of the operation graph.
+        """
+        pipeline = graph.pipelines.get(identifier)
+
+        if pipeline is None:
+            return {'operations': [], 'position': 0, 'pending': False,
+                    'stats': graph.stats}
+
+        return {'operations': [node.operation.name
+                               for node in pipeline.nodes[1:]],
+                'position': pipeline.position,
+                'pending': pipeline.pending,
+                'stats': graph.stats}
+
+    def _data(self, identifier):
+        """
+        Returns a data object from the store, evaluating any pending lazy
+        operations first.
+        """
+        return materialized_data(identifier)
+
+    def submit_operation(self, session, name, *args):
+        """
+        Start an operation on behalf of a client session without waiting for
+        it to finish. Subscribers are sent an `operation_completed` event
+        with the job id and whether the operation was successful once it has
+        finished.
+
+        Parameters
+        ----------
+        session : str
+            Identifier chosen by the client for its session, whose history
+            the operation is recorded in.
+        name : str
+            Name of the operation on the server api, e.g. `smooth_data`.
+        args
+            Arguments passed to the operation.
+
+        Returns
+        -------
+        : str
+            The id of the job, used to retrieve the result with `query_job`.
+        """
+        operation = getattr(self, name)
+        job_id = str(uuid.uuid4())
+
+        job = gevent.spawn(operation.invoke, args, {}, session=session)
+        job.link(lambda job: self._complete_job(job_id, name, job))
+
+        self._jobs[job_id] = job
+
+        return job_id
+
+    def _complete_job(self, job_id, name, job):
+        if not job.successful():
+            logging.error("Operation %s of job %s failed: %s",
+                          name, job_id, job.exception)
+
+        if self.publisher is not None:
+            self.publisher.operation_completed(job_id, job.successful())
+
+        # Forget results that are never queried
+        gevent.spawn_later(JOB_EXPIRY, self._jobs.pop, job_id, None)
+
+    def query_job(self, job_id, binary=False):
+        """
+        Returns the state of a job started with `submit_operation`. Once the
+        job has finished, its result is returned and the job is forgotten.
+        Jobs whose result is not queried within `JOB_EXPIRY` seconds of
+        finishing are forgotten as well.
+
+        Parameters
+        ----------
+        job_id : str
+            The id of the job.
+        binary : bool
+            If `True`, an array result is sent as a raw buffer, see
+            `query_data`.
+
+        Returns
+        -------
+        : dict
+            The `status` of the job, one of `running`, `completed` or
+            `failed`, and the `result` of a completed job.
+        """
+        job = self._jobs[job_id]
+
+        if not job.ready():
+            return {'status': 'running'}
+
+        del self._jobs[job_id]
+
+        if not job.successful():
+            return {'status': 'failed', 'error': str(job.exception)}
+
+        result = job.value
+
+        if isinstance(result, np.ndarray) and not result.dtype.hasobject:
+            result = pack_array(result) if binary else result.tolist()
 
-    def undo(self):
+        return {'status': 'completed', 'result': result}
+
+    def publish_change(self, event, identifier, diff=None, **info):
         """
-        Undo an operation popping from the stack and calling its `undo` method.
+        Store listener that forwards changes to subscribers. Updates are
+        published as `data_updated` events carrying a delta with the new
+        version of the data object and the new values of the changed index
+        ranges, packed as binary arrays, so subscribers can patch their local
+        copies. Removals are published as `data_removed` events.
         """
-        Operation.pop().undo()
+        if self.publisher is None:
+            return
+
+        if event == 'update':
+            self.publisher.data_updated(
+                identifier, self._pack_delta(store[identifier], diff))
+        elif event == 'unregister':
+            self.publisher.data_removed(identifier)
+
+    @staticmethod
+    def _pack_delta(data, diff):
+        delta = {'version': data.version,
+                 'previous_version': data.version - 1,
+                 'fields': {},
+                 'arrays': {},
+                 'reload': False}
+
+        arrays = {'data': data.data,
+                  'uncertainty': data.uncertainty.array
+                  if data.uncertainty is not None else None,
+                  'mask': data.mask}
+
+        for key, value in diff.items():
+            if key == 'name':
+                delta['fields'][key] = data.name
+            elif key == 'unit':
+                delta['fields'][key] = data.flux.unit.to_string()
+
+            # The meta data is not guaranteed to be serializable, subscribers
+            # only see its version change
+            if key not in arrays:
+                continue
 
-    def redo(self):
+            array = arrays[key]
+            n_changed = sum(stop - start for start, stop in value)
+
+            # Sending most of the array as a delta is no cheaper than
+            # having subscribers query the whole data object
+            if n_changed > DELTA_FRACTION * array.shape[-1]:
+                delta['reload'] = True
+                delta['arrays'] = {}
+                break
+
+            delta['arrays'][key] = [
+                (start, stop, pack_array(array[..., start:stop]))
+                for start, stop in value]
+
+        return delta
+
+    def undo(self, session=None, identifier=None):
         """
-        Call the `redo` method on the latest operation to be added to stack.
+        Undo the last operation of a client session on a data object, popping
+        it from the history and calling its `undo` method. The operation is
+        kept in the history if it can not be undone, e.g. because another
+        client session applied lazy operations to the data object since.
         """
-        Operation.redo()
+        histories.undo(session, identifier)
+
+    def redo(self, session=None, identifier=None):
+        """
+        Invoke again the last operation undone by a client session on a data
+        object.
+        """
+        histories.redo(session, identifier)
 
     def register(self, msg):
         pass
@@ -50,6 +282,50 @@ class ServerAPI(Server, metaclass=Singleton):
 
         self.publisher.data_loaded(data.identifier)
 
+    def load_data_async(self, path, format=None):
+        """
+        Start loading a data file, or every file of a directory in parallel,
+        without waiting for the files to be read. Subscribers are sent a
+        `load_progress` event with the job id, the path, the identifier of
+        the new data object or the error message, and the number of files
+        done and in total, as well as a `data_loaded` event, after each file
+        is read. Once all files are read, an `operation_completed` event is
+        sent as for `submit_operation`.
+
+        Parameters
+        ----------
+        path : str
+            Path of a data file or of a directory of data files.
+        format : str, optional
+            Format of the files, see `query_loader_formats`. By default, the
+            format is identified from each file.
+
+        Returns
+        -------
+        : str
+            The id of the job, used to retrieve the identifiers of the loaded
+            data objects with `query_job`.
+        """
+        job_id = str(uuid.uuid4())
+
+        def progress(file_path, identifier, error, n_done, n_files):
+            if self.publisher is None:
+                return
+
+            self.publisher.load_progress(job_id, file_path, identifier, error,
+                                         n_done, n_files)
+
+            if identifier is not None:
+                self.publisher.data_loaded(identifier)
+
+        job = gevent.spawn(loader.load, path, format, progress)
+        job.link(lambda job: self._complete_job(job_id, 'load_data_async',
+                                                job))
+
+        self._jobs[job_id] = job
+
+        return job_id
+
     def create_data(self, *args, **kwargs):
         data = Data(*args, **kwargs)
 
@@ -57,45 +333,409 @@ class ServerAPI(Server, metaclass=Singleton):
 
         return data.identifier
 
+    def create_data_bulk(self, datasets):
+        """
+        Create and register many data objects in one call. Identifiers are
+        assigned in bulk, and subscribers are sent a single
+        `data_created_bulk` event with all the identifiers.
+
+        Parameters
+        ----------
+        datasets : list of dict
+            The `flux` and `spectral_axis` arrays of each data object, with
+            optional `unit`, `spectral_axis_unit`, `uncertainty` (standard
+            deviation), `mask`, `name` and `meta`. Arrays are given as lists
+            or as raw buffers packed with `cosmoscope.transport.pack_array`,
+            and are not decoded with `jsonpickle`.
+
+        Returns
+        -------
+        : list
+            The identifiers of the new data objects.
+        """
+        from .mixins import new_identifiers
+
+        datasets = unpack(datasets)
+        identifiers = new_identifiers(len(datasets))
+
+        registered = store.register_many(
+            Data.restore(identifier, **self._data_arguments(dataset))
+            for identifier, dataset in zip(identifiers, datasets))
+
+        if self.publisher is not None:
+            self.publisher.data_created_bulk(registered)
+
+        return registered
+
+    @staticmethod
+    def _data_arguments(dataset):
+        """Return the `Data` arguments of a dataset of `create_data_bulk`."""
+        from astropy.nddata import StdDevUncertainty
+        from astropy.units import Quantity
+
+        uncertainty = dataset.get('uncertainty')
+
+        return {'flux': Quantity(dataset['flux'], dataset.get('unit')),
+                'spectral_axis': Quantity(dataset['spectral_axis'],
+                                          dataset.get('spectral_axis_unit')),
+                'uncertainty': StdDevUncertainty(uncertainty)
+                if uncertainty is not None else None,
+                'mask': dataset.get('mask'),
+                'meta': dataset.get('meta'),
+                'name': dataset.get('name')}
+
+    def create_catalogue(self, flux, spectral_axis, offsets, unit=None,
+                         spectral_axis_unit=None, name=None):
+        """
+        Create a catalogue of many spectra from ragged buffers and register
+        it with the store at once. The spectra of the catalogue are queried
+        like other data objects, with identifiers of the form
+        ``<catalogue identifier>/<index>``.
+
+        Parameters
+        ----------
+        flux, spectral_axis : list or binary array
+            The values of all spectra, concatenated. Arrays packed with
+            `cosmoscope.transport.pack_array` are sent as raw buffers.
+        offsets : list or binary array
+            Start index of each spectrum, followed by the total number of
+            values.
+        unit, spectral_axis_unit : str, optional
+            Units of the flux and spectral axis.
+        name : str, optional
+            Name of the catalogue.
+
+        Returns
+        -------
+        : str
+            The identifier of the catalogue.
+        """
+        catalogue = Catalogue(
+            unpack(flux), unpack(spectral_axis), unpack(offsets), unit=unit,
+            spectral_axis_unit=spectral_axis_unit, name=name)
+
+        store.register_catalogue(catalogue)
+
+        if self.publisher is not None:
+            self.publisher.catalogue_created(catalogue.identifier,
+                                             len(catalogue))
+
+        return catalogue.identifier
+
+    def query_catalogue(self, identifier, binary=False):
+        """
+        Returns the description of a catalogue and the number of values of
+        each of its spectra.
+        """
+        catalogue = store.catalogues[identifier]
+        lengths = catalogue.lengths
+
+        return {'name': catalogue.name,
+                'version': catalogue.version,
+                'n_spectra': len(catalogue),
+                'nbytes': catalogue.nbytes,
+                'unit': catalogue.unit.to_string(),
+                'spectral_axis_unit': catalogue.spectral_axis_unit.to_string(),
+                'lengths': pack_array(lengths) if binary else lengths.tolist()}
+
+    def remove_catalogue(self, identifier):
+        """
+        Removes a catalogue and its spectra from the store.
+        """
+        store.unregister_catalogue(identifier)
+
+        if self.publisher is not None:
+            self.publisher.catalogue_removed(identifier)
+
     def query_loader_formats(self):
         """
         Returns a list of available data loader formats.
         """
-        from specutils import Spectrum1D
-        from astropy.io import registry as io_registry
+        return loader_formats()
+
+    def query_store_stats(self):
+        """
+        Returns the memory usage and eviction counters of the store.
+        """
+        return dict(store.stats, n_data=len(store),
+                    memory_budget=store.memory_budget)
+
+    def query_store(self, wavelength_range=None, predicates=None,
+                    unit='Angstrom', slices=False):
+        """
+        Returns the data objects and catalogue spectra covering a spectral
+        range whose summary statistics match all of the given predicates,
+        answered from the spectral index of the store.
+
+        Parameters
+        ----------
+        wavelength_range : list, optional
+            Lower and upper bound of the spectral range, in `unit`.
+        predicates : list, optional
+            Predicates of the form ``[field, operator, value]``, e.g.
+            ``['flux_max', '>', 1e-17]``. See
+            `cosmoscope.index.SpectralIndex.query`.
+        unit : str
+            Unit of the spectral range.
+        slices : bool
+            If `True`, the index range of the values within the spectral
+            range is returned with each identifier.
+        """
+        # Pending lazy operations must be applied to be seen by the index
+        for identifier in list(graph.pipelines):
+            graph.materialize(identifier)
+
+        return spectral_index.query(wavelength_range, predicates, unit=unit,
+                                    slices=slices)
+
+    def query_history(self, session=None):
+        """
+        Returns the memory usage and storage state of each entry of the
+        operation histories of a client session, from oldest to newest.
+        """
+        return {'histories': histories.report(session),
+                'nbytes': histories.nbytes,
+                'budget': histories.budget}
+
+    def query_cache_stats(self):
+        """
+        Returns the hit and miss counters of the operation result cache.
+        """
+        return dict(result_cache.stats,
+                    memory_budget=result_cache.memory_budget,
+                    disk_enabled=result_cache.path is not None)
+
+    def query_data(self, identifier, binary=False):
+        """
+        Returns a dictionary representation of the data object.
+
+        Parameters
+        ----------
+        identifier : str
+            Identifier of the data object in the store.
+        binary : bool
+            If `True`, the `spectral_axis` and `flux` arrays are sent as raw
+            buffers packed in msgpack extension types instead of lists. Use
+            `cosmoscope.transport.unpack` to decode them on the client. The
+            decoded arrays are read-only.
+        """
+        return self._pack_data(self._data(identifier), slice(None), binary)
+
+    def query_data_slice(self, identifier, start=None, stop=None, stride=None,
+                         binary=False):
+        """
+        Returns a dictionary representation of a slice of the data object.
+        Only the requested samples of the `spectral_axis` and `flux` arrays
+        are sent.
+
+        Parameters
+        ----------
+        identifier : str
+            Identifier of the data object in the store.
+        start, stop, stride : int, optional
+            Slice parameters along the spectral axis.
+        binary : bool
+            See `query_data`.
+        """
+        return self._pack_data(self._data(identifier),
+                               slice(start, stop, stride), binary)
+
+    @stream
+    def stream_data(self, identifier, start=None, stop=None, stride=None,
+                    chunk_size=CHUNK_SIZE, binary=False):
+        """
+        Streams a slice of the data object in chunks of at most `chunk_size`
+        samples. Each chunk is packed only once it is requested, so neither
+        side holds more than one chunk of the reply at a time.
+
+        Parameters
+        ----------
+        identifier : str
+            Identifier of the data object in the store.
+        start, stop, stride : int, optional
+            Slice parameters along the spectral axis.
+        chunk_size : int
+            Maximum number of samples sent per chunk.
+        binary : bool
+            See `query_data`.
+
+        Yields
+        ------
+        : dict
+            The packed chunk, with an additional `start` key holding the
+            index of its first sample in the full data object.
+        """
+        if stride is not None and stride < 1:
+            raise ValueError("Streamed data must have a positive stride.")
+
+        data = self._data(identifier)
+
+        start, stop, stride = slice(start, stop, stride).indices(
+            data.flux.shape[-1])
+
+        for chunk_start in range(start, stop, chunk_size * stride):
+            chunk_stop = min(chunk_start + chunk_size * stride, stop)
+
+            data_dict = self._pack_data(
+                data, slice(chunk_start, chunk_stop, stride), binary)
+            data_dict['start'] = chunk_start
+
+            yield data_dict
+
+    def query_data_decimated(self, identifier, start=None, stop=None,
+                             n_pixels=1000, binary=False):
+        """
+        Returns the min/max envelope of a slice of the data object reduced to
+        at most `n_pixels` bins, suitable for plotting. The envelope is built
+        from a multi-resolution pyramid cached on the data object, so the cost
+        scales with the number of pixels rather than the number of samples.
 
-        all_formats = io_registry.get_formats(Spectrum1D)['Format']
+        Parameters
+        ----------
+        identifier : str
+            Identifier of the data object in the store.
+        start, stop : int, optional
+            Slice parameters along the spectral axis.
+        n_pixels : int
+            Maximum number of bins returned.
+        binary : bool
+            See `query_data`.
 
-        return all_formats
+        Returns
+        -------
+        : dict
+            The `spectral_axis` value at the start of each bin, and the
+            `min` and `max` flux in each bin.
+        """
+        data = self._data(identifier)
 
-    def query_data(self, identifier):
-        data = store[identifier]
+        edges, mins, maxs = data.pyramid.decimate(start, stop, n_pixels)
 
         data_dict = {
             'name': data.name,
             'identifier': data.identifier,
-            'spectral_axis': data.spectral_axis.value.tolist(),
             'spectral_axis_unit': data.spectral_axis.unit.to_string(),
-            'flux': data.flux.value.tolist(),
             'unit': data.flux.unit.to_string()
         }
 
+        arrays = {'spectral_axis': data.spectral_axis.value[edges],
+                  'min': mins,
+                  'max': maxs}
+
+        for key, array in arrays.items():
+            data_dict[key] = pack_array(array) if binary else array.tolist()
+
         return data_dict
 
-    def query_data_attribute(self, identifier, name):
-        data = store[identifier]
+    @staticmethod
+    def _pack_data(data, key, binary):
+        data_dict = {
+            'name': data.name,
+            'identifier': data.identifier,
+            'version': data.version,
+            'spectral_axis_unit': data.spectral_axis.unit.to_string(),
+            'unit': data.flux.unit.to_string()
+        }
+
+        spectral_axis = data.spectral_axis.value[key]
+        flux = data.flux.value[..., key]
+
+        if binary:
+            data_dict['spectral_axis'] = pack_array(spectral_axis)
+            data_dict['flux'] = pack_array(flux)
+        else:
+            data_dict['spectral_axis'] = spectral_axis.tolist()
+            data_dict['flux'] = flux.tolist()
+
+        return data_dict
+
+    def query_data_attribute(self, identifier, name, binary=False):
+        """
+        Returns an attribute of the data object.
+
+        Parameters
+        ----------
+        identifier : str
+            Identifier of the data object in the store.
+        name : str
+            Name of the attribute.
+        binary : bool
+            If `True` and the attribute is an array or quantity, it is sent as
+            a raw buffer packed in a msgpack extension type rather than being
+            encoded with `jsonpickle`.
+        """
+        return self._pack_attribute(self._data(identifier), name, binary)
 
+    def query_batch(self, requests, binary=False):
+        """
+        Returns several attributes of several data objects in one call.
+
+        Parameters
+        ----------
+        requests : list
+            List of ``(identifier, [attribute names])`` pairs.
+        binary : bool
+            See `query_data_attribute`.
+
+        Returns
+        -------
+        : list
+            For each request, a dict mapping the attribute names to their
+            packed values, in the same form as `query_data_attribute`.
+        """
+        results = []
+
+        for identifier, names in requests:
+            data = self._data(identifier)
+
+            results.append({name: self._pack_attribute(data, name, binary)
+                            for name in names})
+
+        return results
+
+    @staticmethod
+    def _pack_attribute(data, name, binary):
         data_attr = getattr(data, name)
 
-        packed_data_attr = data.encode(data_attr)
+        if binary and isinstance(data_attr, np.ndarray) \
+                and not data_attr.dtype.hasobject:
+            return pack_array(data_attr)
 
-        return packed_data_attr
+        return jsonpickle.encode(data_attr)
 
 
-def launch(server_address=None, publisher_address=None, block=True):
+def launch(server_address=None, publisher_address=None, block=True,
+           autosave_interval=None, workers=None, history_budget=None,
+           disk_cache=False, memory_budget=None, memmap_threshold=None):
     server_address = server_address or "tcp://127.0.0.1:4242"
     publisher_address = publisher_address or "tcp://127.0.0.1:4243"
 
+    # Run CPU-bound operations in a pool of worker processes
+    executor.configure(workers)
+
+    # Spill the least recently used data objects to disk past this budget
+    store.memory_budget = memory_budget
+
+    # Back data objects at least this large with memory-mapped files
+    store.memmap_threshold = memmap_threshold
+
+    # Bound the memory held by all undo histories
+    histories.budget = history_budget
+
+    # Keep operation results on disk so they survive server restarts
+    if disk_cache:
+        result_cache.path = CACHE_PATH
+
+    # Periodically save the session in the background, journalling changes
+    # made in between so they can be recovered after a crash
+    autosave = None
+
+    if autosave_interval is not None:
+        path = os.path.join(SAVE_PATH,
+                            "{:s}.csm".format(store._session_id))
+        autosave = Autosave(store, path, interval=autosave_interval)
+        autosave.start()
+
     # Establish the publisher service. This will send events to any
     # subscribed services along the designated address.
     publisher = Publisher()
@@ -106,11 +746,28 @@ def launch(server_address=None, publisher_address=None, block=True):
     server = ServerAPI(publisher)
     server.bind(server_address)
 
+    # Forward changes made to the store to subscribers
+    store.subscribe(server.publish_change)
+    store.subscribe(histories.forget)
+    store.subscribe(graph.on_change)
+
+    # Index the spectral range and statistics of the data in the store
+    spectral_index.attach(store)
+
     logging.info(
         "Server is now listening on %s and sending on %s.",
         server_address, publisher_address)
 
     # Allow for stopping the server via ctrl-c
-    gevent.signal(signal.SIGINT, server.stop)
+    gevent.signal_handler(signal.SIGINT, server.stop)
+
+    if not block:
+        return gevent.spawn(server.run)
+
+    server.run()
+
+    executor.shutdown()
 
-    server.run() if block else gevent.spawn(server.run)
\ No newline at end of file
+    # Save a final snapshot of the session on shutdown
+    if autosave is not None:
+        autosave.stop()
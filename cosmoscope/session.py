@@ -0,0 +1,681 @@
+"""Contains the on-disk session format used to save and open the store."""
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import gevent
+import jsonpickle
+import numpy as np
+from astropy import nddata
+from astropy.io.fits import Header
+from astropy.units import Quantity, Unit
+from astropy.wcs import WCS
+
+__all__ = ['DeferredData', 'Journal', 'Autosave', 'save_session',
+           'open_session', 'restore_data', 'dump_data', 'load_data']
+
+MANIFEST_NAME = 'manifest.json'
+JOURNAL_NAME = 'journal'
+SESSION_FORMAT_VERSION = 1
+
+# Arrays stored for each data object, in the order they are written
+_ARRAY_NAMES = ('flux', 'spectral_axis', 'uncertainty', 'mask')
+
+
+def _uncertainty_classes():
+    """Map uncertainty type strings to the astropy uncertainty classes."""
+    classes = {}
+
+    for name in ('StdDevUncertainty', 'VarianceUncertainty',
+                 'InverseVariance'):
+        cls = getattr(nddata, name, None)
+
+        if cls is not None:
+            classes[cls().uncertainty_type] = cls
+
+    return classes
+
+
+def _replace(path, write):
+    """
+    Write a file by calling `write` on a temporary file and atomically moving
+    it into place. Readers that have the previous file mapped in memory keep
+    seeing the old content, and a crash never leaves a partial file behind.
+    """
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         suffix='.tmp')
+
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            write(f)
+
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class DeferredData:
+    """
+    Placeholder kept in the store for a data object that has not been loaded
+    yet. The store replaces it with the loaded data object the first time it
+    is accessed.
+
+    Parameters
+    ----------
+    identifier : str
+        Identifier of the data object.
+    entry : dict
+        Manifest entry describing the stored data object.
+    path : str
+        Directory holding the arrays of the data object.
+    """
+    def __init__(self, identifier, entry, path):
+        self.identifier = identifier
+        self.entry = entry
+        self.path = path
+
+    @property
+    def version(self):
+        return self.entry.get('version', 0)
+
+    def load(self, mmap_threshold=None):
+        """Load and return the data object."""
+        return load_data(self.identifier, self.entry, self.path,
+                         mmap_threshold=mmap_threshold)
+
+    def array(self, name):
+        """
+        Return one of the stored arrays, memory-mapped read-only, without
+        loading the data object.
+        """
+        return np.load(os.path.join(self.path, '{}.npy'.format(name)),
+                       mmap_mode='r', allow_pickle=False)
+
+
+def _describe(data):
+    """
+    Return the arrays of a data object, by name, and the manifest entry
+    describing it.
+    """
+    from .index import summarize
+
+    arrays = {
+        'flux': data.flux.value,
+        'spectral_axis': data.spectral_axis.value,
+        'uncertainty': data.uncertainty.array
+        if data.uncertainty is not None else None,
+        'mask': data.mask
+    }
+
+    entry = {
+        'name': data.name,
+        'version': data.version,
+        'unit': data.flux.unit.to_string(),
+        'spectral_axis_unit': data.spectral_axis.unit.to_string(),
+        'uncertainty_type': data.uncertainty.uncertainty_type
+        if data.uncertainty is not None else None,
+        'arrays': [name for name in _ARRAY_NAMES if arrays[name] is not None],
+        'meta': jsonpickle.encode(dict(data.meta)) if data.meta else None,
+        # Lookup table WCS are rebuilt from the spectral axis, only FITS WCS
+        # need to be kept
+        'wcs': data.wcs.to_header_string()
+        if isinstance(data.wcs, WCS) else None,
+        # Kept so the spectral index does not need to load the data object
+        'summary': summarize(arrays['spectral_axis'],
+                             data.spectral_axis.unit, arrays['flux'])
+    }
+
+    return arrays, entry
+
+
+def _write_arrays(arrays, path):
+    """
+    Write arrays to `.npy` files named after them in the given directory,
+    removing the files of arrays that are `None`.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    for name, array in arrays.items():
+        file_path = os.path.join(path, '{}.npy'.format(name))
+
+        if array is None:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            continue
+
+        _replace(file_path, lambda f, a=np.asarray(array):
+                 np.save(f, a, allow_pickle=False))
+
+
+def dump_data(data, path):
+    """
+    Write the arrays of a data object to `.npy` files in the given directory.
+    The metadata, encoded with jsonpickle, and any FITS WCS are kept in the
+    returned entry.
+
+    Returns
+    -------
+    : dict
+        The manifest entry describing the stored data object.
+    """
+    arrays, entry = _describe(data)
+    _write_arrays(arrays, path)
+
+    return entry
+
+
+def load_data(identifier, entry, path, mmap_threshold=None):
+    """
+    Load a data object previously written with `dump_data`. The data object
+    is restored with its original identifier and is not registered with the
+    store.
+
+    Parameters
+    ----------
+    mmap_threshold : int, optional
+        Arrays stored in files of at least this many bytes are memory-mapped
+        copy-on-write rather than read into memory.
+    """
+    from .data import Data
+
+    arrays = {}
+
+    for name in entry['arrays']:
+        file_path = os.path.join(path, '{}.npy'.format(name))
+
+        mmap_mode = 'c' if mmap_threshold is not None \
+            and os.path.getsize(file_path) >= mmap_threshold else None
+
+        arrays[name] = np.load(file_path, mmap_mode=mmap_mode,
+                               allow_pickle=False)
+
+    uncertainty = None
+
+    if 'uncertainty' in arrays:
+        uncertainty = _uncertainty_classes()[entry['uncertainty_type']](
+            arrays['uncertainty'])
+
+    if entry.get('wcs') is not None:
+        spectral = {'wcs': WCS(Header.fromstring(entry['wcs']))}
+    else:
+        spectral = {'spectral_axis': Quantity(
+            arrays['spectral_axis'], unit=entry['spectral_axis_unit'])}
+
+    data = Data.restore(
+        identifier,
+        Quantity(arrays['flux'], unit=entry['unit'], copy=False),
+        uncertainty=uncertainty,
+        mask=arrays.get('mask'),
+        meta=jsonpickle.decode(entry['meta'])
+        if entry.get('meta') is not None else None,
+        name=entry['name'],
+        **spectral)
+    data._version = entry['version']
+
+    return data
+
+
+def _read_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+
+    if not os.path.exists(manifest_path):
+        return {'format_version': SESSION_FORMAT_VERSION, 'data': {}}
+
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_session(store, path):
+    """
+    Save the store to a session directory. Each data object is written to its
+    own sub-directory of `.npy` files and described in a JSON manifest. Data
+    objects that have not changed since they were last saved to this session
+    are not written again.
+    """
+    path = os.path.abspath(path)
+    os.makedirs(path, exist_ok=True)
+
+    old_entries = _read_manifest(path)['data']
+    entries = {}
+    written = 0
+
+    # Take a snapshot of the store contents so that the store can keep being
+    # modified while the session is written from another thread
+    for identifier, data in list(dict.items(store)):
+        data_path = os.path.join(path, identifier)
+        old_entry = old_entries.get(identifier)
+
+        if isinstance(data, DeferredData):
+            # Data that was never loaded from this session is unchanged
+            if os.path.abspath(data.path) == data_path:
+                entries[identifier] = data.entry
+                continue
+
+            # Copy the stored arrays of data deferred from another session
+            if os.path.exists(data_path):
+                shutil.rmtree(data_path)
+
+            shutil.copytree(data.path, data_path)
+            entries[identifier] = data.entry
+
+            # Point the placeholder to the copy in case the original is removed
+            data.path = data_path
+            written += 1
+            continue
+
+        if old_entry is not None and old_entry['version'] == data.version \
+                and os.path.exists(data_path):
+            entries[identifier] = old_entry
+            continue
+
+        entries[identifier] = dump_data(data, data_path)
+        written += 1
+
+    # Remove data objects that are no longer in the store
+    for identifier in set(old_entries) - set(entries):
+        shutil.rmtree(os.path.join(path, identifier), ignore_errors=True)
+
+    manifest = {'format_version': SESSION_FORMAT_VERSION,
+                'session_id': store._session_id,
+                'data': entries}
+
+    _replace(os.path.join(path, MANIFEST_NAME),
+             lambda f: f.write(json.dumps(manifest, indent=2).encode()))
+
+    logging.info("Saved session to %s (%d of %d data objects written).",
+                 path, written, len(entries))
+
+
+def open_session(store, path):
+    """
+    Open a session directory into the store. Data objects are not loaded
+    until they are first accessed in the store.
+    """
+    path = os.path.abspath(path)
+    manifest = _read_manifest(path)
+
+    if manifest.get('format_version', 0) > SESSION_FORMAT_VERSION:
+        raise IOError("Session at '{}' was saved with a newer format "
+                      "version.".format(path))
+
+    for identifier, entry in manifest['data'].items():
+        restore_data(store, identifier, DeferredData(
+            identifier, entry, os.path.join(path, identifier)))
+
+    logging.info("Opened session from %s with %d data objects.",
+                 path, len(manifest['data']))
+
+    # Events left in the journal were not part of the last saved snapshot,
+    # e.g. because the server did not shut down cleanly
+    journal = Journal(path)
+
+    if len(journal) > 0:
+        journal.replay(store)
+
+
+def restore_data(store, identifier, data):
+    """
+    Put a data object read from a saved session, or the placeholder of one,
+    into the store. Store listeners are notified of the removal of any data
+    object it replaces and of its registration, with the events flagged as
+    `restored`.
+    """
+    if dict.__contains__(store, identifier):
+        store._discard(identifier)
+        store._notify('unregister', identifier, restored=True)
+
+    dict.__setitem__(store, identifier, data)
+    store._notify('register', identifier, restored=True)
+
+
+def _frozen(array):
+    """
+    Return a copy of an array unless it can not be modified in place, or is
+    backed by a memory-mapped file. Memory-mapped arrays are read from their
+    file by the journal writer rather than copied into memory; changes made
+    to them in the meantime are journalled by later update records anyway.
+    """
+    if array is None or not array.flags.writeable or _memmapped(array):
+        return array
+
+    return np.array(array)
+
+
+def _memmapped(array):
+    """Return whether an array is a view of a memory-mapped array."""
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+
+        array = array.base
+
+    return False
+
+
+def _field_array(data, key):
+    """Return the array of a data object changed by an update of `key`."""
+    if key == 'data':
+        return data.data
+    elif key == 'uncertainty':
+        return data.uncertainty.array
+
+    return data.mask
+
+
+class Journal:
+    """
+    Append-only log of the changes made to the store since the last snapshot
+    of a session. `register` events store the arrays of the new data object,
+    and `update` events the values of the changed index ranges, each in the
+    directory of its own record, so that the session can be recovered by
+    replaying the journal on top of the last snapshot.
+
+    The values of an event are captured when it is recorded, while the files
+    are written in order by a background greenlet in the gevent thread pool,
+    so that recording does not stall RPC handling.
+
+    Parameters
+    ----------
+    path : str
+        The session directory the journal belongs to.
+    """
+    def __init__(self, path):
+        self._path = os.path.join(path, JOURNAL_NAME)
+        self._log_path = os.path.join(self._path, 'journal.log')
+
+        records = self._read()
+        self._sequence = records[-1]['sequence'] + 1 if records else 0
+        self._queue = None
+        self._writer = None
+
+    def __len__(self):
+        return len(self._read())
+
+    @property
+    def sequence(self):
+        """Sequence number of the next recorded event."""
+        return self._sequence
+
+    def _read(self):
+        if not os.path.exists(self._log_path):
+            return []
+
+        records = []
+
+        with open(self._log_path, 'r') as f:
+            for line in f:
+                # A partially written final record is ignored
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+
+        return records
+
+    def _record_path(self, record):
+        return os.path.join(self._path, record['identifier'],
+                            str(record['sequence']))
+
+    def record(self, event, identifier, data=None, diff=None):
+        """
+        Queue an event to be appended to the journal.
+
+        Parameters
+        ----------
+        event : str
+            One of `register`, `update` or `unregister`.
+        identifier : str
+            Identifier of the affected data object.
+        data : `~cosmoscope.data.Data`, optional
+            The data object after a `register` or `update` event.
+        diff : dict, optional
+            The diff returned by `~cosmoscope.store.Store.update` for
+            `update` events. Only the changed values are journalled.
+
+        Returns
+        -------
+        : int
+            The sequence number of the event.
+        """
+        record = {'event': event, 'identifier': identifier,
+                  'sequence': self._sequence}
+        arrays = {}
+        self._sequence += 1
+
+        if event == 'register':
+            arrays, record['entry'] = _describe(data)
+            arrays = {name: _frozen(array) for name, array in arrays.items()}
+        elif event == 'update':
+            record['version'] = data.version
+            record['fields'] = {}
+            record['ranges'] = {}
+
+            if 'name' in diff:
+                record['fields']['name'] = data.name
+            if 'unit' in diff:
+                record['fields']['unit'] = data.unit.to_string()
+            if 'meta' in diff:
+                record['fields']['meta'] = jsonpickle.encode(dict(data.meta))
+
+            # The values of the changed ranges of each array are stored
+            # one after the other
+            for key in ('data', 'uncertainty', 'mask'):
+                if key in diff:
+                    array = _field_array(data, key)
+                    record['ranges'][key] = diff[key]
+                    arrays[key] = np.concatenate(
+                        [array[..., start:stop] for start, stop in diff[key]],
+                        axis=-1)
+
+        self._submit(self._write, record, arrays)
+
+        return record['sequence']
+
+    def _submit(self, function, *args):
+        from gevent.queue import JoinableQueue
+
+        if self._queue is None:
+            self._queue = JoinableQueue()
+            self._writer = gevent.spawn(self._run)
+
+        self._queue.put((function, args))
+
+    def _run(self):
+        threadpool = gevent.get_hub().threadpool
+
+        while True:
+            function, args = self._queue.get()
+
+            try:
+                threadpool.apply(function, args)
+            except Exception:
+                logging.exception("Failed to write to journal %s.",
+                                  self._path)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait for the queued events to be written."""
+        if self._queue is not None:
+            self._queue.join()
+
+    def close(self):
+        """Write the queued events and stop the background writer."""
+        self.flush()
+
+        if self._writer is not None:
+            self._writer.kill()
+            self._writer = self._queue = None
+
+    def _write(self, record, arrays):
+        os.makedirs(self._path, exist_ok=True)
+
+        if arrays or record['event'] == 'register':
+            _write_arrays(arrays, self._record_path(record))
+
+        with open(self._log_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replay(self, store):
+        """Apply the journalled events to the store."""
+        from .store import Store
+
+        records = self._read()
+
+        for record in records:
+            identifier = record['identifier']
+
+            if record['event'] == 'unregister':
+                if dict.__contains__(store, identifier):
+                    store._discard(identifier)
+                    store._notify('unregister', identifier, restored=True)
+            elif record['event'] == 'register':
+                restore_data(store, identifier, DeferredData(
+                    identifier, record['entry'], self._record_path(record)))
+            elif identifier not in store:
+                logging.warning("Skipped journalled update of unknown data "
+                                "object %s.", identifier)
+            else:
+                data = store[identifier]
+                fields = record['fields']
+                diff = dict(record['ranges'])
+
+                if 'name' in fields:
+                    diff['name'], data._name = data.name, fields['name']
+                if 'unit' in fields:
+                    diff['unit'] = str(data.unit or "")
+                    data._unit = Unit(fields['unit'])
+                if 'meta' in fields:
+                    diff['meta'] = data.meta
+                    data.meta = jsonpickle.decode(fields['meta'])
+
+                for key, ranges in record['ranges'].items():
+                    values = np.load(os.path.join(
+                        self._record_path(record), '{}.npy'.format(key)))
+                    offset = 0
+
+                    for start, stop in ranges:
+                        end = offset + stop - start
+                        Store._update_array(data, key, {
+                            'start': start, 'values': values[..., offset:end]})
+                        offset = end
+
+                data._version = record['version']
+
+                store._notify('update', identifier, diff=diff, restored=True)
+
+        logging.info("Replayed %d journalled events from %s.",
+                     len(records), self._path)
+
+    def compact(self, sequence):
+        """
+        Queue the removal of the events before `sequence`, which are covered
+        by a snapshot, and of the arrays they reference.
+        """
+        self._submit(self._compact, sequence)
+
+    def _compact(self, sequence):
+        records = [record for record in self._read()
+                   if record['sequence'] >= sequence]
+
+        if not records:
+            shutil.rmtree(self._path, ignore_errors=True)
+            return
+
+        _replace(self._log_path, lambda f: f.write(''.join(
+            json.dumps(record) + '\n' for record in records).encode()))
+
+        referenced = {self._record_path(record) for record in records}
+
+        for identifier in os.listdir(self._path):
+            identifier_path = os.path.join(self._path, identifier)
+
+            if not os.path.isdir(identifier_path):
+                continue
+
+            for name in os.listdir(identifier_path):
+                if os.path.join(identifier_path, name) not in referenced:
+                    shutil.rmtree(os.path.join(identifier_path, name),
+                                  ignore_errors=True)
+
+            if not os.listdir(identifier_path):
+                os.rmdir(identifier_path)
+
+
+class Autosave:
+    """
+    Background worker that periodically saves the store to a session and
+    journals the changes made in between. Sessions are written from the
+    gevent thread pool so that RPC handling is not stalled.
+
+    Parameters
+    ----------
+    store : `~cosmoscope.store.Store`
+        The store to save.
+    path : str
+        The session directory to save to.
+    interval : float
+        Number of seconds between snapshots.
+    """
+    def __init__(self, store, path, interval=300):
+        self._store = store
+        self._path = path
+        self._interval = interval
+        self._journal = Journal(path)
+        self._greenlet = None
+
+    def start(self):
+        """Start journalling changes and saving snapshots."""
+        self._store.subscribe(self._record)
+        self._greenlet = gevent.spawn(self._run)
+
+        logging.info("Autosaving session to %s every %s seconds.",
+                     self._path, self._interval)
+
+    def stop(self, snapshot=True):
+        """Stop the worker, optionally saving a final snapshot."""
+        self._store.unsubscribe(self._record)
+
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+        if snapshot:
+            self.snapshot()
+
+        self._journal.close()
+
+    def _record(self, event, identifier, **info):
+        # Catalogues are not part of saved sessions, and restored events are
+        # already on disk in the session they were read from
+        if event not in ('register', 'update', 'unregister') \
+                or info.get('restored'):
+            return
+
+        data = self._store[identifier] if event != 'unregister' else None
+
+        self._journal.record(event, identifier, data, info.get('diff'))
+
+    def _run(self):
+        while True:
+            gevent.sleep(self._interval)
+
+            try:
+                self.snapshot()
+            except Exception:
+                logging.exception("Failed to autosave session to %s.",
+                                  self._path)
+
+    def snapshot(self):
+        """Save the store and drop the journalled events it covers."""
+        sequence = self._journal.sequence
+
+        gevent.get_hub().threadpool.apply(
+            save_session, (self._store, self._path))
+
+        self._journal.compact(sequence)
@@ -1,17 +1,26 @@
 """Contains main storage class and related functions."""
-import copy
 import logging
 import uuid
 import os
+import shutil
 import sys
 import glob
+from collections import OrderedDict
 
 import pickle
 import datetime
 
-from .data import Data
+import numpy as np
+from astropy.nddata import StdDevUncertainty
+from astropy.units import Unit
+
+from .catalogue import CATALOGUE_SEPARATOR
+from .session import (DeferredData, dump_data, open_session, restore_data,
+                      save_session)
+from .utils.memmap import release_on_collect
 
 SAVE_PATH = os.path.join(os.path.expanduser("~/.cosmoscope"), "sessions")
+SPILL_PATH = os.path.join(os.path.expanduser("~/.cosmoscope"), "spill")
 
 
 class StoreRegistry(type):
@@ -36,6 +45,21 @@ class Store(dict):
     The store is the centralized location for managing and propagating changes
     throughout the application.
 
+    Attributes
+    ----------
+    memmap_threshold : int or None
+        Data objects whose arrays use at least this many bytes are spilled to
+        memory-mapped files when registered. If `None`, all data is kept in
+        memory.
+    memory_budget : int or None
+        Maximum number of bytes of data arrays to keep in memory. When the
+        budget is exceeded, the least recently used data objects are spilled
+        to disk and transparently loaded again when next accessed. If `None`,
+        data objects are never evicted.
+    stats : dict
+        Counters of the number of evictions, evicted bytes, rehydrations of
+        evicted data objects and the bytes currently held in memory.
+
     Note
     ----
     This data store should not be accessed explicitly and instead should be
@@ -46,10 +70,49 @@ class Store(dict):
         # Define this session's id. This is used for saving and loading
         # serialized data
         self._session_id = str(datetime.datetime.utcnow())
+        self._listeners = []
+        self.memmap_threshold = None
+        self.memory_budget = None
+        self.stats = {'evictions': 0, 'evicted_bytes': 0, 'rehydrations': 0,
+                      'resident_bytes': 0}
+        # Size of the loaded data objects in least to most recently used order
+        self._resident = OrderedDict()
+        # Files that each loaded data object was last loaded from or spilled to
+        self._origins = {}
+        self._evicted = set()
+        # Evicted data objects are spilled to a directory of their own for
+        # each store, removed once the store is collected or on exit
+        self._spill_path = os.path.join(
+            SPILL_PATH, '{}-{}'.format(os.getpid(), uuid.uuid4().hex))
+        release_on_collect(self, self._spill_path)
+        # Catalogues of small spectra, registered as a whole
+        self.catalogues = {}
+
+    def subscribe(self, callback):
+        """
+        Add a callback that is called as ``callback(event, identifier,
+        **info)`` whenever a data object is registered, updated or
+        unregistered. The event is one of `register`, `update` or
+        `unregister`, or `register_catalogue` and `unregister_catalogue` for
+        catalogues. For `update` events, `info` holds the `diff` returned by
+        `update`.
+        """
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        """Remove a callback previously added with `subscribe`."""
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _notify(self, event, identifier, **info):
+        for callback in list(self._listeners):
+            callback(event, identifier, **info)
 
     def open(self, name=None):
         """
-        Opens a saved document and loads it as the current session.
+        Opens a saved document and loads it as the current session. Data
+        objects in the session are only loaded once they are accessed.
         """
         # If no filename given, load the latest stored session
         if name is None:
@@ -67,40 +130,159 @@ class Store(dict):
         else:
             open_path = os.path.join(SAVE_PATH, name)
 
-        if os.path.exists(open_path):
+            # Allow the name to be given without the session file extension
+            if not os.path.exists(open_path):
+                open_path = "{:s}.csm".format(open_path)
+
+        if os.path.isdir(open_path):
+            open_session(self, open_path)
+        elif os.path.exists(open_path):
+            # Sessions saved before the directory format are pickled stores
             with open(open_path, 'rb') as f:
-                self.update(pickle.load(f))
+                for identifier, data in pickle.load(f).items():
+                    restore_data(self, identifier, data)
         else:
             raise IOError("No file named '%s'.", name)
 
     def save(self, filename=None):
         """
-        Serializes the current document to the users' drive.
+        Serializes the current document to the users' drive. Saving to an
+        existing session only rewrites the data objects that have changed
+        since it was last saved.
         """
         file_path = os.path.join(SAVE_PATH, "{:s}.csm".format(filename or self._session_id))
 
         if not os.path.exists(SAVE_PATH):
-            os.mkdir(SAVE_PATH)
+            os.makedirs(SAVE_PATH)
 
-        with open(file_path, 'wb') as f:
-            pickle.dump(self, f)
+        save_session(self, file_path)
 
     def __getitem__(self, key):
         """
-        Retrieve a data object from the database.
+        Retrieve a data object from the database. Data objects from an opened
+        session are loaded on first access.
 
         Returns
         -------
         : `~cosmoscope.core.data.Data`
             The data object.
         """
+        # Spectra of catalogues are materialized on demand
+        member = self._catalogue_member(key)
+
+        if member is not None:
+            catalogue, index = member
+
+            return catalogue.spectrum(index)
+
         data = super(Store, self).__getitem__(key)
 
+        if isinstance(data, DeferredData):
+            if key in self._evicted:
+                self._evicted.discard(key)
+                self.stats['rehydrations'] += 1
+
+            self._origins[key] = data
+            data = data.load(mmap_threshold=self.memmap_threshold)
+            super(Store, self).__setitem__(key, data)
+
         if data is None:
             logging.error("No stored data set with id %s", key)
+        else:
+            self._touch(key, data)
 
         return data
 
+    def __contains__(self, key):
+        return dict.__contains__(self, key) \
+            or self._catalogue_member(key) is not None
+
+    def _catalogue_member(self, key):
+        """
+        Return the catalogue and index of the catalogue spectrum addressed by
+        a key of the form ``<catalogue identifier>/<index>``, or `None` if
+        the key does not address one.
+        """
+        if not isinstance(key, str) or CATALOGUE_SEPARATOR not in key \
+                or dict.__contains__(self, key):
+            return None
+
+        catalogue_id, _, index = key.partition(CATALOGUE_SEPARATOR)
+        catalogue = self.catalogues.get(catalogue_id)
+
+        try:
+            index = int(index)
+        except ValueError:
+            return None
+
+        if catalogue is None or not -len(catalogue) <= index < len(catalogue):
+            return None
+
+        return catalogue, index
+
+    def _touch(self, identifier, data):
+        """
+        Mark the data object as most recently used and evict the least
+        recently used data objects if the memory budget is exceeded.
+        """
+        nbytes = 0 if data.is_memmapped else data.nbytes
+
+        self.stats['resident_bytes'] += nbytes - self._resident.pop(
+            identifier, 0)
+        self._resident[identifier] = nbytes
+
+        if self.memory_budget is None:
+            return
+
+        for old_identifier in list(self._resident):
+            if self.stats['resident_bytes'] <= self.memory_budget:
+                break
+
+            # Never evict the data object that is being accessed, nor
+            # memory-mapped ones, which do not count towards the budget
+            if old_identifier != identifier \
+                    and self._resident[old_identifier] > 0:
+                self.evict(old_identifier)
+
+    def evict(self, identifier):
+        """
+        Spill a data object to disk and drop it from memory. The data object
+        is loaded again the next time it is accessed in the store. Data that
+        has not changed since it was loaded is not written again, and
+        memory-mapped data objects are not evicted.
+        """
+        data = super(Store, self).get(identifier)
+
+        # Memory-mapped data objects are already backed by their files
+        if data is None or isinstance(data, DeferredData) \
+                or data.is_memmapped:
+            return
+
+        origin = self._origins.get(identifier)
+
+        if origin is None or origin.version != data.version \
+                or not os.path.isdir(origin.path):
+            path = os.path.join(self._spill_path, identifier)
+            origin = DeferredData(identifier, dump_data(data, path), path)
+
+        super(Store, self).__setitem__(identifier, origin)
+        self._evicted.add(identifier)
+
+        nbytes = self._resident.pop(identifier, 0)
+        self.stats['resident_bytes'] -= nbytes
+        self.stats['evicted_bytes'] += nbytes
+        self.stats['evictions'] += 1
+
+        logging.debug("Data object with id %s has been evicted to %s.",
+                      identifier, origin.path)
+
+    def get(self, key, default=None):
+        """
+        Retrieve a data object from the database, or `default` if there is
+        no data object with the given identifier.
+        """
+        return self[key] if key in self else default
+
     def register(self, data, overwrite=False):
         """
         Register `Data` object to be tracked by the database.
@@ -109,46 +291,249 @@ class Store(dict):
 
         if data.identifier in self and not overwrite:
             logging.warning("Data with identifier '%s' already exists in "
-                "database. Pass 'overwrite=True' to overwrite.")
+                            "database. Pass 'overwrite=True' to overwrite.",
+                            data.identifier)
             return
 
-        super(Store, self).__setitem__(data.identifier, data)
+        self._insert(data)
 
         logging.info("Data object has been added to database with id %s",
                      data.identifier)
 
+    def register_many(self, datasets, overwrite=False):
+        """
+        Register many `Data` objects at once. A single message is logged for
+        all of them, rather than one per data object as with `register`.
+        Listeners are notified of each data object as it is added, so those
+        added before an error raised while consuming `datasets` are not
+        missed.
+
+        Returns
+        -------
+        : list
+            The identifiers of the registered data objects.
+        """
+        registered, skipped = [], 0
+
+        try:
+            for data in datasets:
+                if data.identifier in self and not overwrite:
+                    skipped += 1
+                    continue
+
+                self._insert(data)
+                registered.append(data.identifier)
+        finally:
+            if skipped:
+                logging.warning("%d data objects already exist in database. "
+                                "Pass 'overwrite=True' to overwrite.", skipped)
+
+            logging.info("%d data objects have been added to database.",
+                         len(registered))
+
+        return registered
+
+    def _insert(self, data):
+        """
+        Add a data object, memory-mapping it if it is larger than the memory
+        map threshold, and notify the listeners.
+        """
+        if self.memmap_threshold is not None \
+                and data.nbytes >= self.memmap_threshold:
+            data.to_memmap()
+
+        super(Store, self).__setitem__(data.identifier, data)
+        self._touch(data.identifier, data)
+
+        self._notify('register', data.identifier)
+
     def update(self, identifier, update_dict):
         """
-        Updates the given storage pointer to a new data set.
+        Updates the given storage pointer to a new data set. Changes are
+        applied to the arrays of the stored data object in place, and only
+        the changed fields and index ranges are compared, so the cost of an
+        update is proportional to the size of the change.
+
+        Parameters
+        ----------
+        identifier : str
+            Identifier of the data object. Spectra of catalogues can not be
+            updated.
+        update_dict : dict
+            Fields to update, using the keys of `Data.to_dict`. The `name`,
+            `unit` and `meta` fields are replaced. The `data`, `uncertainty`
+            and `mask` fields take either a full array, or a dict with a
+            `start` index and the `values` to write from that index onwards.
 
         Returns
         -------
         : dict
             A python `dict` holding the differences between the old and new
-            data objects.
+            data objects. Scalar fields map to their previous value, array
+            fields to a list of ``[start, stop)`` index ranges that changed.
+        """
+        # Spectra of catalogues are read-only views on the catalogue buffers
+        if self._catalogue_member(identifier) is not None:
+            raise KeyError("Spectrum '{}' of a catalogue can not be "
+                           "updated.".format(identifier))
+
+        data = self[identifier]
+        diff = {}
+
+        for key, value in update_dict.items():
+            if key in ('data', 'uncertainty', 'mask'):
+                ranges = self._update_array(data, key, value)
+
+                if ranges:
+                    diff[key] = ranges
+            elif key == 'name':
+                if value != data.name:
+                    diff[key], data._name = data.name, value
+            elif key == 'unit':
+                if Unit(value) != data.unit:
+                    diff[key] = str(data.unit or "")
+                    data._unit = Unit(value)
+            elif key == 'meta':
+                if value != data.meta:
+                    diff[key], data.meta = data.meta, value
+            else:
+                raise KeyError("Data field '{}' can not be updated.".format(
+                    key))
+
+        if diff:
+            # Invalidate anything derived from the previous version of the data
+            data._version += 1
+
+            self._notify('update', identifier, diff=diff)
+
+        return diff
+
+    @staticmethod
+    def _update_array(data, key, value):
+        """
+        Write new values into one of the arrays of a data object in place and
+        return the index ranges that changed.
         """
-        data = self.get(identifier).to_dict()
+        start = 0
+
+        if isinstance(value, dict):
+            start, value = value.get('start', 0), value['values']
+
+            # Negative indices would silently write from the end
+            if start < 0:
+                raise ValueError("Update of '{}' can not start at negative "
+                                 "index {}.".format(key, start))
+
+        value = np.asanyarray(value)
+
+        if key == 'data':
+            array = data.data
+        elif key == 'uncertainty':
+            if data.uncertainty is None:
+                data.uncertainty = StdDevUncertainty(
+                    np.zeros(data.data.shape))
+            array = data.uncertainty.array
+        else:
+            if data.mask is None:
+                data.mask = np.zeros(data.data.shape, dtype=bool)
+            array = data.mask
+
+        # Replacing an array with itself changes nothing
+        if value is array:
+            return []
+
+        stop = start + value.shape[-1] if value.ndim > 0 else array.shape[-1]
+
+        if stop > array.shape[-1]:
+            raise ValueError("Update of '{}' does not fit in an array of "
+                             "length {}.".format(key, array.shape[-1]))
 
-        # Create a deep copy of the current data object so that it can be
-        # compared with the updated data object, and the differences returned
-        data_copy = copy.deepcopy(data)
+        ranges = _changed_ranges(array[..., start:stop], value, offset=start)
 
-        # Update the store dictionary object
-        data.update(update_dict)
+        if ranges:
+            if not array.flags.writeable:
+                array = array.copy()
 
-        return {k: data_copy[k] for k in set(data) - set(data_copy)}
+                if key == 'data':
+                    data._data = array
+                elif key == 'uncertainty':
+                    data.uncertainty.array = array
+                else:
+                    data.mask = array
+
+            array[..., start:stop] = value
+
+        return ranges
 
     def unregister(self, identifier):
         """
-        Removes data object tracking from the database.
+        Removes data object tracking from the database. Spectra of catalogues
+        are only removed with their catalogue.
         """
-        if self.get(identifier) is not None:
-            del self[identifier]
+        if dict.__contains__(self, identifier):
+            self._discard(identifier)
 
             logging.info(
                 "Data object with id %s has been removed from database.",
                 identifier)
 
+            self._notify('unregister', identifier)
+
+    def _discard(self, identifier):
+        """
+        Remove a data object and its memory bookkeeping without notifying the
+        listeners.
+        """
+        dict.pop(self, identifier, None)
+
+        self.stats['resident_bytes'] -= self._resident.pop(identifier, 0)
+        self._origins.pop(identifier, None)
+        self._evicted.discard(identifier)
+        shutil.rmtree(os.path.join(self._spill_path, identifier),
+                      ignore_errors=True)
+
+    def register_catalogue(self, catalogue):
+        """
+        Register a `~cosmoscope.catalogue.Catalogue` and all of its spectra
+        at once. Its spectra are retrieved with identifiers of the form
+        ``<catalogue identifier>/<index>``.
+        """
+        self.catalogues[catalogue.identifier] = catalogue
+
+        logging.info("Catalogue of %d spectra has been added to database "
+                     "with id %s", len(catalogue), catalogue.identifier)
+
+        self._notify('register_catalogue', catalogue.identifier)
+
+    def unregister_catalogue(self, identifier):
+        """Removes a catalogue and its spectra from the database."""
+        if self.catalogues.pop(identifier, None) is not None:
+            logging.info("Catalogue with id %s has been removed from "
+                         "database.", identifier)
+
+            self._notify('unregister_catalogue', identifier)
+
+
+def _changed_ranges(old, new, offset=0):
+    """
+    Return the ``[start, stop)`` index ranges along the last axis where two
+    arrays differ. NaN values are considered equal to each other.
+    """
+    changed = np.asarray(old != new)
+
+    if changed.dtype == bool and np.issubdtype(np.result_type(old, new),
+                                               np.inexact):
+        changed &= ~(np.isnan(old) & np.isnan(new))
+
+    changed = np.broadcast_to(changed, np.broadcast(old, new).shape)
+    changed = changed.reshape(-1, changed.shape[-1]).any(axis=0) \
+        if changed.ndim > 1 else np.atleast_1d(changed)
+
+    edges = np.flatnonzero(np.diff(np.concatenate(
+        ([False], changed, [False])).astype(np.int8)))
+
+    return (edges.reshape(-1, 2) + offset).tolist()
+
 
 # Initialize the cosmoscope store
 store = Store()
\ No newline at end of file
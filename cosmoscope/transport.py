@@ -0,0 +1,107 @@
+"""Contains binary array packing used when passing data along RPC."""
+import struct
+
+import msgpack
+import numpy as np
+from astropy.units import Quantity
+
+__all__ = ['ARRAY_EXT_CODE', 'pack_array', 'unpack_array', 'unpack']
+
+# The msgpack extension type code used to tag packed numpy arrays
+ARRAY_EXT_CODE = 42
+
+# Header length prefix, stored as a little-endian unsigned int
+_HEADER_LENGTH = struct.Struct('<I')
+
+
+def pack_array(array, unit=None):
+    """
+    Pack an array into a msgpack extension type. The extension payload holds a
+    small msgpack header with the dtype, shape and unit of the array, followed
+    by the raw array buffer.
+
+    Parameters
+    ----------
+    array : `~numpy.ndarray` or `~astropy.units.Quantity`
+        The array to pack. If a quantity is given, its unit is stored in the
+        header unless `unit` is explicitly provided.
+    unit : str or `~astropy.units.Unit`, optional
+        The unit to associate with the array.
+
+    Returns
+    -------
+    : `~msgpack.ExtType`
+        The packed array.
+    """
+    if isinstance(array, Quantity):
+        unit = array.unit if unit is None else unit
+        array = array.value
+
+    # Unlike `np.ascontiguousarray`, keeps the shape of 0-d arrays
+    array = np.require(array, requirements='C')
+
+    if array.dtype.hasobject:
+        raise TypeError("Arrays of python objects can not be packed.")
+
+    header = msgpack.packb(
+        (array.dtype.str, array.shape,
+         unit.to_string() if hasattr(unit, 'to_string') else unit),
+        use_bin_type=True)
+
+    payload = b''.join((_HEADER_LENGTH.pack(len(header)), header,
+                        memoryview(array.reshape(-1)).cast('B')))
+
+    return msgpack.ExtType(ARRAY_EXT_CODE, payload)
+
+
+def unpack_array(ext):
+    """
+    Unpack an array previously packed with `pack_array`. The returned array is
+    a read-only view on the received buffer; no per-element python objects are
+    created. Copy the array, e.g. with `numpy.array`, before modifying it.
+
+    Parameters
+    ----------
+    ext : `~msgpack.ExtType` or bytes
+        The packed extension type, or its raw payload.
+
+    Returns
+    -------
+    : `~numpy.ndarray` or `~astropy.units.Quantity`
+        The unpacked array. A quantity is returned if a unit was packed.
+    """
+    if isinstance(ext, msgpack.ExtType):
+        if ext.code != ARRAY_EXT_CODE:
+            raise TypeError("Unknown extension type code {}.".format(ext.code))
+
+        ext = ext.data
+
+    payload = memoryview(ext)
+    header_length, = _HEADER_LENGTH.unpack_from(payload)
+    offset = _HEADER_LENGTH.size + header_length
+
+    dtype, shape, unit = msgpack.unpackb(
+        payload[_HEADER_LENGTH.size:offset], raw=False)
+
+    array = np.frombuffer(payload, dtype=dtype, offset=offset).reshape(shape)
+
+    if unit is not None:
+        return Quantity(array, unit=unit, copy=False)
+
+    return array
+
+
+def unpack(obj):
+    """
+    Recursively unpack any array extension types contained in the given
+    object, e.g. the dictionary returned by `ServerAPI.query_data`. As with
+    `unpack_array`, the unpacked arrays are read-only.
+    """
+    if isinstance(obj, msgpack.ExtType) and obj.code == ARRAY_EXT_CODE:
+        return unpack_array(obj)
+    elif isinstance(obj, dict):
+        return {k: unpack(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(unpack(x) for x in obj)
+
+    return obj
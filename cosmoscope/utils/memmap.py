@@ -0,0 +1,59 @@
+"""Contains helpers for backing arrays with memory-mapped files."""
+import os
+import shutil
+import weakref
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+__all__ = ['MEMMAP_PATH', 'to_memmap', 'release_on_collect']
+
+MEMMAP_PATH = os.path.join(os.path.expanduser("~/.cosmoscope"), "arrays")
+
+
+def to_memmap(array, path):
+    """
+    Write an array to a `.npy` file and return it re-opened as a writable
+    memory-mapped array. Only the pages of the returned array that are
+    actually accessed are read back into memory.
+
+    Parameters
+    ----------
+    array : `~numpy.ndarray`
+        The array to spill to disk.
+    path : str
+        Path of the `.npy` file.
+
+    Returns
+    -------
+    : `~numpy.memmap`
+        The memory-mapped array.
+    """
+    array = np.asanyarray(array)
+
+    # Nothing to do if the array already lives in this file
+    if isinstance(array, np.memmap) and array.filename is not None \
+            and os.path.abspath(array.filename) == os.path.abspath(path):
+        return array
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    mapped = open_memmap(path, mode='w+', dtype=array.dtype, shape=array.shape)
+    mapped[...] = array
+    mapped.flush()
+
+    return mapped
+
+
+def release_on_collect(obj, path):
+    """
+    Remove the file or directory at `path` once `obj` has been garbage
+    collected.
+    """
+    def remove(path=path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    return weakref.finalize(obj, remove)
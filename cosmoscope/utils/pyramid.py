@@ -0,0 +1,129 @@
+"""Contains multi-resolution min/max pyramids used for decimating data."""
+import numpy as np
+
+__all__ = ['Pyramid']
+
+
+class Pyramid:
+    """
+    Multi-resolution min/max envelope of a one-dimensional array. Level `n`
+    of the pyramid holds the minimum and maximum of consecutive blocks of
+    ``factor ** (n + 1)`` samples, so the whole pyramid costs less memory than
+    the original array.
+
+    Parameters
+    ----------
+    array : `~numpy.ndarray`
+        The one-dimensional array to decimate.
+    factor : int
+        The reduction factor between consecutive levels.
+    """
+    def __init__(self, array, factor=4):
+        if factor < 2:
+            raise ValueError("Pyramid reduction factor must be at least 2.")
+
+        self._array = np.asarray(array).ravel()
+        self._factor = factor
+        self._levels = []
+
+        mins = maxs = self._array
+
+        while len(mins) > 1:
+            mins = self._reduce(mins, np.fmin)
+            maxs = self._reduce(maxs, np.fmax)
+            self._levels.append((mins, maxs))
+
+    def _reduce(self, array, ufunc):
+        # The last block may hold fewer than `factor` elements
+        size = len(array) // self._factor * self._factor
+        reduced = ufunc.reduce(array[:size].reshape(-1, self._factor), axis=1)
+
+        if size < len(array):
+            reduced = np.append(reduced, ufunc.reduce(array[size:]))
+
+        return reduced
+
+    @property
+    def nbytes(self):
+        """Return the number of bytes used by the pyramid levels."""
+        return sum(mins.nbytes + maxs.nbytes for mins, maxs in self._levels)
+
+    def decimate(self, start, stop, n_pixels):
+        """
+        Return the min/max envelope of the array between `start` and `stop`
+        in (at most) `n_pixels` bins. Each bin is covered by the blocks of
+        the coarsest level no larger than a bin, and the parts of the bin
+        that do not fill a whole block by blocks of finer levels, so the cost
+        depends on the number of bins rather than the number of samples.
+
+        Returns
+        -------
+        edges : `~numpy.ndarray`
+            Index of the first sample of each bin.
+        mins, maxs : `~numpy.ndarray`
+            Minimum and maximum of the samples in each bin, ignoring NaNs.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self._array))
+        n_samples = max(stop - start, 0)
+
+        if n_pixels < 1:
+            raise ValueError("Number of pixels must be positive.")
+
+        # Nothing to reduce, send the raw samples
+        if n_samples <= n_pixels:
+            values = self._array[start:stop]
+
+            return np.arange(start, stop), values, values
+
+        edges = start + np.arange(n_pixels) * n_samples // n_pixels
+        samples_per_pixel = n_samples // n_pixels
+
+        # Find the coarsest level with blocks no larger than a pixel
+        level, block_size = -1, 1
+
+        while level + 1 < len(self._levels) \
+                and block_size * self._factor <= samples_per_pixel:
+            level += 1
+            block_size *= self._factor
+
+        mins = np.full(n_pixels, np.nan)
+        maxs = np.full(n_pixels, np.nan)
+
+        # Ranges of samples of each bin not yet reduced
+        bins = np.arange(n_pixels)
+        lower, upper = edges, np.append(edges[1:], stop)
+
+        while len(bins):
+            level_mins, level_maxs = self._levels[level] if level >= 0 \
+                else (self._array, self._array)
+
+            # Whole blocks of the level within each range
+            first = -(-lower // block_size)
+            last = upper // block_size
+
+            for offset in range(int(np.max(last - first, initial=0))):
+                index = first + offset
+                within = index < last
+                index = np.where(within, index, 0)
+
+                np.fmin.at(mins, bins[within], level_mins[index[within]])
+                np.fmax.at(maxs, bins[within], level_maxs[index[within]])
+
+            # The samples before and after the whole blocks are left to the
+            # finer levels
+            covered = first < last
+            head_upper = np.where(covered, first * block_size, upper)
+            tail_lower = np.where(covered, last * block_size, upper)
+
+            bins = np.concatenate([bins, bins])
+            lower = np.concatenate([lower, tail_lower])
+            upper = np.concatenate([head_upper, upper])
+
+            remaining = lower < upper
+            bins, lower, upper = \
+                bins[remaining], lower[remaining], upper[remaining]
+
+            level -= 1
+            block_size //= self._factor
+
+        return edges, mins, maxs
@@ -23,8 +23,10 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     description="Back-end server to handle astronomical operations and pass information to connected clients",
     entry_points={
@@ -39,6 +41,7 @@ setup(
     keywords='cosmoscope',
     name='cosmoscope',
     packages=find_packages(include=['cosmoscope']),
+    python_requires='>=3.8',
     setup_requires=setup_requirements,
     test_suite='tests',
     tests_require=test_requirements,
@@ -0,0 +1,65 @@
+"""Tests for `cosmoscope.operations.cache`."""
+import os
+
+import numpy as np
+import astropy.units as u
+import pytest
+
+from cosmoscope.data import Data
+from cosmoscope.mixins import deferred_registration
+from cosmoscope.operations.cache import ResultCache, content_key
+
+
+def test_data_objects_are_hashed_by_identifier_and_version():
+    with deferred_registration():
+        data = Data(np.arange(3.) * u.Jy, spectral_axis=np.arange(3.) * u.AA)
+
+    key = content_key(data)
+    data._version += 1
+
+    assert content_key(data) != key
+
+
+def test_sequences_are_hashed_by_type_and_content():
+    assert content_key([1, 2, 3]) == content_key([1, 2, 3])
+    assert content_key([1, 2, 3]) != content_key((1, 2, 3))
+    assert content_key([1, 2, 3]) != content_key([1, 2, 4])
+    assert content_key(['1', 2]) != content_key([1, 2])
+    assert content_key([1 * u.AA]) != content_key([1 * u.nm])
+
+
+def test_unhashable_values_raise():
+    with pytest.raises(TypeError):
+        content_key(object())
+
+
+def test_first_caller_keeps_a_writable_result():
+    cache = ResultCache()
+    result = np.arange(3.)
+
+    cache.put('key', result, {}, ())
+    result[0] = 10
+
+    cached, _ = cache.get('key', ())
+
+    assert result.flags.writeable
+    assert not cached.flags.writeable
+    assert cached.tolist() == [0., 1., 2.]
+
+
+def test_disk_usage_is_tracked_without_listing(tmp_path, monkeypatch):
+    cache = ResultCache(memory_budget=0, path=str(tmp_path),
+                        disk_budget=3000)
+    listed = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir',
+                        lambda path: listed.append(path) or listdir(path))
+
+    for index in range(5):
+        cache.put('key{}'.format(index), np.zeros(100), {}, ())
+
+    # The directory is only listed once, and the oldest results are removed
+    assert len(listed) == 1
+    assert sorted(os.listdir(str(tmp_path))) == ['key3.npz', 'key4.npz']
+    assert cache.stats['disk_bytes'] == sum(
+        os.path.getsize(str(path)) for path in tmp_path.iterdir())
@@ -0,0 +1,95 @@
+"""Tests for `cosmoscope.interface.client`."""
+import msgpack
+import numpy as np
+import astropy.units as u
+import pytest
+
+from cosmoscope.data import Data
+from cosmoscope.interface.client import SubscriberAPI
+from cosmoscope.server import ServerAPI
+from cosmoscope.store import store
+
+
+def roundtrip(obj):
+    # Messages reach the client with arrays still packed in extension types
+    return msgpack.unpackb(msgpack.packb(obj, use_bin_type=True), raw=False)
+
+
+class Client:
+    def __init__(self, server):
+        self.server = server
+        self.queries = 0
+
+    def query_data(self, identifier, binary):
+        self.queries += 1
+
+        return roundtrip(self.server.query_data(identifier, binary))
+
+
+class Publisher:
+    def __init__(self, subscriber):
+        self.subscriber = subscriber
+        self.connected = True
+
+    def data_updated(self, identifier, delta):
+        if self.connected:
+            self.subscriber.data_updated(identifier, roundtrip(delta))
+
+    def data_removed(self, identifier):
+        self.subscriber.data_removed(identifier)
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    server = ServerAPI()
+    subscriber = SubscriberAPI()
+    client = Client(server)
+    publisher = Publisher(subscriber)
+
+    monkeypatch.setattr(subscriber, 'client', client)
+    monkeypatch.setattr(subscriber, 'replicas', {})
+    monkeypatch.setattr(server, 'publisher', publisher)
+    store.subscribe(server.publish_change)
+
+    data = Data(np.arange(10.) * u.Jy,
+                spectral_axis=np.linspace(4000., 5000., 10) * u.AA)
+
+    yield subscriber, client, publisher, data
+
+    store.unsubscribe(server.publish_change)
+
+    if data.identifier in store:
+        store.unregister(data.identifier)
+
+
+def test_updates_patch_the_replica(replica):
+    subscriber, client, _, data = replica
+    local = subscriber.watch(data.identifier)
+
+    store.update(data.identifier, {'data': {'start': 3, 'values': [0.]},
+                                   'name': 'renamed'})
+
+    assert client.queries == 1
+    assert local['version'] == data.version
+    assert local['name'] == 'renamed'
+    np.testing.assert_array_equal(local['flux'], data.flux.value)
+
+
+def test_missed_updates_reload_the_replica(replica):
+    subscriber, client, publisher, data = replica
+    subscriber.watch(data.identifier)
+
+    publisher.connected = False
+    store.update(data.identifier, {'data': {'start': 3, 'values': [0.]}})
+    publisher.connected = True
+    store.update(data.identifier, {'data': {'start': 5, 'values': [0.]}})
+
+    local = subscriber.replicas[data.identifier]
+
+    assert client.queries == 2
+    assert local['version'] == data.version
+    np.testing.assert_array_equal(local['flux'], data.flux.value)
+
+    store.unregister(data.identifier)
+
+    assert data.identifier not in subscriber.replicas
@@ -0,0 +1,96 @@
+"""Tests for `cosmoscope.operations.coadd`."""
+import numpy as np
+import astropy.units as u
+import pytest
+from astropy.nddata import StdDevUncertainty
+
+from cosmoscope.data import Data
+from cosmoscope.operations.coadd import coadd_data
+from cosmoscope.store import store
+
+SPECTRAL_AXIS = np.linspace(4000., 5000., 50) * u.AA
+
+
+@pytest.fixture
+def spectra():
+    state = np.random.RandomState(0)
+    flux = state.normal(10, 1, (7, 50))
+    sigma = state.uniform(0.5, 2, flux.shape)
+    mask = state.uniform(size=flux.shape) < 0.1
+    flux[2, 5] = np.nan
+
+    identifiers = [Data(flux[i] * u.Jy, spectral_axis=SPECTRAL_AXIS,
+                        uncertainty=StdDevUncertainty(sigma[i]),
+                        mask=mask[i]).identifier
+                   for i in range(len(flux))]
+
+    yield identifiers, np.ma.masked_array(flux, mask | np.isnan(flux)), sigma
+
+    for identifier in identifiers:
+        store.unregister(identifier)
+
+
+def coadd(identifiers, **kwargs):
+    identifier = coadd_data(identifiers, **kwargs)
+    result = store[identifier]
+    store.unregister(identifier)
+
+    return result
+
+
+def test_mean(spectra):
+    identifiers, flux, _ = spectra
+
+    result = coadd(identifiers, weighted=False)
+
+    np.testing.assert_allclose(result.flux.value, flux.mean(axis=0))
+
+
+def test_weighted_mean(spectra):
+    identifiers, flux, sigma = spectra
+
+    result = coadd(identifiers)
+
+    np.testing.assert_allclose(result.flux.value,
+                               np.ma.average(flux, axis=0,
+                                             weights=sigma ** -2))
+    np.testing.assert_allclose(
+        result.uncertainty.array,
+        np.sqrt(1 / np.ma.masked_array(sigma ** -2, flux.mask).sum(axis=0)))
+
+
+def test_clipped_mean(spectra):
+    identifiers, flux, _ = spectra
+    flux = np.ma.concatenate([flux, np.full((1, 50), 1e3)])
+    outlier = Data(flux[-1].data * u.Jy,
+                   spectral_axis=SPECTRAL_AXIS).identifier
+
+    try:
+        result = coadd(identifiers + [outlier], method='clipped_mean',
+                       weighted=False, sigma=2)
+    finally:
+        store.unregister(outlier)
+
+    # Each pass rejects values relative to the mean and spread of the
+    # values kept by the previous pass
+    clipped = flux
+
+    for _ in range(5):
+        mean, spread = clipped.mean(axis=0), clipped.std(axis=0)
+        clipped = np.ma.masked_where(np.abs(flux - mean) > 2 * spread, flux)
+
+    assert clipped.mask[-1].all()
+    np.testing.assert_allclose(result.flux.value, clipped.mean(axis=0))
+
+
+def test_median(spectra, monkeypatch):
+    identifiers, flux, _ = spectra
+
+    # Split the spectral axis into several blocks
+    monkeypatch.setattr('cosmoscope.operations.coadd.MEDIAN_BUDGET', 8 * 64)
+
+    result = coadd(identifiers, method='median')
+
+    np.testing.assert_allclose(result.flux.value,
+                               np.ma.median(flux, axis=0))
+    assert not result.mask.any()
@@ -0,0 +1,44 @@
+"""Tests for `cosmoscope.operations.convolution`."""
+import numpy as np
+import pytest
+from astropy.convolution import Box1DKernel, Gaussian1DKernel
+from astropy.convolution import convolve as astropy_convolve
+
+from cosmoscope.operations.convolution import (blockwise_convolve,
+                                               fft_convolve)
+
+
+@pytest.mark.parametrize('n_samples', [50, 1000, 20000])
+@pytest.mark.parametrize('kernel', [Box1DKernel(5), Gaussian1DKernel(3),
+                                    Gaussian1DKernel(40)])
+@pytest.mark.parametrize('nans', [False, True])
+def test_fft_convolve_matches_astropy(n_samples, kernel, nans):
+    array = np.random.RandomState(0).normal(size=n_samples)
+
+    if nans:
+        array[::7] = np.nan
+        array[10:30] = np.nan
+
+    np.testing.assert_allclose(fft_convolve(array, kernel),
+                               astropy_convolve(array, kernel),
+                               rtol=1e-7, atol=1e-10)
+
+
+def test_fft_convolve_rows():
+    array = np.random.RandomState(0).normal(size=(3, 500))
+    array[1, ::5] = np.nan
+    kernel = Gaussian1DKernel(4)
+
+    np.testing.assert_allclose(
+        fft_convolve(array, kernel),
+        [astropy_convolve(row, kernel) for row in array], atol=1e-10)
+
+
+def test_blockwise_convolve_matches_whole_array():
+    array = np.random.RandomState(0).normal(size=5000)
+    array[::11] = np.nan
+    kernel = Box1DKernel(9)
+
+    np.testing.assert_allclose(
+        blockwise_convolve(array, kernel, block_size=700),
+        astropy_convolve(array, kernel), atol=1e-10)
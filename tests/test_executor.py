@@ -0,0 +1,60 @@
+"""Tests for `cosmoscope.operations.executor`."""
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import astropy.units as u
+import pytest
+
+from cosmoscope.operations import executor as executor_module
+from cosmoscope.operations.executor import Executor
+from cosmoscope.operations.operation import FunctionalOperation
+
+
+def scale(data, factor, context, offset=0):
+    # Run in a worker process, imported from this module
+    context['old_data'] = data
+    context['offset'] = np.full(data.shape, offset)
+
+    return data * factor + offset * data.unit
+
+
+@pytest.fixture
+def executor():
+    executor = Executor()
+    executor.configure(1)
+
+    yield executor
+
+    executor.shutdown()
+
+
+def test_operations_run_in_a_worker_process(executor, monkeypatch):
+    released = []
+    release = executor_module._SharedArray.release
+
+    def spy(self):
+        released.append(self.name)
+        release(self)
+
+    monkeypatch.setattr(executor_module._SharedArray, 'release', spy)
+
+    data = np.arange(5.) * u.Jy
+    context = {}
+
+    result = executor.run(FunctionalOperation(scale), (data, 2.),
+                          {'offset': 1}, context)
+
+    assert result.unit == u.Jy
+    np.testing.assert_array_equal(result.value, [1., 3., 5., 7., 9.])
+
+    # Context values that are arguments are not sent back, the others are
+    # copied out of shared memory
+    assert context['old_data'] is data
+    np.testing.assert_array_equal(context['offset'], np.ones(5))
+
+    # The blocks of the argument, the context value and the result are freed
+    assert len(released) == 3
+
+    for name in released:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=name)
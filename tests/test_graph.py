@@ -0,0 +1,41 @@
+"""Tests for `cosmoscope.operations.graph`."""
+import numpy as np
+import astropy.units as u
+import pytest
+
+from cosmoscope.data import Data
+from cosmoscope.operations.arithmetic import scale_data
+from cosmoscope.operations.graph import LazyOperation, graph
+from cosmoscope.operations.history import histories
+from cosmoscope.store import store
+
+
+def test_lazy_undo_does_not_move_other_sessions_operations():
+    data = Data(np.arange(4.) * u.Jy, spectral_axis=np.arange(4.) * u.AA)
+    identifier = data.identifier
+    scale = LazyOperation(scale_data)
+
+    try:
+        scale.invoke((identifier, 2.), {}, session='a')
+        scale.invoke((identifier, 10.), {}, session='b')
+
+        # The operation of session a is not the head of the pipeline
+        with pytest.raises(ValueError):
+            histories.undo('a', identifier)
+
+        assert len(histories.get('a', identifier)) == 1
+
+        histories.undo('b', identifier)
+        histories.undo('a', identifier)
+        assert graph.pipelines[identifier].position == 0
+
+        histories.redo('a', identifier)
+        graph.materialize(identifier)
+        np.testing.assert_array_equal(data.data, [0., 2., 4., 6.])
+
+        # The source is kept once the data object is changed
+        histories.undo('a', identifier)
+        graph.materialize(identifier)
+        np.testing.assert_array_equal(data.data, [0., 1., 2., 3.])
+    finally:
+        store.unregister(identifier)
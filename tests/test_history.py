@@ -0,0 +1,40 @@
+"""Tests for `cosmoscope.operations.history`."""
+import numpy as np
+
+from cosmoscope.operations.history import Histories, HistoryEntry
+
+
+class Operation:
+    name = 'operation'
+
+
+def make_entry(session, identifier):
+    values = np.random.RandomState(0).uniform(size=1000)
+
+    return HistoryEntry(Operation(), {'values': values}, session=session,
+                        identifier=identifier)
+
+
+def test_budget_is_shared_by_all_histories():
+    histories = Histories(budget=20000, spill=False)
+
+    for session, identifier in [('a', 'x'), ('b', 'x'), ('a', 'y'),
+                                ('b', 'y')]:
+        histories.record(make_entry(session, identifier))
+
+    # The two oldest entries, of separate histories, were dropped
+    assert histories.nbytes <= 20000
+    assert [len(histories.get('a', 'x')), len(histories.get('b', 'x')),
+            len(histories.get('a', 'y')), len(histories.get('b', 'y'))] == [
+        0, 0, 1, 1]
+
+    # Undone entries count towards the budget too, and are dropped once
+    # older than the other entries
+    histories.pop('b', 'y')
+    histories.record(make_entry('a', 'x'))
+    histories.record(make_entry('a', 'y'))
+
+    assert histories.nbytes <= 20000
+    assert len(histories.get('a', 'x')) == 1
+    assert len(histories.get('a', 'y')) == 1
+    assert histories._undone[('b', 'y')] == []
@@ -0,0 +1,117 @@
+"""Tests for `cosmoscope.interface.spectrum1d`."""
+import msgpack
+import numpy as np
+import astropy.units as u
+import pytest
+
+from cosmoscope.data import Data
+from cosmoscope.interface import spectrum1d
+from cosmoscope.interface.spectrum1d import AttributeCache, Spectrum1D
+from cosmoscope.server import ServerAPI
+from cosmoscope.store import store
+
+
+def roundtrip(obj):
+    # Replies reach the client with arrays still packed in extension types
+    return msgpack.unpackb(msgpack.packb(obj, use_bin_type=True), raw=False)
+
+
+class Subscriber:
+    def __init__(self):
+        self.listeners = []
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def notify(self, event, identifier):
+        for callback in self.listeners:
+            callback(event, identifier)
+
+
+class Query:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, identifier, name):
+        self.calls.append(name)
+
+        return len(self.calls)
+
+
+@pytest.fixture
+def cache():
+    subscriber = Subscriber()
+
+    return subscriber, AttributeCache(subscriber)
+
+
+def test_updates_drop_mutable_attributes(cache):
+    subscriber, cache = cache
+    query = Query()
+
+    for name in ('flux', 'identifier', 'flux', 'identifier'):
+        cache.get('a', name, query)
+
+    assert query.calls == ['flux', 'identifier']
+
+    subscriber.notify('data_updated', 'a')
+
+    assert cache.missing('a', ['flux', 'identifier']) == ['flux']
+    assert cache.get('a', 'flux', query) == 3
+    assert cache.get('a', 'identifier', query) == 2
+
+
+def test_removals_drop_all_attributes(cache):
+    subscriber, cache = cache
+    query = Query()
+    cache.get('a', 'identifier', query)
+    cache.get('b', 'identifier', query)
+
+    subscriber.notify('data_removed', 'a')
+
+    assert cache.missing('a', ['identifier']) == ['identifier']
+    assert cache.missing('b', ['identifier']) == []
+
+
+def test_values_queried_before_an_update_are_not_cached(cache):
+    subscriber, cache = cache
+    version = cache.version('a')
+
+    # The update arrives while the value is being queried
+    subscriber.notify('data_updated', 'a')
+    cache.put('a', 'flux', 1, version)
+
+    assert cache.missing('a', ['flux']) == ['flux']
+
+    cache.put('a', 'flux', 2, cache.version('a'))
+
+    assert cache.missing('a', ['flux']) == []
+
+
+def test_prefetch_fetches_immutable_attributes(monkeypatch):
+    server = ServerAPI()
+    data = Data(np.arange(10.) * u.Jy,
+                spectral_axis=np.linspace(4000., 5000., 10) * u.AA)
+
+    class Client:
+        @staticmethod
+        def query_batch(requests, binary):
+            return roundtrip(server.query_batch(requests, binary))
+
+    monkeypatch.setattr(spectrum1d.subscriber, 'client', Client())
+    monkeypatch.setattr(spectrum1d, 'cache',
+                        AttributeCache(spectrum1d.subscriber))
+
+    spectrum = Spectrum1D.__new__(Spectrum1D)
+    spectrum._identifier = data.identifier
+
+    try:
+        spectrum1d.prefetch([spectrum], ['identifier', 'wcs', 'flux'])
+    finally:
+        store.unregister(data.identifier)
+
+    assert spectrum.identifier == data.identifier
+    np.testing.assert_array_equal(
+        spectrum.wcs.pixel_to_world(np.arange(10)), data.spectral_axis)
+    np.testing.assert_array_equal(spectrum.flux, data.flux)
+    assert spectrum1d.cache.hits == 3
@@ -0,0 +1,71 @@
+"""Tests for `cosmoscope.io`."""
+import os
+
+import pytest
+from astropy.io import registry as io_registry
+from specutils import Spectrum1D
+
+from cosmoscope.data import Data
+from cosmoscope.io import identify_format, loader_formats
+
+FORMAT = 'cosmoscope-test'
+
+
+@pytest.fixture
+def identified():
+    calls = []
+
+    def identify(origin, path, *args, **kwargs):
+        calls.append(path)
+
+        return path.endswith('.test')
+
+    io_registry.register_reader(FORMAT, Data, lambda path: None)
+    io_registry.register_identifier(FORMAT, Data, identify)
+
+    yield calls
+
+    io_registry.unregister_reader(FORMAT, Data)
+    io_registry.unregister_identifier(FORMAT, Data)
+
+
+def test_identification_is_cached_until_the_file_changes(tmp_path,
+                                                         identified):
+    path = tmp_path / 'spectrum.test'
+    path.write_text('1 2 3')
+
+    assert FORMAT in identify_format(str(path))
+    assert FORMAT in identify_format(str(path))
+    assert len(identified) == 1
+
+    # A change of size
+    path.write_text('1 2 3 4')
+    identify_format(str(path))
+
+    assert len(identified) == 2
+
+    # A change of modification time only
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    identify_format(str(path))
+
+    assert len(identified) == 3
+
+
+def test_registry_changes_invalidate_cached_results(tmp_path, identified):
+    path = tmp_path / 'spectrum.test'
+    path.write_text('1 2 3')
+
+    identify_format(str(path))
+    assert FORMAT not in loader_formats()
+
+    io_registry.register_reader(FORMAT, Spectrum1D, lambda path: None)
+
+    try:
+        assert FORMAT in loader_formats()
+        identify_format(str(path))
+    finally:
+        io_registry.unregister_reader(FORMAT, Spectrum1D)
+
+    assert len(identified) == 2
+    assert FORMAT not in loader_formats()
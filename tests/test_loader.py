@@ -0,0 +1,67 @@
+"""Tests for `cosmoscope.loader`."""
+import threading
+
+import numpy as np
+import astropy.units as u
+import pytest
+from astropy.io import registry as io_registry
+
+from cosmoscope.data import Data
+from cosmoscope.loader import loader
+from cosmoscope.store import store
+
+FORMAT = 'cosmoscope-test'
+
+
+@pytest.fixture
+def reader():
+    # Both valid files must be read at the same time to get past the barrier
+    barrier = threading.Barrier(2, timeout=10)
+
+    def read(path):
+        with open(path) as f:
+            values = [float(x) for x in f.read().split()]
+
+        barrier.wait()
+
+        return Data(np.array(values) * u.Jy,
+                    spectral_axis=np.arange(len(values)) * u.AA)
+
+    io_registry.register_reader(FORMAT, Data, read)
+    io_registry.register_identifier(
+        FORMAT, Data, lambda origin, path, *args, **kwargs:
+        str(path).endswith('.test'))
+
+    yield
+
+    io_registry.unregister_reader(FORMAT, Data)
+    io_registry.unregister_identifier(FORMAT, Data)
+
+
+def test_files_are_loaded_concurrently(tmp_path, reader):
+    (tmp_path / 'a.test').write_text('1 2 3')
+    (tmp_path / 'b.test').write_text('4 5')
+    (tmp_path / 'c.test').write_text('6 x')
+
+    progress = []
+
+    result = loader.load(str(tmp_path), None,
+                         lambda *args: progress.append(args))
+
+    try:
+        assert sorted(store[identifier].flux.value.tolist()
+                      for identifier in result['loaded']) == [[1., 2., 3.],
+                                                              [4., 5.]]
+    finally:
+        for identifier in result['loaded']:
+            store.unregister(identifier)
+
+    # The error of the unreadable file is reported without stopping the
+    # other files from loading
+    path = str(tmp_path / 'c.test')
+
+    assert list(result['failed']) == [path]
+    assert 'could not convert' in result['failed'][path]
+    assert sorted(n_done for *_, n_done, _ in progress) == [1, 2, 3]
+    assert [args[:2] for args in progress if args[2] is not None] == [
+        (path, None)]
@@ -0,0 +1,65 @@
+"""Tests for `cosmoscope.utils.pyramid`."""
+import numpy as np
+import pytest
+
+from cosmoscope.utils.pyramid import Pyramid
+
+
+def reference(array, edges, stop):
+    bounds = np.append(edges, stop)
+    bins = list(zip(bounds[:-1], bounds[1:]))
+
+    return (np.array([np.nanmin(array[a:b]) for a, b in bins]),
+            np.array([np.nanmax(array[a:b]) for a, b in bins]))
+
+
+@pytest.mark.parametrize('factor', [2, 4, 7])
+@pytest.mark.parametrize('start,stop,n_pixels', [
+    (0, 10000, 100),
+    (13, 9871, 97),
+    (1, 10000, 3),
+    (4095, 4097 + 64 * 5, 5),
+    (333, 9999, 1)])
+def test_decimate_matches_bins(factor, start, stop, n_pixels):
+    array = np.random.default_rng(0).normal(size=10000)
+    edges, mins, maxs = Pyramid(array, factor).decimate(start, stop, n_pixels)
+
+    assert edges[0] == start
+    assert len(edges) == n_pixels
+
+    expected_mins, expected_maxs = reference(array, edges, stop)
+
+    np.testing.assert_array_equal(mins, expected_mins)
+    np.testing.assert_array_equal(maxs, expected_maxs)
+
+
+def test_decimate_excludes_samples_outside_range():
+    array = np.zeros(4096)
+    array[:100] = 1e9
+    array[-100:] = -1e9
+
+    _, mins, maxs = Pyramid(array).decimate(100, 3996, 4)
+
+    np.testing.assert_array_equal(mins, 0)
+    np.testing.assert_array_equal(maxs, 0)
+
+
+def test_decimate_ignores_nans():
+    array = np.arange(1000.)
+    array[::3] = np.nan
+    array[500:600] = np.nan
+
+    edges, mins, maxs = Pyramid(array).decimate(7, 993, 10)
+    expected_mins, expected_maxs = reference(array, edges, 993)
+
+    np.testing.assert_array_equal(mins, expected_mins)
+    np.testing.assert_array_equal(maxs, expected_maxs)
+
+
+def test_decimate_returns_raw_samples_when_few():
+    array = np.arange(50.)
+    edges, mins, maxs = Pyramid(array).decimate(10, 20, 100)
+
+    np.testing.assert_array_equal(edges, np.arange(10, 20))
+    np.testing.assert_array_equal(mins, array[10:20])
+    np.testing.assert_array_equal(maxs, array[10:20])
@@ -0,0 +1,92 @@
+"""Tests for `cosmoscope.operations.resample`."""
+import numpy as np
+import pytest
+
+from cosmoscope.operations.resample import resample
+
+SOURCE = np.linspace(4000., 5000., 101)
+TARGET = np.linspace(4003., 4997., 67)
+
+
+def test_linear_reproduces_linear_values():
+    flux, _, _ = resample(2 * SOURCE + 1, SOURCE, TARGET)
+
+    np.testing.assert_allclose(flux, 2 * TARGET + 1)
+
+
+def test_flux_conserving_keeps_integrated_flux():
+    values = np.random.RandomState(0).uniform(1, 2, len(SOURCE))
+    target = SOURCE[::4]
+
+    flux, _, _ = resample(values, SOURCE, target, method='flux_conserving')
+    inside = ~np.isnan(flux)
+
+    # Each target bin covers three source bins and half of two more
+    expected = [(values[i - 2] / 2 + values[i - 1] + values[i]
+                 + values[i + 1] + values[i + 2] / 2) / 4
+                for i in 4 * np.flatnonzero(inside)]
+
+    np.testing.assert_allclose(flux[inside], expected)
+    assert inside[1:-1].all()
+
+
+def test_spline_reproduces_cubic_values():
+    def cubic(x):
+        x = (x - 4500) / 500
+        return x ** 3 - 2 * x ** 2 + x
+
+    flux, _, _ = resample(cubic(SOURCE), SOURCE, TARGET, method='spline')
+
+    np.testing.assert_allclose(flux, cubic(TARGET), atol=1e-10)
+
+
+@pytest.mark.parametrize('method', ['linear', 'flux_conserving', 'spline'])
+def test_reversed_grids(method):
+    values = np.sin(SOURCE / 50)
+    expected, _, _ = resample(values, SOURCE, TARGET, method=method)
+
+    flux, _, _ = resample(values[::-1], SOURCE[::-1], TARGET, method=method)
+    np.testing.assert_allclose(flux, expected)
+
+    flux, _, _ = resample(values, SOURCE, TARGET[::-1], method=method)
+    np.testing.assert_allclose(flux, expected[::-1])
+
+
+def test_linear_propagates_masks_and_uncertainties():
+    mask = np.zeros(len(SOURCE), dtype=bool)
+    mask[50] = True
+
+    flux, uncertainty, result_mask = resample(
+        SOURCE, SOURCE, [4495., 4500., 4515., 3000.],
+        uncertainty=np.ones(len(SOURCE)), mask=mask)
+
+    np.testing.assert_array_equal(result_mask, [True, True, False, True])
+    np.testing.assert_allclose(uncertainty[2], np.sqrt(0.5 ** 2 * 2))
+    assert np.isnan(flux[3])
+
+
+def test_spline_ignores_masked_and_non_finite_values():
+    values = np.sin(SOURCE / 50)
+    expected, _, _ = resample(values, SOURCE, TARGET, method='spline')
+
+    corrupted = values.copy()
+    corrupted[30] = np.nan
+    corrupted[60] = 1e6
+    mask = np.zeros(len(SOURCE), dtype=bool)
+    mask[60] = True
+
+    flux, uncertainty, result_mask = resample(
+        np.stack([values, corrupted]), SOURCE, TARGET, method='spline',
+        mask=np.stack([np.zeros(len(SOURCE), dtype=bool), mask]))
+
+    # Only the values between the neighbours of the invalid values are
+    # masked, and the other values are close to the uncorrupted spline
+    gaps = (np.abs(TARGET - SOURCE[30]) < 10) \
+        | (np.abs(TARGET - SOURCE[60]) < 10)
+
+    assert uncertainty is None
+    np.testing.assert_array_equal(result_mask[0], False)
+    np.testing.assert_array_equal(result_mask[1], gaps)
+    np.testing.assert_array_equal(flux[0], expected)
+    np.testing.assert_allclose(flux[1][~gaps], expected[~gaps], atol=1e-3)
+    assert np.isnan(flux[1][gaps]).all()
@@ -0,0 +1,150 @@
+"""Tests for `cosmoscope.server`."""
+import jsonpickle
+import msgpack
+import numpy as np
+import astropy.units as u
+import pytest
+
+from cosmoscope.data import Data
+from cosmoscope.server import ServerAPI
+from cosmoscope.store import store
+from cosmoscope.transport import unpack
+
+
+def roundtrip(obj):
+    return unpack(msgpack.unpackb(msgpack.packb(obj, use_bin_type=True),
+                                  raw=False))
+
+
+@pytest.fixture
+def server():
+    return ServerAPI()
+
+
+@pytest.fixture
+def data():
+    data = Data(np.arange(10.) * u.Jy,
+                spectral_axis=np.linspace(4000., 5000., 10) * u.AA,
+                name='spectrum')
+
+    yield data
+
+    if data.identifier in store:
+        store.unregister(data.identifier)
+
+
+def test_query_batch_mixes_arrays_and_other_attributes(server, data):
+    names = ['flux', 'name', 'identifier', 'unit', 'wcs']
+
+    result, = roundtrip(server.query_batch([(data.identifier, names)], True))
+
+    np.testing.assert_array_equal(result['flux'], data.flux)
+    assert jsonpickle.decode(result['name']) == 'spectrum'
+    assert jsonpickle.decode(result['identifier']) == data.identifier
+    assert jsonpickle.decode(result['unit']) == u.Jy
+    np.testing.assert_array_equal(
+        jsonpickle.decode(result['wcs']).pixel_to_world(np.arange(10)),
+        data.spectral_axis)
+
+
+def test_undo_and_redo_use_the_session_history(server):
+    import cosmoscope.operations.filter  # noqa: F401
+    from cosmoscope.operations.history import histories
+
+    history = histories.get('test-session')
+    server.call_operation('test-session', 'smooth_data', np.arange(10.),
+                          np.ones(3) / 3)
+
+    server.undo('test-session')
+
+    assert len(history) == 0
+
+    server.redo('test-session')
+
+    assert len(history) == 1
+    assert history[0].name == 'Apply Smooth'
+
+
+def test_query_data_slice(server, data):
+    result = server.query_data_slice(data.identifier, 2, 9, 3)
+
+    assert result['flux'] == [2., 5., 8.]
+    assert result['spectral_axis'] == data.spectral_axis.value[2:9:3].tolist()
+    assert result['version'] == data.version
+
+    result = roundtrip(server.query_data_slice(data.identifier, -3, None,
+                                               None, True))
+
+    np.testing.assert_array_equal(result['flux'], [7., 8., 9.])
+
+
+@pytest.mark.parametrize('start, stop, stride', [
+    (None, None, None), (1, None, 2), (2, 9, 3), (9, 2, 2)])
+def test_stream_data_chunks(server, data, start, stop, stride):
+    chunks = list(server.stream_data(data.identifier, start, stop, stride,
+                                     2))
+    expected = np.arange(10.)[start:stop:stride]
+
+    # Chunks hold at most two samples, and start at the index of their
+    # first sample in the full data object
+    assert all(len(chunk['flux']) <= 2 for chunk in chunks)
+    assert [chunk['start'] for chunk in chunks] == \
+        expected[::2].astype(int).tolist()
+    assert sum((chunk['flux'] for chunk in chunks), []) == expected.tolist()
+    assert sum((chunk['spectral_axis'] for chunk in chunks), []) == \
+        data.spectral_axis.value[start:stop:stride].tolist()
+
+
+def test_stream_data_rejects_negative_strides(server, data):
+    with pytest.raises(ValueError):
+        list(server.stream_data(data.identifier, None, None, -1))
+
+
+class Publisher:
+    def __init__(self):
+        self.events = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.events.append((name,) + args)
+
+
+@pytest.fixture
+def publisher(server, monkeypatch):
+    publisher = Publisher()
+    monkeypatch.setattr(server, 'publisher', publisher)
+    store.subscribe(server.publish_change)
+
+    yield publisher
+
+    store.unsubscribe(server.publish_change)
+
+
+def test_updates_publish_the_changed_ranges(publisher, data):
+    store.update(data.identifier,
+                 {'data': {'start': 2, 'values': [0., 0., 4., 0.]},
+                  'name': 'renamed'})
+
+    (event, identifier, delta), = publisher.events
+    delta = roundtrip(delta)
+
+    assert (event, identifier) == ('data_updated', data.identifier)
+    assert delta['version'] == data.version
+    assert delta['previous_version'] == data.version - 1
+    assert delta['fields'] == {'name': 'renamed'}
+    assert not delta['reload']
+
+    (start, stop, values), (start2, stop2, values2) = delta['arrays']['data']
+
+    assert (start, stop, start2, stop2) == (2, 4, 5, 6)
+    np.testing.assert_array_equal(values, [0., 0.])
+    np.testing.assert_array_equal(values2, [0.])
+
+
+def test_large_updates_ask_for_a_reload(publisher, data):
+    store.update(data.identifier, {'data': np.zeros(10)})
+    store.unregister(data.identifier)
+
+    (_, _, delta), removed = publisher.events
+
+    assert delta['reload'] and delta['arrays'] == {}
+    assert removed == ('data_removed', data.identifier)
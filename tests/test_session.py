@@ -0,0 +1,142 @@
+"""Tests for `cosmoscope.session`."""
+import numpy as np
+import astropy.units as u
+from astropy.nddata import StdDevUncertainty
+from astropy.wcs import WCS
+
+from cosmoscope.data import Data
+from cosmoscope.mixins import deferred_registration
+from cosmoscope.session import dump_data, load_data
+
+
+def make_data(**kwargs):
+    with deferred_registration():
+        return Data(np.arange(5.) * u.Jy, **kwargs)
+
+
+def roundtrip(data, tmp_path):
+    entry = dump_data(data, str(tmp_path))
+
+    return load_data(data.identifier, entry, str(tmp_path))
+
+
+def test_dump_keeps_arrays_and_meta(tmp_path):
+    data = make_data(spectral_axis=np.arange(5.) * u.AA,
+                     uncertainty=StdDevUncertainty(np.ones(5)),
+                     mask=np.array([0, 1, 0, 0, 1], dtype=bool),
+                     meta={'object': 'M31', 'exposure': 1200.5,
+                           'history': ['reduced', 'flux calibrated']},
+                     name='spectrum')
+
+    result = roundtrip(data, tmp_path)
+
+    assert result.identifier == data.identifier
+    assert result.name == 'spectrum'
+    assert dict(result.meta) == dict(data.meta)
+    np.testing.assert_array_equal(result.flux, data.flux)
+    np.testing.assert_array_equal(result.spectral_axis, data.spectral_axis)
+    np.testing.assert_array_equal(result.uncertainty.array, np.ones(5))
+    np.testing.assert_array_equal(result.mask, data.mask)
+
+
+def test_dump_keeps_fits_wcs(tmp_path):
+    wcs = WCS(naxis=1)
+    wcs.wcs.ctype = ['WAVE']
+    wcs.wcs.cunit = ['Angstrom']
+    wcs.wcs.crval = [5000.]
+    wcs.wcs.cdelt = [2.]
+    wcs.wcs.crpix = [1.]
+
+    data = make_data(wcs=wcs)
+    result = roundtrip(data, tmp_path)
+
+    assert isinstance(result.wcs, WCS)
+    np.testing.assert_allclose(result.spectral_axis.to_value(u.AA),
+                               data.spectral_axis.to_value(u.AA))
+
+
+def test_journal_replays_registers_and_update_deltas(tmp_path):
+    from cosmoscope.session import Autosave, Journal, open_session
+    from cosmoscope.store import Store
+
+    store = Store()
+    autosave = Autosave(store, str(tmp_path), interval=3600)
+    autosave.start()
+
+    data = make_data(spectral_axis=np.arange(5.) * u.AA, name='spectrum')
+    store.register(data)
+    store.update(data.identifier, {'data': {'start': 1, 'values': [7., 8.]},
+                                   'name': 'renamed'})
+    store.update(data.identifier, {'mask': {'start': 4, 'values': [True]}})
+    autosave._journal.flush()
+
+    # Each record is written to its own directory, and updates only hold
+    # the changed values
+    journal_path = tmp_path / 'journal' / data.identifier
+    assert sorted(p.name for p in journal_path.iterdir()) == ['0', '1', '2']
+    assert np.load(str(journal_path / '1' / 'data.npy')).tolist() == [7., 8.]
+
+    # Recover the session as if the server had crashed
+    recovered = Store()
+    open_session(recovered, str(tmp_path))
+    result = recovered[data.identifier]
+
+    assert result.name == 'renamed'
+    assert result.version == data.version
+    np.testing.assert_array_equal(result.flux.value, [0., 7., 8., 3., 4.])
+    np.testing.assert_array_equal(result.mask, [0, 0, 0, 0, 1])
+    assert len(Journal(str(tmp_path))) == 3
+
+    # A snapshot covers, and removes, the journalled events
+    autosave.stop()
+
+    assert not (tmp_path / 'journal').exists()
+
+
+def test_journal_reads_memmapped_arrays_in_the_writer(tmp_path):
+    from cosmoscope.session import Journal
+
+    journal = Journal(str(tmp_path))
+    data = make_data(spectral_axis=np.arange(5.) * u.AA)
+    data.to_memmap(str(tmp_path / 'arrays'))
+
+    written = []
+    write = journal._write
+
+    def spy(record, arrays):
+        written.append(arrays)
+        write(record, arrays)
+
+    journal._write = spy
+    journal.record('register', data.identifier, data)
+    journal.close()
+
+    # The flux is not copied when the event is recorded
+    assert np.shares_memory(written[0]['flux'], data.data)
+    assert np.load(str(tmp_path / 'journal' / data.identifier / '0'
+                       / 'flux.npy')).tolist() == [0., 1., 2., 3., 4.]
+
+
+def test_opened_sessions_are_indexed_without_loading(tmp_path):
+    from cosmoscope.index import SpectralIndex
+    from cosmoscope.session import DeferredData, open_session, save_session
+    from cosmoscope.store import Store
+
+    store = Store()
+    data = make_data(spectral_axis=np.arange(5.) * u.AA)
+    store.register(data)
+    save_session(store, str(tmp_path))
+
+    opened = Store()
+    events = []
+    opened.subscribe(lambda event, identifier, **info: events.append(
+        (event, identifier, info.get('restored'))))
+    index = SpectralIndex()
+    index.attach(opened)
+    open_session(opened, str(tmp_path))
+
+    assert events == [('register', data.identifier, True)]
+    assert index.query((1, 2), [('flux_max', '>=', 2)], slices=True) == [
+        {'identifier': data.identifier, 'start': 1, 'stop': 3}]
+    assert index.query((1, 2), [('flux_max', '>', 2)]) == []
+    assert isinstance(dict.get(opened, data.identifier), DeferredData)
@@ -0,0 +1,172 @@
+"""Tests for `cosmoscope.store`."""
+import numpy as np
+import astropy.units as u
+import pytest
+
+from cosmoscope.catalogue import Catalogue
+from cosmoscope.store import Store
+
+
+@pytest.fixture
+def catalogue_store():
+    store = Store()
+    catalogue = Catalogue.from_arrays(
+        [np.arange(3.) * u.Jy, np.arange(4.) * u.Jy],
+        [np.arange(3.) * u.AA, np.arange(4.) * u.AA])
+    store.register_catalogue(catalogue)
+
+    return store, catalogue.identifier
+
+
+def test_catalogue_spectra_are_in_the_store(catalogue_store):
+    store, identifier = catalogue_store
+    key = '{}/1'.format(identifier)
+
+    assert key in store
+    assert store.get(key).flux.value.tolist() == [0., 1., 2., 3.]
+    assert '{}/2'.format(identifier) not in store
+    assert '{}/x'.format(identifier) not in store
+    assert store.get('{}/2'.format(identifier)) is None
+
+
+def test_catalogue_spectra_can_not_be_updated(catalogue_store):
+    store, identifier = catalogue_store
+    events = []
+    store.subscribe(lambda *args, **info: events.append(args))
+
+    with pytest.raises(KeyError):
+        store.update('{}/0'.format(identifier), {'name': 'renamed'})
+
+    store.unregister('{}/0'.format(identifier))
+
+    assert events == []
+    assert '{}/0'.format(identifier) in store
+
+
+def test_register_many_announces_data_added_before_an_error():
+    from cosmoscope.data import Data
+    from cosmoscope.mixins import deferred_registration
+
+    store = Store()
+    events = []
+    store.subscribe(lambda event, identifier, **info: events.append(
+        (event, identifier)))
+
+    with deferred_registration():
+        data = Data(np.arange(3.) * u.Jy, spectral_axis=np.arange(3.) * u.AA)
+
+    def datasets():
+        yield data
+        raise RuntimeError("Unreadable data")
+
+    with pytest.raises(RuntimeError):
+        store.register_many(datasets())
+
+    assert events == [('register', data.identifier)]
+    assert store[data.identifier] is data
+
+
+def test_large_data_is_memmapped_at_registration(tmp_path, monkeypatch):
+    import gc
+    import os
+
+    from cosmoscope.data import Data
+    from cosmoscope.mixins import deferred_registration
+
+    monkeypatch.setattr('cosmoscope.data.MEMMAP_PATH', str(tmp_path))
+
+    store = Store()
+    store.memmap_threshold = 800
+
+    with deferred_registration():
+        small = Data(np.zeros(99) * u.Jy,
+                     spectral_axis=np.arange(99.) * u.AA)
+        large = Data(np.arange(100.) * u.Jy,
+                     spectral_axis=np.arange(100.) * u.AA)
+
+    store.register(small)
+    store.register(large)
+
+    assert not small.is_memmapped
+    assert large.is_memmapped
+    assert os.listdir(str(tmp_path)) == [large.identifier]
+    assert store.stats['resident_bytes'] == small.nbytes
+    np.testing.assert_array_equal(store[large.identifier].flux.value,
+                                  np.arange(100.))
+
+    # The files are removed once the data object is no longer referenced
+    store.unregister(large.identifier)
+    del large
+    gc.collect()
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_eviction_skips_memmapped_data_and_spills_per_store(tmp_path):
+    import gc
+    import os
+
+    from cosmoscope.data import Data
+    from cosmoscope.mixins import deferred_registration
+
+    store = Store()
+    store.memory_budget = 1000
+
+    with deferred_registration():
+        mapped = Data(np.zeros(500) * u.Jy,
+                      spectral_axis=np.arange(500.) * u.AA)
+        first = Data(np.zeros(100) * u.Jy,
+                     spectral_axis=np.arange(100.) * u.AA)
+        second = Data(np.ones(100) * u.Jy,
+                      spectral_axis=np.arange(100.) * u.AA)
+
+    mapped.to_memmap(str(tmp_path / 'mapped'))
+    store.register(mapped)
+    store.register(first)
+    store.register(second)
+
+    # Only the data object held in memory is evicted, to this store's own
+    # spill directory
+    assert store.stats['evictions'] == 1
+    assert os.listdir(store._spill_path) == [first.identifier]
+    assert store[first.identifier].flux.value.tolist() == [0.] * 100
+
+    spill_path = store._spill_path
+    del store
+    gc.collect()
+
+    assert not os.path.exists(spill_path)
+
+
+def test_changed_ranges():
+    from cosmoscope.store import _changed_ranges
+
+    old = np.array([0., 1., np.nan, 3., 4., 5.])
+    new = np.array([0., 9., np.nan, 9., 9., 5.])
+
+    assert _changed_ranges(old, new) == [[1, 2], [3, 5]]
+    assert _changed_ranges(old, new, offset=10) == [[11, 12], [13, 15]]
+    assert _changed_ranges(old, old.copy()) == []
+    assert _changed_ranges(old, 0.) == [[1, 6]]
+
+    # Rows of two-dimensional arrays change together
+    assert _changed_ranges(np.zeros((2, 4)), np.array(
+        [[0, 1, 0, 0], [0, 0, 0, 1]])) == [[1, 2], [3, 4]]
+
+
+def test_update_array_validates_the_range():
+    from cosmoscope.data import Data
+    from cosmoscope.mixins import deferred_registration
+
+    with deferred_registration():
+        data = Data(np.zeros(4) * u.Jy, spectral_axis=np.arange(4.) * u.AA)
+
+    with pytest.raises(ValueError):
+        Store._update_array(data, 'data', {'start': -1, 'values': [1.]})
+
+    with pytest.raises(ValueError):
+        Store._update_array(data, 'data', {'start': 3, 'values': [1., 2.]})
+
+    assert Store._update_array(
+        data, 'mask', {'start': 2, 'values': [True]}) == [[2, 3]]
+    assert data.mask.tolist() == [False, False, True, False]
@@ -0,0 +1,44 @@
+"""Tests for `cosmoscope.transport`."""
+import msgpack
+import numpy as np
+import pytest
+from astropy.units import Quantity
+
+from cosmoscope.transport import pack_array, unpack, unpack_array
+
+
+def roundtrip(obj):
+    return unpack(msgpack.unpackb(msgpack.packb(obj, use_bin_type=True),
+                                  raw=False))
+
+
+@pytest.mark.parametrize('array', [
+    np.array(5.),
+    np.arange(10, dtype=np.int16),
+    np.arange(12.).reshape(3, 4).T,
+    np.empty((0, 3), dtype=np.float32)])
+def test_roundtrip_preserves_shape_and_dtype(array):
+    result = roundtrip(pack_array(array))
+
+    assert result.shape == array.shape
+    assert result.dtype == array.dtype
+    np.testing.assert_array_equal(result, array)
+
+
+def test_roundtrip_quantity():
+    result = roundtrip({'flux': pack_array(Quantity([1., 2.], 'Jy'))})
+
+    assert result['flux'].unit == 'Jy'
+    np.testing.assert_array_equal(result['flux'].value, [1., 2.])
+
+
+def test_unpacked_arrays_are_read_only():
+    result = unpack_array(pack_array(np.arange(3.)))
+
+    with pytest.raises(ValueError):
+        result[0] = 1.
+
+
+def test_object_arrays_are_rejected():
+    with pytest.raises(TypeError):
+        pack_array(np.array([None, 1]))